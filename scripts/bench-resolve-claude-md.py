@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""Benchmark resolve-claude-md.py on synthetic monorepos.
+
+Generates a git repository with a configurable shape (directory depth and
+fan-out, CLAUDE.md count, @ include chains and fan-in, document sizes,
+fence/backtick density), runs the resolver in merge-base, working-tree and
+--check-head modes, and records wall time, peak RSS and git process counts.
+A large-document mode also resolves one long CLAUDE.md full of fenced @
+lines, where directive scanning dominates.
+
+Usage:
+    # Record a baseline on one commit...
+    python3 bench-resolve-claude-md.py --output before.json
+
+    # ...and compare another commit against it (exit 1 on regression):
+    python3 bench-resolve-claude-md.py --baseline before.json
+
+Generation is deterministic for a given shape and --seed, so results from
+different commits of the resolver measure the same repository. Peak RSS is
+the resolver process's own maximum resident set (git children excluded).
+Git processes are counted by a `git` wrapper put first on PATH, so any
+version of the resolver can be measured without flags of its own.
+"""
+
+import argparse
+import json
+import os
+import posixpath
+import random
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+RESOLVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resolve-claude-md.py")
+MODES = ["merge-base", "working-tree", "check-head", "large-document"]
+LARGE_DOC_DIR = "large"
+BENCH_FORMAT_VERSION = 1
+
+
+@dataclass
+class Shape:
+    """Parameters of a synthetic repository and of the queries run against it."""
+    dir_depth: int = 4
+    fanout: int = 4
+    files_per_dir: int = 3
+    guidelines: int = 40
+    chains: int = 8
+    chain_depth: int = 4
+    fan_in: int = 5
+    doc_bytes: int = 2000
+    fence_ratio: float = 0.3
+    changed_files: int = 20
+    budget: int = 8000
+    large_doc_lines: int = 50_000
+    seed: int = 0
+
+
+# --- Repository generation ---
+
+
+def _git(repo: str, *args: str) -> str:
+    result = subprocess.run(
+        ["git", "-C", repo] + list(args), capture_output=True, text=True, check=True,
+    )
+    return result.stdout.strip()
+
+
+def markdown_body(rnd: random.Random, size: int, fence_ratio: float) -> str:
+    """Markdown prose of about `size` bytes with fenced samples and inline code.
+
+    Fenced blocks and inline spans contain @ lines that must not be
+    treated as directives, which exercises the fence tracking.
+    """
+    lines = []
+    total = 0
+    while total < size:
+        if rnd.random() < fence_ratio:
+            fence = rnd.choice(["```", "~~~", "````"])
+            block = [fence + "go", "@not/a/directive.md", "x := `tick`", fence]
+        else:
+            words = rnd.randint(4, 16)
+            block = [" ".join(rnd.choice(["use", "`code`", "the", "`@span.md`", "rules"])
+                              for _ in range(words))]
+        lines.extend(block)
+        total += sum(len(line) + 1 for line in block)
+    return "\n".join(lines) + "\n"
+
+
+def large_document(n_lines: int) -> str:
+    """A long CLAUDE.md whose code samples are full of @ lines that are not directives."""
+    block = ["## Example", "```go", "@not-a-directive.md", "x := 1", "```", ""]
+    return "\n".join((block * (n_lines // len(block) + 1))[:n_lines]) + "\n"
+
+
+def directory_tree(shape: Shape) -> list[str]:
+    """All directories of the synthetic tree, parents before children."""
+    dirs = [""]
+    level = [""]
+    for _ in range(shape.dir_depth):
+        level = [
+            f"{parent}/d{i}" if parent else f"d{i}"
+            for parent in level
+            for i in range(shape.fanout)
+        ]
+        dirs.extend(level)
+    return dirs
+
+
+def generate_repo(root: str, shape: Shape) -> dict:
+    """Create the synthetic repository with a base and a head commit.
+
+    Returns the base and head commit IDs and the changed files the
+    resolver is asked about.
+    """
+    rnd = random.Random(shape.seed)
+    dirs = directory_tree(shape)
+    os.makedirs(root, exist_ok=True)
+    _git(root, "init", "-q")
+    _git(root, "config", "user.email", "bench@example.com")
+    _git(root, "config", "user.name", "bench")
+
+    def write(path: str, content: str) -> None:
+        full = os.path.join(root, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, "w") as f:
+            f.write(content)
+
+    source_files = []
+    for d in dirs:
+        for i in range(shape.files_per_dir):
+            path = f"{d}/f{i}.go" if d else f"f{i}.go"
+            write(path, f"package p{i}\n")
+            source_files.append(path)
+
+    # Shared @ chains: docs/cN/l0.md -> docs/cN/l1.md -> ...
+    chain_heads = []
+    for c in range(shape.chains):
+        for level in range(shape.chain_depth):
+            body = markdown_body(rnd, shape.doc_bytes, shape.fence_ratio)
+            if level + 1 < shape.chain_depth:
+                body += f"@l{level + 1}.md\n"
+            write(f"docs/c{c}/l{level}.md", body)
+        chain_heads.append(f"docs/c{c}/l0.md")
+
+    # Guidelines spread over the tree; each chain is included by fan_in of them
+    guideline_paths = ["CLAUDE.md"]
+    candidates = [posixpath.join(d, "CLAUDE.md") for d in dirs if d]
+    candidates += [posixpath.join(d, ".claude", "CLAUDE.md") for d in dirs]
+    rnd.shuffle(candidates)
+    guideline_paths.extend(candidates[:max(0, shape.guidelines - 1)])
+    includes = {path: [] for path in guideline_paths}
+    for head in chain_heads:
+        for path in rnd.sample(guideline_paths, min(shape.fan_in, len(guideline_paths))):
+            includes[path].append(head)
+    for path in guideline_paths:
+        # Directives resolve relative to the directory the guideline applies to
+        owner = posixpath.dirname(path)
+        if posixpath.basename(owner) == ".claude":
+            owner = posixpath.dirname(owner)
+        body = markdown_body(rnd, shape.doc_bytes, shape.fence_ratio)
+        body += "".join(f"@{posixpath.relpath(head, owner or '.')}\n" for head in includes[path])
+        write(path, body)
+
+    _git(root, "add", "-A")
+    _git(root, "commit", "-q", "-m", "base")
+    base = _git(root, "rev-parse", "HEAD")
+
+    # Head commit: touch the queried files and add a guideline in a leaf dir
+    changed = rnd.sample(source_files, min(shape.changed_files, len(source_files)))
+    for path in changed:
+        write(path, f"package changed // {path}\n")
+    leaf = os.path.dirname(changed[0]) if changed else ""
+    write(f"{leaf}/CLAUDE.md" if leaf else "CLAUDE.md", "Added in the PR\n")
+    _git(root, "add", "-A")
+    _git(root, "commit", "-q", "-m", "head")
+    head = _git(root, "rev-parse", "HEAD")
+
+    # Untracked: only the working-tree large-document mode reads it
+    write(f"{LARGE_DOC_DIR}/CLAUDE.md", large_document(shape.large_doc_lines))
+    return {"base": base, "head": head, "changed_files": sorted(changed)}
+
+
+# --- Measurement ---
+
+
+def resolver_argv(mode: str, repo: str, base: str, files: list[str], budget: int) -> list[str]:
+    if mode == "large-document":
+        # A budget the document fits in, so all of it is scanned
+        return [
+            "--git-dir", repo, "--budget", str(10**9), "--working-tree",
+            "--files", f"{LARGE_DOC_DIR}/main.go",
+        ]
+    argv = ["--git-dir", repo, "--budget", str(budget), "--files"] + files
+    if mode == "working-tree":
+        return argv + ["--working-tree"]
+    argv += ["--merge-base", base]
+    if mode == "check-head":
+        argv.append("--check-head")
+    return argv
+
+
+@dataclass
+class GitCounter:
+    """A `git` wrapper that logs each invocation before running the real git."""
+    env: dict
+    log_path: str
+
+    @classmethod
+    def install(cls, directory: str) -> "GitCounter":
+        real_git = shutil.which("git")
+        if real_git is None:
+            raise RuntimeError("git not found on PATH")
+        log_path = os.path.join(directory, "git.log")
+        wrapper = os.path.join(directory, "git")
+        with open(wrapper, "w") as f:
+            f.write(
+                "#!/bin/sh\n"
+                f"echo >> {shlex.quote(log_path)}\n"
+                f'exec {shlex.quote(real_git)} "$@"\n'
+            )
+        os.chmod(wrapper, 0o755)
+        env = dict(os.environ, PATH=directory + os.pathsep + os.environ.get("PATH", ""))
+        return cls(env=env, log_path=log_path)
+
+    def reset(self) -> None:
+        open(self.log_path, "w").close()
+
+    def count(self) -> int:
+        with open(self.log_path, "rb") as f:
+            return f.read().count(b"\n")
+
+
+def run_once(resolver: str, argv: list[str], counter: GitCounter) -> dict:
+    """Run the resolver once; return wall time, peak RSS (KiB) and git processes."""
+    counter.reset()
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            [sys.executable, resolver] + argv, stdout=out, stderr=err, env=counter.env,
+        )
+        _pid, status, rusage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        err.seek(0)
+        stderr = err.read().decode("utf-8", "replace")
+    if proc.returncode != 0:
+        raise RuntimeError(f"resolver failed ({proc.returncode}): {stderr}")
+    return {
+        "wall_seconds": wall,
+        "peak_rss_kib": rusage.ru_maxrss,  # KiB on Linux
+        "git_processes": counter.count(),
+    }
+
+
+def measure(resolver: str, repo: str, info: dict, budget: int, repeat: int) -> dict:
+    """Median wall time and maximum RSS over `repeat` runs per mode."""
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="bench-git-") as wrapper_dir:
+        counter = GitCounter.install(wrapper_dir)
+        for mode in MODES:
+            argv = resolver_argv(mode, repo, info["base"], info["changed_files"], budget)
+            runs = [run_once(resolver, argv, counter) for _ in range(repeat)]
+            results[mode] = {
+                "wall_seconds": statistics.median(r["wall_seconds"] for r in runs),
+                "peak_rss_kib": max(r["peak_rss_kib"] for r in runs),
+                "git_processes": runs[-1]["git_processes"],
+            }
+    return results
+
+
+def compare(baseline: dict, current: dict, wall_tolerance: float, rss_tolerance: float) -> list[str]:
+    """Describe regressions of `current` against `baseline`; empty if none.
+
+    Wall time and RSS regress when they exceed the baseline by the given
+    ratio; any increase in git processes is a regression.
+    """
+    if baseline.get("shape") != current["shape"]:
+        return ["baseline was measured on a different shape; regenerate it"]
+    regressions = []
+    for mode, now in current["results"].items():
+        before = baseline["results"].get(mode)
+        if before is None:
+            continue
+        if now["wall_seconds"] > before["wall_seconds"] * wall_tolerance:
+            regressions.append(
+                f"{mode}: wall time {before['wall_seconds']:.3f}s -> {now['wall_seconds']:.3f}s"
+            )
+        if now["peak_rss_kib"] > before["peak_rss_kib"] * rss_tolerance:
+            regressions.append(
+                f"{mode}: peak RSS {before['peak_rss_kib']} KiB -> {now['peak_rss_kib']} KiB"
+            )
+        if (now["git_processes"] or 0) > (before["git_processes"] or 0):
+            regressions.append(
+                f"{mode}: git processes {before['git_processes']} -> {now['git_processes']}"
+            )
+    return regressions
+
+
+def main(argv: Optional[list[str]] = None):
+    defaults = Shape()
+    parser = argparse.ArgumentParser(description="Benchmark resolve-claude-md.py on a synthetic repo.")
+    parser.add_argument("--dir-depth", type=int, default=defaults.dir_depth,
+                        help="Directory nesting depth")
+    parser.add_argument("--fanout", type=int, default=defaults.fanout,
+                        help="Subdirectories per directory")
+    parser.add_argument("--files-per-dir", type=int, default=defaults.files_per_dir,
+                        help="Source files per directory")
+    parser.add_argument("--guidelines", type=int, default=defaults.guidelines,
+                        help="Number of CLAUDE.md files")
+    parser.add_argument("--chains", type=int, default=defaults.chains,
+                        help="Number of shared @ include chains")
+    parser.add_argument("--chain-depth", type=int, default=defaults.chain_depth,
+                        help="Documents per @ chain")
+    parser.add_argument("--fan-in", type=int, default=defaults.fan_in,
+                        help="Guidelines including each chain")
+    parser.add_argument("--doc-bytes", type=int, default=defaults.doc_bytes,
+                        help="Approximate size of each markdown document")
+    parser.add_argument("--fence-ratio", type=float, default=defaults.fence_ratio,
+                        help="Fraction of markdown blocks that are fenced code")
+    parser.add_argument("--changed-files", type=int, default=defaults.changed_files,
+                        help="Files passed to the resolver as changed")
+    parser.add_argument("--budget", type=int, default=defaults.budget,
+                        help="Resolver --budget for every run")
+    parser.add_argument("--large-doc-lines", type=int, default=defaults.large_doc_lines,
+                        help="Lines of the document resolved in large-document mode")
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per mode")
+    parser.add_argument("--resolver", default=RESOLVER_SCRIPT, help="Resolver script to benchmark")
+    parser.add_argument("--output", help="Write results JSON here (default: stdout)")
+    parser.add_argument("--baseline", help="Compare against an earlier results JSON")
+    parser.add_argument("--wall-tolerance", type=float, default=1.25,
+                        help="Allowed wall time ratio over the baseline")
+    parser.add_argument("--rss-tolerance", type=float, default=1.25,
+                        help="Allowed peak RSS ratio over the baseline")
+    parser.add_argument("--keep-repo", help="Generate the repository here and keep it")
+    args = parser.parse_args(argv)
+
+    shape = Shape(
+        dir_depth=args.dir_depth, fanout=args.fanout, files_per_dir=args.files_per_dir,
+        guidelines=args.guidelines, chains=args.chains, chain_depth=args.chain_depth,
+        fan_in=args.fan_in, doc_bytes=args.doc_bytes, fence_ratio=args.fence_ratio,
+        changed_files=args.changed_files, budget=args.budget,
+        large_doc_lines=args.large_doc_lines, seed=args.seed,
+    )
+    work_dir = args.keep_repo or tempfile.mkdtemp(prefix="bench-resolve-claude-md-")
+    try:
+        info = generate_repo(work_dir, shape)
+        results = {
+            "version": BENCH_FORMAT_VERSION,
+            "shape": asdict(shape),
+            "results": measure(args.resolver, work_dir, info, shape.budget, args.repeat),
+        }
+    finally:
+        if not args.keep_repo:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    text = json.dumps(results, indent=2) + "\n"
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.wall_tolerance, args.rss_tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Thin client for the resolve-claude-md.py daemon.
+
+Usage:
+    # Start the daemon once (exits after --idle-timeout seconds without requests):
+    python3 resolve-claude-md.py --serve &
+    # or, to also answer repeated --working-tree queries until a file they read changes:
+    python3 resolve-claude-md.py --serve --watch &
+
+    # Then call the client with the same arguments as resolve-claude-md.py:
+    python3 resolve-claude-md-client.py --git-dir <repo> --merge-base <sha> --files a.go b.go
+
+The client forwards its arguments and working directory to the daemon over
+the per-user Unix socket and prints the daemon's answer, which is the same
+JSON document a standalone run would produce. If no daemon is listening, it
+runs resolve-claude-md.py in-process instead, so callers never need to know
+whether the daemon is up. The same happens if the listener does not belong
+to the current user: its answer ends up in the agent's prompt.
+
+Deliberately imports nothing heavier than the standard socket/json modules:
+the point of the daemon is to skip the resolver's startup work.
+"""
+
+import json
+import os
+import runpy
+import socket
+import struct
+import sys
+import tempfile
+from typing import Optional
+
+RESOLVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resolve-claude-md.py")
+
+
+def default_socket_path() -> str:
+    """Must match default_socket_path() in resolve-claude-md.py."""
+    override = os.environ.get("RESOLVE_CLAUDE_MD_SOCKET")
+    if override:
+        return override
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "resolve-claude-md.sock")
+    return os.path.join(tempfile.gettempdir(), f"resolve-claude-md-{os.getuid()}", "daemon.sock")
+
+
+def owned_by_user(sock: socket.socket, path: str) -> bool:
+    """Whether the process (or, without SO_PEERCRED, the socket file) behind sock is ours."""
+    if hasattr(socket, "SO_PEERCRED"):
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        _pid, uid, _gid = struct.unpack("3i", creds)
+        return uid == os.getuid()
+    return os.lstat(path).st_uid == os.getuid()
+
+
+def query_daemon(argv: list[str]) -> Optional[dict]:
+    """Send one request to the daemon. Returns None if no daemon answered."""
+    request = json.dumps({"argv": argv, "cwd": os.getcwd()}).encode("utf-8") + b"\n"
+    path = default_socket_path()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            if not owned_by_user(sock, path):
+                return None
+            sock.sendall(request)
+            with sock.makefile("rb") as f:
+                line = f.readline()
+        response = json.loads(line)
+        return {
+            "exit_code": int(response["exit_code"]),
+            "stdout": str(response["stdout"]),
+            "stderr": str(response["stderr"]),
+        }
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def main():
+    argv = sys.argv[1:]
+    response = query_daemon(argv)
+    if response is None:
+        # No daemon: run the resolver in this process
+        sys.argv = [RESOLVER_SCRIPT] + argv
+        runpy.run_path(RESOLVER_SCRIPT, run_name="__main__")
+        return
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    sys.exit(response["exit_code"])
+
+
+if __name__ == "__main__":
+    main()
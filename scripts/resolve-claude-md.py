@@ -4,17 +4,40 @@
 Replaces LLM-driven CLAUDE.md probing with a single script invocation.
 Handles discovery, reading, @ directive resolution, budget management,
 and output formatting.
+
+With --serve the script runs as a per-user daemon that keeps git sessions
+and parsed guidelines warm between requests; resolve-claude-md-client.py
+forwards the usual arguments to it and falls back to an in-process run when
+no daemon is listening.
 """
 
 import argparse
+import codecs
+import contextlib
+import ctypes
+import fcntl
+import hashlib
+import io
 import json
+import locale
+import mmap
 import os
 import posixpath
 import re
+import signal
+import socket
+import socketserver
+import stat
+import struct
 import subprocess
 import sys
-from dataclasses import dataclass
-from typing import Optional
+import tempfile
+import time
+import traceback
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Iterable, Iterator, Optional
 
 
 @dataclass
@@ -23,7 +46,7 @@ class Directive:
     directive: str
     resolved_path: str
     exists_at_merge_base: bool
-    status: str  # resolved, truncated, not-found, cycle-skipped, budget-dropped
+    status: str  # resolved, truncated, not-found, cycle-skipped, budget-dropped, deduplicated
     depth: int
 
 
@@ -33,6 +56,80 @@ class Guideline:
     exists_at_merge_base: bool
 
 
+@dataclass
+class SourceSpan:
+    """Where a run of resolved_content came from.
+
+    offset and length count characters of resolved_content; oid is the
+    source's blob OID in merge-base mode (None on disk or for non-blobs);
+    depth is 0 for a guideline and the directive depth for an included
+    target.
+    """
+    offset: int
+    length: int
+    path: str
+    oid: Optional[str]
+    depth: int
+
+
+@dataclass
+class Resolution:
+    """Result of reading guidelines and resolving their @ directives."""
+    resolved_content: str
+    directives: list[Directive]
+    guidelines_loaded_section: str
+    source_map: list[SourceSpan] = field(default_factory=list)
+
+
+# A piece of resolved output: (text, source path or None, depth). Resolution
+# builds lists of these and joins them once, so nested includes are never
+# re-copied into each parent's text.
+Segment = tuple[str, Optional[str], int]
+
+
+@dataclass
+class TargetInfo:
+    """What the planning pass knows about a guideline or directive target before reading it."""
+    oid: Optional[str]  # blob OID in merge-base mode, None for working-tree files
+    obj_type: str  # git object type; "blob" for regular files on disk
+    size: int  # bytes
+    file_id: Optional[tuple[int, int, int]] = None  # (mtime_ns, size, inode) on disk
+
+
+@dataclass
+class SubtreeMemo:
+    """A resolved directive subtree that can be replayed for another parent.
+
+    Only recorded when nothing in the subtree was truncated or
+    budget-dropped. Replaying is valid while the caller can afford `cost`
+    with the same per-directive budget checks passing (`min_budget`), and
+    the caller's include chain hits the same cycle edges (`chain_hits`).
+    """
+    segments: list
+    directives: list[Directive]
+    cost: int
+    min_budget: int
+    touched: frozenset
+    chain_hits: frozenset
+
+
+@dataclass
+class Metrics:
+    """Instrumentation for --timings; only collected when the flag is set.
+
+    Step times are laps: each call to lap() charges the time since the
+    previous one to the named step.
+    """
+    step_seconds: dict = field(default_factory=dict)
+    budget_by_guideline: dict = field(default_factory=dict)
+    _last: float = field(default_factory=time.perf_counter, repr=False)
+
+    def lap(self, step: str) -> None:
+        now = time.perf_counter()
+        self.step_seconds[step] = self.step_seconds.get(step, 0.0) + (now - self._last)
+        self._last = now
+
+
 @dataclass
 class ResolveContext:
     git_dir: str
@@ -41,34 +138,968 @@ class ResolveContext:
     depth_limit: int
     budget: int
     budget_remaining: int = 0
+    budget_unit: str = "chars"  # one of BUDGET_UNITS
+    dedupe_includes: bool = False
+    prefetch_workers: int = 0  # 0: read each target only when resolution reaches it
+    git: Optional["GitSession"] = field(default=None, repr=False)
+    # Per-run directive graph: each node is planned, read, parsed and resolved once
+    target_infos: dict = field(default_factory=dict, repr=False)
+    read_cache: dict = field(default_factory=dict, repr=False)
+    partial_reads: set = field(default_factory=set, repr=False)
+    prefetched: dict = field(default_factory=dict, repr=False)  # path -> (read cap, text)
+    # --dedupe-includes: content key -> path of its first full copy in the output
+    included_blocks: dict = field(default_factory=dict, repr=False)
+    included_sizes: set = field(default_factory=set, repr=False)
+    directive_scans: dict = field(default_factory=dict, repr=False)
+    subtree_memo: dict = field(default_factory=dict, repr=False)
+    # Content-keyed caches that stay valid across runs (see RepoState)
+    blob_texts: dict = field(default_factory=dict, repr=False)
+    token_counts: dict = field(default_factory=dict, repr=False)
+    # --blob-cache: blob texts by OID, shared with concurrent runs on disk
+    blob_cache: Optional["DiskCache"] = field(default=None, repr=False)
+    # --cache-dir: token counts, and working-tree file texts
+    content_cache: Optional["DiskCache"] = field(default=None, repr=False)
+    metrics: Optional[Metrics] = field(default=None, repr=False)
+    # Working-tree mode: directory listings
+    listings: Optional["DirectoryListings"] = field(default=None, repr=False)
+
+    def __post_init__(self):
+        if self.git is None:
+            self.git = GitSession(self.git_dir)
+        if self.working_tree and self.listings is None:
+            self.listings = DirectoryListings(self.git_dir)
+
+
+BATCH_CHECK_CHUNK = 256
+# Pathspec matching every CLAUDE.md (git's `*` also matches `/`)
+GUIDELINE_PATHSPEC = "*CLAUDE.md"
+# The empty tree, by object ID length (SHA-1, SHA-256); git knows it without storing it
+EMPTY_TREE_OIDS = {
+    40: "4b825dc642cb6eb9a060e54bf8d69288fbee4904",
+    64: "6ef19b41225c5369f1c104d45d8d85efa9b057b53b14b4b9b939dd74decc5321",
+}
+# Bytes per read when streaming NUL-delimited git output
+STREAM_CHUNK = 64 * 1024
+# Upper bound on encoded bytes per decoded character (UTF-8; a CRLF pair
+# decodes to one character, which is within the bound too)
+MAX_BYTES_PER_CHAR = 4
+
+
+class UnsupportedObjectAccess(Exception):
+    """An object lookup ObjectDatabase leaves to git itself."""
+
+
+OBJECT_TYPES = {1: "commit", 2: "tree", 3: "blob", 4: "tag"}
+OFS_DELTA = 6
+REF_DELTA = 7
+# Repository format extensions ObjectDatabase understands; any other one
+# (reftable ref storage, partial clone, ...) means git must do the reads
+SUPPORTED_EXTENSIONS = {"objectformat", "worktreeconfig"}
+# Refs that live in a worktree's own git dir rather than the common dir
+PER_WORKTREE_REF_PREFIXES = ("refs/bisect/", "refs/worktree/", "refs/rewritten/")
+# git's ref name disambiguation order (see `git help revisions`)
+REF_RULES = ["refs/{}", "refs/tags/{}", "refs/heads/{}", "refs/remotes/{}", "refs/remotes/{}/HEAD"]
+SAFE_REF_RE = re.compile(r"^[A-Za-z0-9._/-]+$")
+HEX_RE = re.compile(r"^[0-9a-f]+$")
+SYMREF_MAX_DEPTH = 5
+
+
+def _read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    """Decode a delta header size (little-endian base-128); returns (value, next pos)."""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    """Rebuild an object from its delta base and a git pack delta."""
+    base_size, pos = _read_varint(delta, 0)
+    result_size, pos = _read_varint(delta, pos)
+    if base_size != len(base):
+        raise UnsupportedObjectAccess("delta base size mismatch")
+    out = bytearray()
+    while pos < len(delta):
+        cmd = delta[pos]
+        pos += 1
+        if cmd & 0x80:
+            # Copy from base: offset and size bytes present per flag bit
+            offset = 0
+            for i in range(4):
+                if cmd & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            size = 0
+            for i in range(3):
+                if cmd & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            out += base[offset:offset + (size or 0x10000)]
+        elif cmd:
+            out += delta[pos:pos + cmd]
+            pos += cmd
+        else:
+            raise UnsupportedObjectAccess("reserved delta opcode")
+    if len(out) != result_size:
+        raise UnsupportedObjectAccess("delta result size mismatch")
+    return bytes(out)
 
 
-def run_git(git_dir: str, *args: str) -> subprocess.CompletedProcess:
-    """Run a git command in the specified directory."""
-    cmd = ["git", "-C", git_dir] + list(args)
-    return subprocess.run(cmd, capture_output=True, text=True)
+def inflate(read, size: int, limit: Optional[int] = None) -> bytes:
+    """Inflate a zlib stream whose output is `size` bytes, stopping after `limit`.
 
+    `read(n)` returns the next compressed bytes (empty at the end).
+    """
+    want = size if limit is None else min(size, limit)
+    decompressor = zlib.decompressobj()
+    out = bytearray()
+    while len(out) < want and not decompressor.eof:
+        data = decompressor.unconsumed_tail or read(STREAM_CHUNK)
+        if not data:
+            raise UnsupportedObjectAccess("truncated zlib stream")
+        out += decompressor.decompress(data, want - len(out))
+    if len(out) < want:
+        raise UnsupportedObjectAccess("short zlib stream")
+    return bytes(out)
+
+
+class PackFile:
+    """One `.idx` (version 2) and `.pack` pair, both memory-mapped."""
+
+    def __init__(self, idx_path: str, hash_len: int):
+        self.hash_len = hash_len
+        with open(idx_path, "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.idx[:8] != b"\xfftOc\x00\x00\x00\x02":
+            raise UnsupportedObjectAccess(f"unsupported pack index {idx_path}")
+        self.fanout = struct.unpack_from(">256I", self.idx, 8)
+        self.count = self.fanout[255]
+        self.oids_at = 8 + 256 * 4
+        self.offsets_at = self.oids_at + self.count * hash_len + self.count * 4  # skip CRCs
+        self.large_offsets_at = self.offsets_at + self.count * 4
+        with open(idx_path[:-len(".idx")] + ".pack", "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.pack[:4] != b"PACK" or struct.unpack_from(">I", self.pack, 4)[0] not in (2, 3):
+            raise UnsupportedObjectAccess(f"unsupported pack for {idx_path}")
+
+    def find(self, oid: bytes) -> Optional[int]:
+        """Pack offset of an object, by binary search within its fanout bucket."""
+        lo = self.fanout[oid[0] - 1] if oid[0] else 0
+        hi = self.fanout[oid[0]]
+        hash_len = self.hash_len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            at = self.oids_at + mid * hash_len
+            probe = self.idx[at:at + hash_len]
+            if probe < oid:
+                lo = mid + 1
+            elif probe > oid:
+                hi = mid
+            else:
+                offset = struct.unpack_from(">I", self.idx, self.offsets_at + mid * 4)[0]
+                if offset & 0x80000000:
+                    large = self.large_offsets_at + (offset & 0x7FFFFFFF) * 8
+                    offset = struct.unpack_from(">Q", self.idx, large)[0]
+                return offset
+        return None
+
+    def entry_header(self, offset: int) -> tuple[int, int, int]:
+        """(type number, inflated size, data position) of the entry at offset."""
+        byte = self.pack[offset]
+        pos = offset + 1
+        obj_type = (byte >> 4) & 7
+        size = byte & 0x0F
+        shift = 4
+        while byte & 0x80:
+            byte = self.pack[pos]
+            pos += 1
+            size |= (byte & 0x7F) << shift
+            shift += 7
+        return obj_type, size, pos
+
+    def ofs_delta_base(self, offset: int, pos: int) -> tuple[int, int]:
+        """Decode an OFS_DELTA base distance; returns (base offset, data position)."""
+        byte = self.pack[pos]
+        pos += 1
+        distance = byte & 0x7F
+        while byte & 0x80:
+            byte = self.pack[pos]
+            pos += 1
+            distance = ((distance + 1) << 7) | (byte & 0x7F)
+        return offset - distance, pos
+
+    def reader(self, pos: int):
+        """A read(n) function over the pack starting at pos, for inflate()."""
+        def read(n: int) -> bytes:
+            nonlocal pos
+            data = self.pack[pos:pos + n]
+            pos += len(data)
+            return data
+        return read
+
+    def close(self) -> None:
+        self.idx.close()
+        self.pack.close()
+
+
+class ObjectDatabase:
+    """Read-only, in-process access to a repository's refs and objects.
+
+    Understands what `git cat-file --batch` needs for this resolver:
+    `<rev>`, `<rev>^{tree}` and `<rev>:<path>` specs where <rev> is a full
+    object ID or a ref name, loose objects, and version 2 pack indexes with
+    OFS/REF delta chains. Anything else (abbreviated IDs, revision
+    expressions, objects it cannot find) raises UnsupportedObjectAccess so
+    the caller can ask git. open() returns None for repositories it should
+    not read at all: reftable or other repository extensions, alternates,
+    replace refs, GIT_DIR-style environment overrides, or a git dir owned
+    by another user (git's safe.directory check).
+    """
+
+    def __init__(self, git_dir: str, common_dir: str, hash_len: int):
+        self.git_dir = git_dir
+        self.common_dir = common_dir
+        self.hash_len = hash_len
+        self.objects_dir = os.path.join(common_dir, "objects")
+        self.packs: dict[str, PackFile] = {}
+        self._packed_refs: Optional[tuple[tuple, dict[str, str]]] = None
+        self._trees: dict = BoundedDict(1024)
+        self._delta_bases: dict = BoundedDict(64)
+        self._scan_packs()
+
+    @classmethod
+    def open(cls, work_dir: str) -> Optional["ObjectDatabase"]:
+        for var in ("GIT_DIR", "GIT_COMMON_DIR", "GIT_OBJECT_DIRECTORY",
+                    "GIT_ALTERNATE_OBJECT_DIRECTORIES", "GIT_NAMESPACE", "GIT_CEILING_DIRECTORIES"):
+            if os.environ.get(var):
+                return None
+        git_dir = cls._find_git_dir(work_dir)
+        if git_dir is None:
+            return None
+        try:
+            if os.stat(git_dir).st_uid != os.getuid():
+                return None
+            common_dir = git_dir
+            commondir_file = os.path.join(git_dir, "commondir")
+            if os.path.exists(commondir_file):
+                with open(commondir_file, "r") as f:
+                    common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+            hash_len = cls._hash_len_from_config(os.path.join(common_dir, "config"))
+            if hash_len is None:
+                return None
+            if (
+                os.path.exists(os.path.join(common_dir, "reftable"))
+                or os.path.exists(os.path.join(common_dir, "objects", "info", "alternates"))
+                or os.path.exists(os.path.join(common_dir, "refs", "replace"))
+            ):
+                return None
+            odb = cls(git_dir, common_dir, hash_len)
+            if any(name.startswith("refs/replace/") for name in odb._load_packed_refs()):
+                return None
+            return odb
+        except (OSError, ValueError, UnsupportedObjectAccess):
+            return None
+
+    @staticmethod
+    def _find_git_dir(work_dir: str) -> Optional[str]:
+        """Locate the git dir the way `git -C work_dir` would (without ceiling dirs)."""
+        d = os.path.abspath(work_dir)
+        while True:
+            dotgit = os.path.join(d, ".git")
+            if os.path.isdir(dotgit):
+                return dotgit
+            if os.path.isfile(dotgit):
+                with open(dotgit, "r") as f:
+                    line = f.readline().strip()
+                if not line.startswith("gitdir: "):
+                    return None
+                return os.path.normpath(os.path.join(d, line[len("gitdir: "):]))
+            if all(os.path.exists(os.path.join(d, name)) for name in ("HEAD", "objects", "refs")):
+                return d  # bare repository
+            parent = os.path.dirname(d)
+            if parent == d:
+                return None
+            d = parent
+
+    @staticmethod
+    def _hash_len_from_config(config_path: str) -> Optional[int]:
+        """Object ID length in bytes, or None if the config needs features we lack."""
+        hash_len = 20
+        section = ""
+        with open(config_path, "r", errors="replace") as f:
+            for raw in f:
+                line = raw.strip()
+                if not line or line[0] in "#;":
+                    continue
+                if line.startswith("["):
+                    section = line[1:line.index("]")].strip().lower().split(" ")[0]
+                    if section in ("include", "includeif"):
+                        return None  # extensions could come from elsewhere
+                    continue
+                key, _, value = line.partition("=")
+                key = key.strip().lower()
+                value = value.strip().strip('"').lower()
+                if section == "core" and key == "repositoryformatversion" and value not in ("0", "1"):
+                    return None
+                if section == "extensions":
+                    if key not in SUPPORTED_EXTENSIONS:
+                        return None
+                    if key == "objectformat":
+                        if value == "sha256":
+                            hash_len = 32
+                        elif value != "sha1":
+                            return None
+        return hash_len
+
+    # --- Refs ---
+
+    def _load_packed_refs(self) -> dict[str, str]:
+        path = os.path.join(self.common_dir, "packed-refs")
+        try:
+            st = os.stat(path)
+        except OSError:
+            return {}
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if self._packed_refs is None or self._packed_refs[0] != stamp:
+            refs = {}
+            with open(path, "r", errors="surrogateescape") as f:
+                for line in f:
+                    if line.startswith(("#", "^")):
+                        continue
+                    oid, _, name = line.rstrip("\n").partition(" ")
+                    refs[name] = oid
+            self._packed_refs = (stamp, refs)
+        return self._packed_refs[1]
+
+    def _read_ref(self, name: str, depth: int = 0) -> Optional[str]:
+        """Hex object ID a ref points to (following symbolic refs), or None."""
+        if depth > SYMREF_MAX_DEPTH:
+            raise UnsupportedObjectAccess(f"symbolic ref loop at {name}")
+        per_worktree = name == "HEAD" or name.startswith(PER_WORKTREE_REF_PREFIXES)
+        base = self.git_dir if per_worktree else self.common_dir
+        try:
+            with open(os.path.join(base, name), "r") as f:
+                value = f.read().strip()
+        except IsADirectoryError:
+            return None
+        except OSError:
+            return self._load_packed_refs().get(name)
+        if value.startswith("ref: "):
+            return self._read_ref(value[len("ref: "):], depth + 1)
+        if len(value) == self.hash_len * 2 and HEX_RE.match(value):
+            return value
+        raise UnsupportedObjectAccess(f"unreadable ref {name}")
+
+    def resolve_rev(self, rev: str) -> bytes:
+        """Object ID for a full hex ID or a ref name, in git's lookup order."""
+        if len(rev) == self.hash_len * 2 and HEX_RE.match(rev):
+            return bytes.fromhex(rev)
+        if (
+            not SAFE_REF_RE.match(rev) or ".." in rev or rev.endswith((".lock", "/", "."))
+            or rev.startswith(("/", "-")) or "//" in rev
+        ):
+            raise UnsupportedObjectAccess(f"revision syntax {rev!r}")
+        names = [rule.format(rev) for rule in REF_RULES]
+        if rev == "HEAD" or rev.startswith("refs/"):
+            names.insert(0, rev)
+        elif rev.isupper():
+            raise UnsupportedObjectAccess(f"pseudo-ref {rev}")  # FETCH_HEAD etc.
+        for name in names:
+            oid = self._read_ref(name)
+            if oid is not None:
+                return bytes.fromhex(oid)
+        raise UnsupportedObjectAccess(f"no ref named {rev}")  # maybe an abbreviated ID
+
+    # --- Objects ---
+
+    def _scan_packs(self) -> bool:
+        """Map packs not seen yet; True if any were added."""
+        pack_dir = os.path.join(self.objects_dir, "pack")
+        try:
+            names = os.listdir(pack_dir)
+        except OSError:
+            return False
+        added = False
+        for name in sorted(names):
+            if name.endswith(".idx") and name not in self.packs:
+                self.packs[name] = PackFile(os.path.join(pack_dir, name), self.hash_len)
+                added = True
+        return added
+
+    def _find_packed(self, oid: bytes) -> Optional[tuple[PackFile, int]]:
+        for attempt in range(2):
+            for pack in self.packs.values():
+                offset = pack.find(oid)
+                if offset is not None:
+                    return pack, offset
+            if attempt or not self._scan_packs():
+                return None
+        return None
+
+    def _loose_path(self, oid: bytes) -> str:
+        hex_oid = oid.hex()
+        return os.path.join(self.objects_dir, hex_oid[:2], hex_oid[2:])
+
+    def _read_loose(self, oid: bytes, limit: Optional[int]) -> Optional[tuple[str, int, bytes]]:
+        """(type, size, content or its first `limit` bytes) of a loose object."""
+        try:
+            f = open(self._loose_path(oid), "rb")
+        except OSError:
+            return None
+        with f:
+            decompressor = zlib.decompressobj()
+            header = b""
+            while b"\0" not in header:
+                data = f.read(256)
+                if not data:
+                    raise UnsupportedObjectAccess("corrupt loose object")
+                header += decompressor.decompress(data)
+            header, _, rest = header.partition(b"\0")
+            obj_type, _, size = header.decode("ascii").partition(" ")
+            size = int(size)
+            if limit is not None and limit <= len(rest):
+                return obj_type, size, rest[:limit]
+
+            def read(n: int) -> bytes:
+                return decompressor.unconsumed_tail or f.read(n)
+
+            want = size if limit is None else min(size, limit)
+            out = bytearray(rest)
+            while len(out) < want and not decompressor.eof:
+                data = read(STREAM_CHUNK)
+                if not data:
+                    raise UnsupportedObjectAccess("truncated loose object")
+                out += decompressor.decompress(data, want - len(out))
+            return obj_type, size, bytes(out[:want])
+
+    def _packed_info(self, pack: PackFile, offset: int) -> tuple[str, int]:
+        """(type, size) of a packed object, reading only headers along its delta chain."""
+        obj_type, size, pos = pack.entry_header(offset)
+        if obj_type in OBJECT_TYPES:
+            return OBJECT_TYPES[obj_type], size
+        if obj_type == OFS_DELTA:
+            base_offset, pos = pack.ofs_delta_base(offset, pos)
+            base_type = self._packed_info(pack, base_offset)[0]
+        elif obj_type == REF_DELTA:
+            base_oid = pack.pack[pos:pos + self.hash_len]
+            pos += self.hash_len
+            base_type = self._info_by_oid(base_oid)[0]
+        else:
+            raise UnsupportedObjectAccess(f"pack entry type {obj_type}")
+        # The delta header carries the result size
+        header = inflate(pack.reader(pos), size, 32)
+        _base_size, at = _read_varint(header, 0)
+        return base_type, _read_varint(header, at)[0]
+
+    def _read_packed(self, pack: PackFile, offset: int) -> tuple[str, bytes]:
+        """Read a packed object, applying its delta chain from the base up."""
+        chain = []
+        while True:
+            cached = self._delta_bases.get((id(pack), offset))
+            if cached is not None:
+                obj_type, data = cached
+                break
+            entry_type, size, pos = pack.entry_header(offset)
+            if entry_type in OBJECT_TYPES:
+                obj_type = OBJECT_TYPES[entry_type]
+                data = inflate(pack.reader(pos), size)
+                break
+            if entry_type == OFS_DELTA:
+                base_offset, pos = pack.ofs_delta_base(offset, pos)
+                chain.append((offset, inflate(pack.reader(pos), size)))
+                offset = base_offset
+            elif entry_type == REF_DELTA:
+                base_oid = pack.pack[pos:pos + self.hash_len]
+                chain.append((offset, inflate(pack.reader(pos + self.hash_len), size)))
+                obj_type, data = self._read_by_oid(base_oid)
+                break
+            else:
+                raise UnsupportedObjectAccess(f"pack entry type {entry_type}")
+        for delta_offset, delta in reversed(chain):
+            data = apply_delta(data, delta)
+            self._delta_bases[(id(pack), delta_offset)] = (obj_type, data)
+        return obj_type, data
+
+    def _info_by_oid(self, oid: bytes) -> tuple[str, int]:
+        found = self._find_packed(oid)
+        if found is not None:
+            return self._packed_info(*found)
+        loose = self._read_loose(oid, 0)
+        if loose is None:
+            raise UnsupportedObjectAccess(f"object {oid.hex()} not found")  # maybe promisor
+        return loose[0], loose[1]
+
+    def _read_by_oid(self, oid: bytes, limit: Optional[int] = None) -> tuple[str, bytes]:
+        found = self._find_packed(oid)
+        if found is not None:
+            pack, offset = found
+            entry_type, size, pos = pack.entry_header(offset)
+            if limit is not None and entry_type in OBJECT_TYPES:
+                return OBJECT_TYPES[entry_type], inflate(pack.reader(pos), size, limit)
+            return self._read_packed(pack, offset)
+        loose = self._read_loose(oid, limit)
+        if loose is None:
+            raise UnsupportedObjectAccess(f"object {oid.hex()} not found")
+        return loose[0], loose[2]
+
+    def _peel_to_tree(self, oid: bytes) -> bytes:
+        for _ in range(SYMREF_MAX_DEPTH * 4):
+            obj_type, data = self._read_by_oid(oid)
+            if obj_type == "tree":
+                return oid
+            if obj_type == "commit" and data.startswith(b"tree "):
+                oid = bytes.fromhex(data[5:5 + self.hash_len * 2].decode("ascii"))
+            elif obj_type == "tag" and data.startswith(b"object "):
+                oid = bytes.fromhex(data[7:7 + self.hash_len * 2].decode("ascii"))
+            else:
+                raise UnsupportedObjectAccess(f"cannot peel {obj_type} to a tree")
+        raise UnsupportedObjectAccess("tag chain too long")
+
+    def _tree_entries(self, oid: bytes) -> dict[bytes, tuple[bytes, bytes]]:
+        entries = self._trees.get(oid)
+        if entries is None:
+            obj_type, data = self._read_by_oid(oid)
+            if obj_type != "tree":
+                raise UnsupportedObjectAccess("not a tree")
+            entries = {}
+            pos = 0
+            while pos < len(data):
+                space = data.index(b" ", pos)
+                nul = data.index(b"\0", space)
+                entries[data[space + 1:nul]] = (data[pos:space], data[nul + 1:nul + 1 + self.hash_len])
+                pos = nul + 1 + self.hash_len
+            self._trees[oid] = entries
+        return entries
+
+    def resolve_spec(self, spec: str) -> Optional[bytes]:
+        """Object ID named by `<rev>`, `<rev>^{tree}` or `<rev>:<path>`; None if the path is absent."""
+        rev, colon, path = spec.partition(":")
+        if not colon:
+            if rev.endswith("^{tree}"):
+                return self._peel_to_tree(self.resolve_rev(rev[:-len("^{tree}")]))
+            return self.resolve_rev(rev)
+        if not rev or path.startswith(("./", "../")) or path in (".", ".."):
+            raise UnsupportedObjectAccess(f"path syntax {spec!r}")
+        oid = self._peel_to_tree(self.resolve_rev(rev))
+        if not path:
+            return oid
+        components = path.split("/")
+        if "" in components:
+            raise UnsupportedObjectAccess(f"path syntax {spec!r}")
+        for i, name in enumerate(components):
+            entry = self._tree_entries(oid).get(name.encode("utf-8", "surrogateescape"))
+            if entry is None:
+                return None
+            mode, oid = entry
+            if i + 1 < len(components) and mode != b"40000":
+                return None  # a blob or submodule has no children
+        return oid
+
+    def info(self, spec: str) -> Optional[tuple[str, str, int]]:
+        """Like a `cat-file --batch-check` line: (OID, type, size), or None if missing."""
+        oid = self.resolve_spec(spec)
+        if oid is None:
+            return None
+        obj_type, size = self._info_by_oid(oid)
+        return oid.hex(), obj_type, size
+
+    def read(self, spec: str, limit: Optional[int] = None) -> Optional[tuple[str, int, bytes]]:
+        """(type, size, content) for a spec; with limit, blob content is cut to `limit` bytes."""
+        oid = self.resolve_spec(spec)
+        if oid is None:
+            return None
+        obj_type, size = self._info_by_oid(oid)
+        if obj_type != "blob":
+            limit = None
+        obj_type, data = self._read_by_oid(oid, limit)
+        return obj_type, size, data if limit is None else data[:limit]
+
+    def close(self) -> None:
+        for pack in self.packs.values():
+            pack.close()
+        self.packs.clear()
+
+
+class GitSession:
+    """Object access for one repository through long-lived git processes.
+
+    Existence checks are answered by a single `git cat-file --batch-check`
+    process and content reads by a single `git cat-file --batch` process.
+    Both are started on first use and reused for every lookup in the run,
+    so per-path probing costs a pipe round trip instead of a process spawn.
+    `processes_spawned` counts every git process the session started and
+    `bytes_read` every byte of git output consumed.
+
+    With object_backend="python", object lookups and reads are first tried
+    in-process through an ObjectDatabase; anything it does not support
+    falls back to the cat-file processes. Commands run through run() and
+    iter_z() always use git.
+    """
+
+    def __init__(self, git_dir: str, object_backend: str = "subprocess"):
+        self.git_dir = git_dir
+        self.object_backend = object_backend
+        self.processes_spawned = 0
+        self.bytes_read = 0
+        self._check_proc: Optional[subprocess.Popen] = None
+        self._batch_proc: Optional[subprocess.Popen] = None
+        self._odb: Optional[ObjectDatabase] = None
+        self._odb_opened = False
+
+    def _object_db(self) -> Optional[ObjectDatabase]:
+        """The in-process object reader, if selected and usable for this repository."""
+        if self.object_backend != "python":
+            return None
+        if not self._odb_opened:
+            self._odb_opened = True
+            self._odb = ObjectDatabase.open(self.git_dir)
+        return self._odb
+
+    def _popen(self, *args: str) -> subprocess.Popen:
+        self.processes_spawned += 1
+        return subprocess.Popen(
+            ["git", "-C", self.git_dir] + list(args),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def run(self, *args: str) -> subprocess.CompletedProcess:
+        """Run a one-shot git command in the session's directory."""
+        self.processes_spawned += 1
+        cmd = ["git", "-C", self.git_dir] + list(args)
+        result = subprocess.run(cmd, capture_output=True)
+        self.bytes_read += len(result.stdout)
+        return subprocess.CompletedProcess(
+            result.args, result.returncode,
+            decode_git_text(result.stdout), decode_git_text(result.stderr),
+        )
+
+    def iter_z(self, *args: str):
+        """Run a git command and yield its NUL-terminated records as they arrive.
+
+        Output is read in fixed-size chunks and never held in full, so the
+        caller decides what to keep. Raises subprocess.CalledProcessError
+        (with git's stderr) once the stream ends if git failed.
+        """
+        self.processes_spawned += 1
+        cmd = ["git", "-C", self.git_dir] + list(args)
+        with subprocess.Popen(
+            cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        ) as proc:
+            pending = b""
+            while True:
+                chunk = proc.stdout.read(STREAM_CHUNK)
+                if not chunk:
+                    break
+                self.bytes_read += len(chunk)
+                *records, pending = (pending + chunk).split(b"\0")
+                for record in records:
+                    yield record.decode("utf-8", "surrogateescape")
+            stderr = proc.stderr.read().decode("utf-8", "replace")
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr)
+
+    @staticmethod
+    def _send(proc: Optional[subprocess.Popen], specs: list[str]) -> bool:
+        """Write object specs to a cat-file batch process. False if it is unusable."""
+        if proc is None:
+            return False
+        try:
+            proc.stdin.write(b"".join(
+                spec.encode("utf-8", "surrogateescape") + b"\n" for spec in specs
+            ))
+            proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            return False
+        return True
+
+    def _read_header(self, proc: subprocess.Popen) -> Optional[list[str]]:
+        """Read one response header; None when the object is missing or git went away."""
+        header = proc.stdout.readline()
+        if not header:
+            return None
+        self.bytes_read += len(header)
+        header = header.rstrip(b"\n").decode("utf-8", "surrogateescape")
+        if header.endswith((" missing", " ambiguous")):
+            return None
+        fields = header.split(" ")
+        if len(fields) != 3:
+            return None
+        return fields
+
+    def _request(self, proc: Optional[subprocess.Popen], spec: str) -> Optional[list[str]]:
+        """Send one object spec to a cat-file batch process, return its header fields.
+
+        Returns None when the object is missing or the process is unusable
+        (e.g. git_dir is not a repository), mirroring `cat-file -e` failing.
+        """
+        if "\n" in spec or not self._send(proc, [spec]):
+            return None
+        return self._read_header(proc)
+
+    def _check(self) -> subprocess.Popen:
+        if self._check_proc is None:
+            self._check_proc = self._popen("cat-file", "--batch-check")
+        return self._check_proc
+
+    def object_info(self, spec: str) -> Optional[tuple[str, str, int]]:
+        """Look up (OID, type, size) for an object spec without reading it."""
+        odb = self._object_db()
+        if odb is not None:
+            try:
+                return odb.info(spec)
+            except UnsupportedObjectAccess:
+                pass
+        fields = self._request(self._check(), spec)
+        if fields is None:
+            return None
+        return fields[0], fields[1], int(fields[2])
+
+    def object_infos(self, specs: list[str]) -> list[Optional[tuple[str, str, int]]]:
+        """Look up many object specs with pipelined batch-check round trips.
+
+        Specs are written in chunks so git's response pipe can never fill up
+        while we are still writing requests.
+        """
+        results: list[Optional[tuple[str, str, int]]] = [None] * len(specs)
+        pending = range(len(specs))
+        odb = self._object_db()
+        if odb is not None:
+            unsupported = []
+            for i in pending:
+                try:
+                    results[i] = odb.info(specs[i])
+                except UnsupportedObjectAccess:
+                    unsupported.append(i)
+            pending = unsupported
+        sendable = [i for i in pending if "\n" not in specs[i]]
+        proc = self._check() if sendable else None
+        for start in range(0, len(sendable), BATCH_CHECK_CHUNK):
+            chunk = sendable[start:start + BATCH_CHECK_CHUNK]
+            if not self._send(proc, [specs[i] for i in chunk]):
+                break
+            for i in chunk:
+                fields = self._read_header(proc)
+                if fields is not None:
+                    results[i] = (fields[0], fields[1], int(fields[2]))
+        return results
+
+    def object_exists(self, spec: str) -> bool:
+        """Check whether `<rev>:<path>` names an object, like `cat-file -e`."""
+        return self.object_info(spec) is not None
+
+    def read_object(self, spec: str) -> Optional[tuple[str, bytes]]:
+        """Read `<rev>:<path>`, returning (object type, raw content) or None."""
+        odb = self._object_db()
+        if odb is not None:
+            try:
+                obj = odb.read(spec)
+            except UnsupportedObjectAccess:
+                pass
+            else:
+                if obj is None:
+                    return None
+                self.bytes_read += len(obj[2])
+                return obj[0], obj[2]
+        if self._batch_proc is None:
+            self._batch_proc = self._popen("cat-file", "--batch")
+        fields = self._request(self._batch_proc, spec)
+        if fields is None:
+            return None
+        size = int(fields[2])
+        data = self._batch_proc.stdout.read(size + 1)  # content + trailing LF
+        self.bytes_read += len(data)
+        return fields[1], data[:size]
+
+    def read_text(
+        self, spec: str, max_chars: Optional[int] = None
+    ) -> Optional[tuple[str, Optional[str]]]:
+        """Read `<rev>:<path>` as (object type, decoded text), or None if missing.
+
+        Blob content is decoded like decode_git_text(). With max_chars, at
+        most max_chars + 1 characters are kept, so a caller can still tell
+        the blob is longer: the pipe is decoded a chunk at a time and the
+        rest of the object is drained without being stored, bounding memory
+        by max_chars rather than by blob size. Non-blob content is drained
+        and returned as None.
+        """
+        if max_chars is None:
+            obj = self.read_object(spec)
+            if obj is None:
+                return None
+            return obj[0], decode_git_text(obj[1]) if obj[0] == "blob" else None
+        odb = self._object_db()
+        if odb is not None:
+            try:
+                obj = odb.read(spec, (max_chars + 1) * MAX_BYTES_PER_CHAR)
+            except UnsupportedObjectAccess:
+                pass
+            else:
+                if obj is None:
+                    return None
+                obj_type, size, data = obj
+                self.bytes_read += len(data)
+                if obj_type != "blob":
+                    return obj_type, None
+                if len(data) == size:
+                    return obj_type, decode_git_text(data)[:max_chars + 1]
+                decoder = io.IncrementalNewlineDecoder(
+                    codecs.getincrementaldecoder(locale.getpreferredencoding(False))(),
+                    translate=True,
+                )
+                return obj_type, decoder.decode(data)[:max_chars + 1]
+        if self._batch_proc is None:
+            self._batch_proc = self._popen("cat-file", "--batch")
+        fields = self._request(self._batch_proc, spec)
+        if fields is None:
+            return None
+        return self._read_text_body(fields, max_chars)
+
+    def read_texts(
+        self, requests: list[tuple[str, Optional[int]]]
+    ) -> list[Optional[tuple[str, Optional[str]]]]:
+        """read_text() for many (spec, max_chars) pairs with pipelined round trips.
+
+        Specs go to the `cat-file --batch` pipe in chunks and the responses
+        are read back in order, so n reads cost one round trip per chunk
+        instead of n. Chunks are small enough that git can never block on a
+        full response pipe while we are still writing requests.
+        """
+        results: list[Optional[tuple[str, Optional[str]]]] = [None] * len(requests)
+        if self._object_db() is not None:
+            # In-process reads have no round trip to save
+            return [self.read_text(spec, max_chars) for spec, max_chars in requests]
+        sendable = [i for i, (spec, _) in enumerate(requests) if "\n" not in spec]
+        if sendable and self._batch_proc is None:
+            self._batch_proc = self._popen("cat-file", "--batch")
+        for start in range(0, len(sendable), BATCH_CHECK_CHUNK):
+            chunk = sendable[start:start + BATCH_CHECK_CHUNK]
+            if not self._send(self._batch_proc, [requests[i][0] for i in chunk]):
+                break
+            for i in chunk:
+                fields = self._read_header(self._batch_proc)
+                if fields is not None:
+                    results[i] = self._read_text_body(fields, requests[i][1])
+        return results
+
+    def _read_text_body(
+        self, fields: list[str], max_chars: Optional[int]
+    ) -> Optional[tuple[str, Optional[str]]]:
+        """Consume one `cat-file --batch` object body after its header (see read_text)."""
+        stdout = self._batch_proc.stdout
+        obj_type = fields[1]
+        content_left = int(fields[2])
+        if max_chars is None:
+            data = stdout.read(content_left + 1)
+            self.bytes_read += len(data)
+            if len(data) != content_left + 1:
+                return None  # git went away mid-object
+            return obj_type, decode_git_text(data[:-1]) if obj_type == "blob" else None
+        parts = []
+        kept = 0
+        try:
+            if obj_type == "blob":
+                decoder = io.IncrementalNewlineDecoder(
+                    codecs.getincrementaldecoder(locale.getpreferredencoding(False))(),
+                    translate=True,
+                )
+                while content_left and kept <= max_chars:
+                    chunk = stdout.read(min(STREAM_CHUNK, content_left))
+                    if not chunk:
+                        return None  # git went away mid-object
+                    content_left -= len(chunk)
+                    self.bytes_read += len(chunk)
+                    text = decoder.decode(chunk, final=not content_left)
+                    parts.append(text)
+                    kept += len(text)
+        finally:
+            # Drain what we don't keep, plus the trailing LF, also when
+            # decoding failed, so the pipe stays in step with the next request
+            left = content_left + 1
+            while left:
+                chunk = stdout.read(min(STREAM_CHUNK, left))
+                if not chunk:
+                    break
+                left -= len(chunk)
+                self.bytes_read += len(chunk)
+        if obj_type != "blob":
+            return obj_type, None
+        return obj_type, "".join(parts)[:max_chars + 1]
+
+    def close(self) -> None:
+        """Shut down the batch processes.
+
+        Their stdout is closed too: after a failed read git may still be
+        blocked writing output nobody will read, and would never exit.
+        """
+        for proc in (self._check_proc, self._batch_proc):
+            if proc is None:
+                continue
+            for pipe in (proc.stdin, proc.stdout):
+                try:
+                    pipe.close()
+                except OSError:
+                    pass
+            proc.wait()
+        self._check_proc = None
+        self._batch_proc = None
+        if self._odb is not None:
+            self._odb.close()
+        self._odb = None
+        self._odb_opened = False
+
+
+def decode_git_text(data: bytes) -> str:
+    """Decode git output the way subprocess text mode does (locale, universal newlines)."""
+    text = data.decode(locale.getpreferredencoding(False))
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def file_exists_at_ref(git: GitSession, ref: str, path: str) -> bool:
+    """Check if a file exists at the given ref via the session's batch-check pipe."""
+    return git.object_exists(f"{ref}:{path}")
 
-def file_exists_at_ref(git_dir: str, ref: str, path: str) -> bool:
-    """Check if a file exists at the given ref using cat-file -e."""
-    result = run_git(git_dir, "cat-file", "-e", f"{ref}:{path}")
-    return result.returncode == 0
 
+def read_file_at_ref(
+    git: GitSession, ref: str, path: str, max_chars: Optional[int] = None
+) -> Optional[str]:
+    """Read file content at the given ref via the session's batch pipe.
+
+    With max_chars, blob content is capped at max_chars + 1 characters.
+    """
+    obj = git.read_text(f"{ref}:{path}", max_chars)
+    if obj is None:
+        return None
+    obj_type, text = obj
+    if obj_type != "blob":
+        # Trees and other non-blob objects: keep `git show` formatting.
+        result = git.run("show", f"{ref}:{path}")
+        return result.stdout if result.returncode == 0 else None
+    return text
+
+
+def read_blob(git: GitSession, oid: str, max_chars: Optional[int] = None) -> Optional[str]:
+    """Read a blob by OID via the session's batch pipe, optionally capped like read_file_at_ref."""
+    obj = git.read_text(oid, max_chars)
+    if obj is None or obj[0] != "blob":
+        return None
+    return obj[1]
 
-def read_file_at_ref(git_dir: str, ref: str, path: str) -> Optional[str]:
-    """Read file content at the given ref using git show."""
-    result = run_git(git_dir, "show", f"{ref}:{path}")
-    if result.returncode == 0:
-        return result.stdout
-    return None
 
+def read_file_from_disk(git_dir: str, path: str, max_chars: Optional[int] = None) -> Optional[str]:
+    """Read file content from disk (working tree mode).
 
-def read_file_from_disk(git_dir: str, path: str) -> Optional[str]:
-    """Read file content from disk (working tree mode)."""
+    With max_chars, at most max_chars + 1 characters are read.
+    """
     full_path = os.path.join(git_dir, path)
     try:
         with open(full_path, "r") as f:
-            return f.read()
+            return f.read() if max_chars is None else f.read(max_chars + 1)
     except OSError:
         return None
 
@@ -79,6 +1110,683 @@ def file_exists_on_disk(git_dir: str, path: str) -> bool:
     return os.path.isfile(full_path)
 
 
+class DirectoryListings:
+    """Per-run working-tree lookups, one os.scandir() per directory.
+
+    file_stat() answers os.path.isfile() (symlinks followed) from the
+    cached listing of the file's directory, and returns the stat result
+    for size planning and the content cache key. A name the listing lacks
+    is still stat()ed, since a case-insensitive filesystem (macOS) opens
+    `agents.md` as `AGENTS.md`; only a missing directory answers without
+    a system call. Listings are never kept across runs: the working tree
+    may change between them.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._listings: dict[str, Optional[dict[str, os.DirEntry]]] = {}
+
+    def _listing(self, parent: str) -> Optional[dict[str, os.DirEntry]]:
+        """The entries of parent by name, or None if it is not a directory."""
+        if parent in self._listings:
+            return self._listings[parent]
+        try:
+            with os.scandir(os.path.join(self.root, parent)) as entries:
+                listing = {entry.name: entry for entry in entries}
+        except (FileNotFoundError, NotADirectoryError):
+            listing = None
+        except (OSError, ValueError):
+            listing = {}  # unlistable: every lookup falls back to stat()
+        self._listings[parent] = listing
+        return listing
+
+    def file_stat(self, path: str) -> Optional[os.stat_result]:
+        """stat() of a regular file (following symlinks), or None like os.path.isfile."""
+        parent, name = posixpath.split(path)
+        listing = self._listing(parent)
+        if listing is None:
+            return None
+        entry = listing.get(name)
+        try:
+            if entry is None:
+                st = os.stat(os.path.join(self.root, path))
+                return st if stat.S_ISREG(st.st_mode) else None
+            if not entry.is_file():
+                return None
+            return entry.stat()
+        except (OSError, ValueError):
+            return None
+
+
+@dataclass
+class TreeIndex:
+    """Guideline paths present in a commit's tree, from one pathspec-filtered scan.
+
+    Answers the same question as `git cat-file -e <ref>:<path>` for guideline
+    candidates (paths ending in CLAUDE.md) with set lookups: a candidate
+    exists if it names a blob (or symlink) or a directory. Submodule entries
+    are excluded because their commits are not objects in this repository.
+    Paths that are not named CLAUDE.md are never indexed.
+    """
+    blobs: dict[str, str]  # path -> blob OID
+    dirs: set[str]
+
+    @classmethod
+    def from_raw_records(cls, records) -> "TreeIndex":
+        """Build an index from `git diff-tree -r -t -z --raw <empty> <tree>` records.
+
+        Records alternate between ":<modes> <oids> <status>" and the path.
+        Intermediate trees git reports on the way down are dropped as they
+        stream past, so memory is proportional to the guideline count.
+        """
+        blobs = {}
+        dirs = set()
+        records = iter(records)
+        for meta in records:
+            path = next(records, None)
+            if path is None:
+                break
+            if posixpath.basename(path) != "CLAUDE.md":
+                continue
+            _old_mode, new_mode, _old_oid, oid, _status = meta.split(" ")
+            if new_mode == "040000":
+                dirs.add(path)
+            elif new_mode != "160000":
+                blobs[path] = oid
+        return cls(blobs=blobs, dirs=dirs)
+
+    @classmethod
+    def scan(cls, git: "GitSession", tree_oid: str) -> "TreeIndex":
+        """Index the guidelines of a tree, letting git filter by pathspec.
+
+        Diffing the tree against the empty tree is how git lists a tree
+        with wildcard pathspecs (`ls-tree` only takes literal prefixes).
+        Raises subprocess.CalledProcessError if git fails.
+        """
+        empty_tree = EMPTY_TREE_OIDS[len(tree_oid)]
+        return cls.from_raw_records(git.iter_z(
+            "diff-tree", "-r", "-t", "-z", "--raw", "--no-renames",
+            empty_tree, tree_oid, "--", GUIDELINE_PATHSPEC,
+        ))
+
+    def exists(self, path: str) -> bool:
+        return path in self.blobs or path in self.dirs
+
+
+RESOLUTION_CACHE_VERSION = 1
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+def default_cache_dir() -> str:
+    """Cache location under $XDG_CACHE_HOME (default ~/.cache)."""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "claude", "resolve-claude-md")
+
+
+class DiskCache:
+    """Size-bounded key/value cache directory shared by concurrent runs.
+
+    Entries are written to a temp file and atomically renamed into place,
+    so readers never see a partial entry. Reads bump the entry's mtime,
+    which eviction uses as the LRU order. Eviction runs under an exclusive
+    flock so parallel writers don't race each other deleting entries;
+    a reader losing an entry to eviction just sees a miss.
+
+    Eviction scans the whole directory, so put() runs it on a cache's
+    first write and then only after every max_bytes / EVICT_EVERY_PARTS
+    written: each writer overshoots max_bytes by at most that much.
+    """
+
+    EVICT_EVERY_PARTS = 16
+
+    def __init__(self, root: str, max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._written_since_evict: Optional[int] = None  # None: not evicted yet
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass  # evicted concurrently; the data we read is still valid
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self._entry_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError:
+            return  # the cache is an optimization; never fail the run
+        written = len(data) + (self._written_since_evict or 0)
+        if self._written_since_evict is None or written > self.max_bytes // self.EVICT_EVERY_PARTS:
+            self.evict()
+        else:
+            self._written_since_evict = written
+
+    def evict(self) -> None:
+        """Delete least-recently-used entries until the cache fits max_bytes."""
+        self._written_since_evict = 0
+        try:
+            lock_fd = os.open(os.path.join(self.root, ".lock"), os.O_CREAT | os.O_RDWR, 0o644)
+        except OSError:
+            return
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return  # another run is already evicting
+            entries = []
+            total = 0
+            for shard in os.scandir(self.root):
+                if not shard.is_dir(follow_symlinks=False):
+                    continue
+                for entry in os.scandir(shard.path):
+                    if entry.name.startswith(".tmp-"):
+                        continue
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime_ns, st.st_size, entry.path))
+                    total += st.st_size
+            entries.sort()
+            for _mtime, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                total -= size
+        except OSError:
+            pass
+        finally:
+            os.close(lock_fd)
+
+
+def resolution_cache_key(
+    tree_index: TreeIndex,
+    guidelines: list[Guideline],
+    sorted_dirs: list[str],
+    depth: int,
+    budget: int,
+    budget_unit: str = "chars",
+    dedupe_includes: bool = False,
+) -> Optional[str]:
+    """Key a merge-base resolution by guideline blob OIDs and resolver settings.
+
+    Returns None when a guideline is not a plain blob (its rendering would
+    depend on the ref name rather than on content).
+    """
+    guideline_oids = []
+    for g in guidelines:
+        oid = tree_index.blobs.get(g.path)
+        if oid is None:
+            return None
+        guideline_oids.append([g.path, oid])
+    material = json.dumps({
+        "version": RESOLUTION_CACHE_VERSION,
+        "depth": depth,
+        "budget": budget,
+        "budget_unit": budget_unit,
+        "dedupe_includes": dedupe_includes,
+        "ancestor_dirs": sorted_dirs,
+        "guidelines": guideline_oids,
+    }, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def directive_target_oids(
+    git: GitSession, tree_oid: str, paths: list[str]
+) -> Optional[dict[str, Optional[str]]]:
+    """Map directive targets to their blob OIDs in a tree (None when missing).
+
+    Returns None if any target is a directory or other non-blob, whose
+    rendering is not content-addressed.
+    """
+    paths = list(dict.fromkeys(paths))
+    targets = {}
+    for path, info in zip(paths, git.object_infos([f"{tree_oid}:{p}" for p in paths])):
+        if info is not None and info[1] != "blob":
+            return None
+        targets[path] = info[0] if info is not None else None
+    return targets
+
+
+def load_cached_resolution(
+    cache: DiskCache, key: str, git: GitSession, tree_oid: str
+) -> Optional[Resolution]:
+    """Return a cached resolution if every directive target still has the same OID."""
+    data = cache.get(key)
+    if data is None:
+        return None
+    try:
+        entry = json.loads(data)
+        recorded = entry["directive_targets"]
+        if directive_target_oids(git, tree_oid, list(recorded)) != recorded:
+            return None
+        return Resolution(
+            resolved_content=entry["resolved_content"],
+            directives=[Directive(**d) for d in entry["directives"]],
+            guidelines_loaded_section=entry["guidelines_loaded_section"],
+            source_map=[SourceSpan(**span) for span in entry["source_map"]],
+        )
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None  # corrupt or foreign entry: treat as a miss
+
+
+def store_cached_resolution(
+    cache: DiskCache, key: str, resolution: Resolution, git: GitSession, tree_oid: str
+) -> None:
+    """Cache a resolution together with the OIDs of every directive target it consulted."""
+    targets = directive_target_oids(git, tree_oid, [d.resolved_path for d in resolution.directives])
+    if targets is None:
+        return  # directory target: rendered via `git show`, not content-addressed
+    entry = {
+        "directive_targets": targets,
+        "directives": [asdict(d) for d in resolution.directives],
+        "guidelines_loaded_section": resolution.guidelines_loaded_section,
+        "resolved_content": resolution.resolved_content,
+        "source_map": [asdict(span) for span in resolution.source_map],
+    }
+    cache.put(key, json.dumps(entry).encode("utf-8"))
+
+
+def worktree_text_cache_key(git_dir: str, path: str, file_id: tuple[int, int, int]) -> str:
+    """Key a working-tree file's text by location and (mtime_ns, size, inode)."""
+    material = json.dumps({
+        "version": RESOLUTION_CACHE_VERSION,
+        "kind": "worktree-text",
+        "path": os.path.abspath(os.path.join(git_dir, path)),
+        "file_id": list(file_id),
+        "encoding": locale.getpreferredencoding(False),
+    })
+    return hashlib.sha256(material.encode("utf-8", "surrogateescape")).hexdigest()
+
+
+def token_count_cache_key(git_dir: str, key) -> str:
+    """Key a token count by blob OID, or by a working-tree file's (path, file identity).
+
+    The tokenizer pattern is part of the key, so changing it never reuses
+    stale counts.
+    """
+    if isinstance(key, str):
+        identity = {"oid": key}
+    else:
+        path, file_id = key
+        identity = {"path": os.path.abspath(os.path.join(git_dir, path)), "file_id": list(file_id)}
+    material = json.dumps({
+        "version": RESOLUTION_CACHE_VERSION,
+        "kind": "token-count",
+        "tokenizer": TOKEN_RE.pattern,
+        "encoding": locale.getpreferredencoding(False),
+        **identity,
+    })
+    return hashlib.sha256(material.encode("utf-8", "surrogateescape")).hexdigest()
+
+
+def load_cached_count(cache: DiskCache, key: str) -> Optional[int]:
+    data = cache.get(key)
+    if data is None:
+        return None
+    try:
+        return int(data)
+    except ValueError:
+        return None  # corrupt entry: treat as a miss
+
+
+def load_cached_text(cache: DiskCache, key: str) -> Optional[str]:
+    data = cache.get(key)
+    if data is None:
+        return None
+    try:
+        return data.decode("utf-8", "surrogatepass")
+    except UnicodeDecodeError:
+        return None  # corrupt entry: treat as a miss
+
+
+def blob_text_cache_key(oid: str) -> str:
+    """Key a blob's decoded text by OID (and the encoding it was decoded with)."""
+    material = json.dumps({
+        "version": RESOLUTION_CACHE_VERSION,
+        "kind": "blob-text",
+        "oid": oid,
+        "encoding": locale.getpreferredencoding(False),
+    })
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def shared_blob_cache_dir(git: GitSession) -> Optional[str]:
+    """Default --blob-cache location, inside the common git dir every worktree shares."""
+    result = git.run("rev-parse", "--git-common-dir")
+    if result.returncode != 0:
+        return None
+    return os.path.join(git.git_dir, result.stdout.strip(), "resolve-claude-md", "blobs")
+
+
+# Files modified this recently may change again within the same mtime tick
+WORKTREE_RACY_NS = 2 * 1_000_000_000
+
+
+def store_worktree_text(
+    cache: DiskCache, key: str, git_dir: str, path: str, info: TargetInfo, text: str
+) -> None:
+    """Cache a file's text if it still matches the stat the key was built from.
+
+    A file changed between planning and reading, or modified within the
+    last WORKTREE_RACY_NS (when a same-size rewrite could keep the same
+    mtime), is not cached.
+    """
+    try:
+        st = os.stat(os.path.join(git_dir, path))
+    except OSError:
+        return
+    if (st.st_mtime_ns, st.st_size, st.st_ino) != info.file_id:
+        return
+    if time.time_ns() - st.st_mtime_ns < WORKTREE_RACY_NS:
+        return
+    cache.put(key, text.encode("utf-8", "surrogatepass"))
+
+
+class BoundedDict(dict):
+    """A dict that forgets its oldest entries beyond max_entries."""
+
+    def __init__(self, max_entries: int):
+        super().__init__()
+        self.max_entries = max_entries
+
+    def __setitem__(self, key, value):
+        if key not in self and len(self) >= self.max_entries:
+            del self[next(iter(self))]
+        super().__setitem__(key, value)
+
+
+@dataclass
+class RepoState:
+    """Per-repository state that stays valid across resolutions in one process.
+
+    Everything here is keyed by object or content identity (tree OIDs, blob
+    OIDs, document text), so it can be reused no matter which merge-base or
+    file scope a later request asks about.
+    """
+    git: GitSession
+    tree_indexes: dict = field(default_factory=lambda: BoundedDict(8))
+    blob_texts: dict = field(default_factory=lambda: BoundedDict(4096))
+    directive_scans: dict = field(default_factory=lambda: BoundedDict(4096))
+    token_counts: dict = field(default_factory=lambda: BoundedDict(16384))
+    # Default --blob-cache directory, looked up on first use
+    shared_blob_cache_dir: Optional[str] = None
+
+
+def file_identity(path: str) -> Optional[tuple[int, int, int]]:
+    """(mtime_ns, size, inode) of a regular file, following symlinks; None like os.path.isfile."""
+    try:
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+class Inotify:
+    """The few inotify(7) calls watch mode needs, through ctypes.
+
+    open() returns None where inotify is unavailable (not Linux, no libc
+    symbol, or the per-user instance limit is reached); callers then fall
+    back to polling.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = (
+        IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+        | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+    )
+    EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+    def __init__(self, libc, fd: int):
+        self.libc = libc
+        self.fd = fd
+
+    @classmethod
+    def open(cls) -> Optional["Inotify"]:
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        return cls(libc, fd) if fd >= 0 else None
+
+    def add_watch(self, directory: str) -> Optional[int]:
+        """Watch a directory's entries; None if it cannot be watched (gone, or watch limit hit)."""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.WATCH_MASK)
+        return wd if wd >= 0 else None
+
+    def rm_watch(self, wd: int) -> None:
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self) -> list[tuple[int, int, str]]:
+        """Every queued (wd, mask, name) event, without blocking."""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                events.append((wd, mask, os.fsdecode(name)))
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+@dataclass
+class WatchedResult:
+    """A cached response and the working-tree files it was computed from."""
+    response: tuple[int, str, str]
+    dependencies: dict  # absolute path -> file_identity() when resolved
+    polled: bool  # not fully covered by inotify watches: re-stat on every lookup
+
+
+class WorkingTreeWatch:
+    """Working-tree responses kept in memory until a file they read changes (--watch).
+
+    A response depends on every guideline candidate of its ancestor dirs
+    and every directive target, whether found or not. Each dependency's
+    directory (or, for a path under a missing directory, its nearest
+    existing ancestor) gets an inotify watch, and an event naming a
+    dependency or one of its ancestors drops the responses that read it.
+    Without inotify, or for a directory that could not be watched,
+    lookups re-stat the dependencies instead. Either way a response is
+    only kept if no dependency changed between being read and being
+    watched, and none is young enough that a rewrite could keep its
+    mtime (see WORKTREE_RACY_NS).
+    """
+
+    def __init__(self, use_inotify: bool = True):
+        self.inotify = Inotify.open() if use_inotify else None
+        self.results: dict[tuple, WatchedResult] = {}
+        self.by_path: dict[str, set] = {}
+        self.watch_dirs: dict[int, str] = {}
+        self.watched: dict[str, int] = {}
+
+    def lookup(self, key: tuple) -> Optional[tuple[int, str, str]]:
+        self._drain()
+        result = self.results.get(key)
+        if result is None:
+            return None
+        if result.polled and not self._unchanged(result.dependencies):
+            self._drop(key)
+            return None
+        return result.response
+
+    def store(self, key: tuple, response: tuple[int, str, str], dependencies: dict) -> None:
+        self._drain()
+        now = time.time_ns()
+        for identity in dependencies.values():
+            if identity is not None and now - identity[0] < WORKTREE_RACY_NS:
+                return
+        paths = set(dependencies)
+        paths.update(os.path.realpath(path) for path in dependencies)
+        polled = self.inotify is None
+        if not polled:
+            for path in paths:
+                if not self._watch_ancestor(path):
+                    polled = True
+        # Anything that changed before its watch was in place would be missed
+        if not self._unchanged(dependencies):
+            return
+        self._drop(key)
+        self.results[key] = WatchedResult(response, dict(dependencies), polled)
+        for path in paths:
+            self.by_path.setdefault(path, set()).add(key)
+
+    def close(self) -> None:
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    @staticmethod
+    def _unchanged(dependencies: dict) -> bool:
+        return all(file_identity(path) == identity for path, identity in dependencies.items())
+
+    def _watch_ancestor(self, path: str) -> bool:
+        directory = os.path.dirname(path)
+        while directory not in self.watched:
+            wd = self.inotify.add_watch(directory)
+            if wd is not None:
+                self.watch_dirs[wd] = directory
+                self.watched[directory] = wd
+                break
+            parent = os.path.dirname(directory)
+            if parent == directory or os.path.isdir(directory):
+                return False  # cannot watch an existing directory: poll instead
+            directory = parent
+        return True
+
+    def _drain(self) -> None:
+        if self.inotify is None:
+            return
+        for wd, mask, name in self.inotify.read_events():
+            if mask & Inotify.IN_Q_OVERFLOW:
+                for key in list(self.results):
+                    self._drop(key)
+                continue
+            directory = self.watch_dirs.get(wd)
+            if directory is None:
+                continue
+            if mask & (Inotify.IN_IGNORED | Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF):
+                # The directory itself is gone or moved: forget its watch
+                del self.watch_dirs[wd]
+                del self.watched[directory]
+                if not mask & Inotify.IN_IGNORED:
+                    self.inotify.rm_watch(wd)
+                self._invalidate(directory, subtree=True)
+                continue
+            self._invalidate(os.path.join(directory, name), subtree=bool(mask & Inotify.IN_ISDIR))
+
+    def _invalidate(self, path: str, subtree: bool) -> None:
+        keys = set(self.by_path.get(path, ()))
+        if subtree:
+            prefix = path + os.sep
+            for dependency, dependents in self.by_path.items():
+                if dependency.startswith(prefix):
+                    keys.update(dependents)
+        for key in keys:
+            self._drop(key)
+
+    def _drop(self, key: tuple) -> None:
+        result = self.results.pop(key, None)
+        if result is None:
+            return
+        for path in list(self.by_path):
+            dependents = self.by_path[path]
+            dependents.discard(key)
+            if not dependents:
+                del self.by_path[path]
+
+
+class SessionPool:
+    """Warm RepoState per repository for long-lived resolver processes."""
+
+    def __init__(self, watch: bool = False):
+        self.repos: dict[tuple[str, str], RepoState] = {}
+        # --watch: cached working-tree responses, and what main() reports
+        # the last response depended on (None when it must not be cached)
+        self.watch = WorkingTreeWatch() if watch else None
+        self.last_dependencies: Optional[dict] = None
+        # Repositories the current request used (see execute)
+        self.used: set[tuple[str, str]] = set()
+
+    def repo(self, git_dir: str, object_backend: str = "subprocess") -> RepoState:
+        path = os.path.realpath(git_dir)
+        key = (path, object_backend)
+        state = self.repos.get(key)
+        if state is None:
+            state = RepoState(git=GitSession(path, object_backend))
+            self.repos[key] = state
+        self.used.add(key)
+        return state
+
+    def discard_used(self) -> None:
+        """Close and forget the repositories the current request used.
+
+        A request that failed part-way may have left a `cat-file` pipe
+        holding unread output, so later requests start from fresh sessions.
+        """
+        for key in self.used:
+            state = self.repos.pop(key, None)
+            if state is not None:
+                state.git.close()
+        self.used.clear()
+
+    def close(self) -> None:
+        for state in self.repos.values():
+            state.git.close()
+        self.repos.clear()
+        if self.watch is not None:
+            self.watch.close()
+
+
 def compute_ancestor_dirs(changed_files: list[str]) -> list[str]:
     """Extract ancestor directories from changed file paths.
 
@@ -103,6 +1811,40 @@ def sort_ancestor_dirs(dirs: list[str]) -> list[str]:
     return sorted(dirs, key=sort_key)
 
 
+def ancestor_dirs_deepest_first(changed_files: Iterable[str]) -> list[str]:
+    """Ancestor dirs of a stream of paths, already in sort_ancestor_dirs order.
+
+    Equivalent to sort_ancestor_dirs(compute_ancestor_dirs(files)) without
+    materializing the file list: each path walks a trie of its directory
+    components, and a directory's full path is only built the first time
+    it is seen. Directories are bucketed by depth as they are created, so
+    the final ordering sorts each level once instead of every dir by key.
+    """
+    trie: dict = {}
+    levels: list[list[str]] = []
+    for filepath in changed_files:
+        node = trie
+        prefix = ""
+        parts = filepath.split("/")
+        for depth in range(len(parts) - 1):
+            name = parts[depth]
+            child = node.get(name)
+            if child is None:
+                dir_path = f"{prefix}/{name}" if depth else name
+                child = node[name] = ({}, dir_path)
+                if dir_path:  # a leading "/" names the root, which is added below
+                    while len(levels) <= depth:
+                        levels.append([])
+                    levels[depth].append(dir_path)
+            node, prefix = child
+    dirs = []
+    for level in reversed(levels):
+        level.sort()
+        dirs.extend(level)
+    dirs.append("")  # root is always included, always last
+    return dirs
+
+
 def format_ancestor_dirs_list(sorted_dirs: list[str]) -> str:
     """Format dirs for display: comma-separated, (root) for empty string."""
     parts = []
@@ -114,22 +1856,34 @@ def format_ancestor_dirs_list(sorted_dirs: list[str]) -> str:
     return ", ".join(parts)
 
 
-def is_inside_fenced_code_block(lines: list[str], target_line_idx: int) -> bool:
-    """Check if a line is inside a fenced code block.
+FENCE_OPEN_RE = re.compile(r"^( {0,3})((`{3,})|(~{3,}))")
+BACKTICK_FENCE_CLOSE_RE = re.compile(r"^( {0,3})(`{3,})$")
+TILDE_FENCE_CLOSE_RE = re.compile(r"^( {0,3})(~{3,})$")
+# Lines that could be @ directives: optional whitespace (not crossing a line), then @
+DIRECTIVE_CANDIDATE_RE = re.compile(r"^[^\S\n]*@", re.MULTILINE)
+
+
+def fenced_line_flags(lines: list[str]) -> list[bool]:
+    """Compute fenced-code-block state for every line in one forward pass.
+
+    flags[i] is True when lines[i] is inside a fenced code block, i.e. the
+    same answer as is_inside_fenced_code_block(lines, i), but for the whole
+    document in O(n) instead of O(n) per line.
 
     Implements CommonMark fenced code block detection:
     - Opens with 3+ consecutive backticks or tildes (optionally preceded by up to 3 spaces)
     - Closes with >= same count of same fence char, no other non-whitespace
     - Nested fences (longer sequence inside shorter) do not close outer
     """
+    flags = []
     in_fence = False
     fence_char = None
     fence_count = 0
 
-    for i in range(target_line_idx):
-        line = lines[i]
+    for line in lines:
+        flags.append(in_fence)
         if not in_fence:
-            m = re.match(r"^( {0,3})((`{3,})|(~{3,}))", line)
+            m = FENCE_OPEN_RE.match(line)
             if m:
                 if m.group(3):
                     # Backtick fence: info string must not contain backticks
@@ -145,19 +1899,25 @@ def is_inside_fenced_code_block(lines: list[str], target_line_idx: int) -> bool:
         else:
             # Check if this line closes the fence
             if fence_char == "`":
-                close_match = re.match(r"^( {0,3})(`{3,})$", line.rstrip())
-                if close_match and len(close_match.group(2)) >= fence_count:
-                    in_fence = False
-                    fence_char = None
-                    fence_count = 0
-            elif fence_char == "~":
-                close_match = re.match(r"^( {0,3})(~{3,})$", line.rstrip())
-                if close_match and len(close_match.group(2)) >= fence_count:
-                    in_fence = False
-                    fence_char = None
-                    fence_count = 0
+                close_match = BACKTICK_FENCE_CLOSE_RE.match(line.rstrip())
+            else:
+                close_match = TILDE_FENCE_CLOSE_RE.match(line.rstrip())
+            if close_match and len(close_match.group(2)) >= fence_count:
+                in_fence = False
+                fence_char = None
+                fence_count = 0
+
+    return flags
+
+
+def is_inside_fenced_code_block(lines: list[str], target_line_idx: int) -> bool:
+    """Check if a line is inside a fenced code block.
 
-    return in_fence
+    Scans from the top of the document; callers checking many lines of the
+    same document should compute fenced_line_flags() once instead.
+    """
+    # The sentinel line reports the state after lines[:target_line_idx]
+    return fenced_line_flags(lines[:target_line_idx] + [""])[-1]
 
 
 def is_inside_inline_code_span(line: str, at_position: int) -> bool:
@@ -216,7 +1976,12 @@ SAFE_PATH_RE = re.compile(r"^[A-Za-z0-9._/~-]+$")
 DOTDOT_COMPONENT_RE = re.compile(r"(^|/)\.\.(/|$)")
 
 
-def is_directive_line(line: str, lines: list[str], line_idx: int) -> Optional[str]:
+def is_directive_line(
+    line: str,
+    lines: list[str],
+    line_idx: int,
+    fence_flags: Optional[list[bool]] = None,
+) -> Optional[str]:
     """Check if a line is an @ directive. Returns the path or None.
 
     Conditions:
@@ -224,6 +1989,9 @@ def is_directive_line(line: str, lines: list[str], line_idx: int) -> Optional[st
     (b) @ is first non-whitespace character
     (c) Not inside fenced code block
     (d) Not inside inline code span
+
+    fence_flags, when given, is the fenced_line_flags(lines) result for the
+    document and replaces the per-line rescan for condition (c).
     """
     stripped = line.strip()
     if not stripped:
@@ -251,7 +2019,10 @@ def is_directive_line(line: str, lines: list[str], line_idx: int) -> Optional[st
         return None
 
     # (c) Not inside fenced code block
-    if is_inside_fenced_code_block(lines, line_idx):
+    if fence_flags is not None:
+        if fence_flags[line_idx]:
+            return None
+    elif is_inside_fenced_code_block(lines, line_idx):
         return None
 
     # (d) Not inside inline code span
@@ -295,6 +2066,439 @@ def get_parent_dir(claude_md_path: str) -> str:
     return "/".join(parts[:-1])
 
 
+def min_chars_for_size(size: int) -> int:
+    """Fewest characters a file of `size` bytes can decode to."""
+    return -(-size // MAX_BYTES_PER_CHAR)
+
+
+BUDGET_UNITS = ("chars", "tokens")
+TRUNCATION_MARKER = "[truncated]"
+
+# Offline approximation of a BPE tokenizer for --budget-unit tokens. It
+# tracks how model tokenizers treat markdown: English words cost about one
+# token (long ones several), digits go in groups of three, indentation and
+# blank-line runs are cheap, punctuation (fences, table rules, markup)
+# merges in short runs, and every non-ASCII character costs a full token.
+# No token is longer than MAX_TOKEN_CHARS characters.
+TOKEN_RE = re.compile(
+    r" ?[A-Za-z]{1,8}"
+    r"| ?[0-9]{1,3}"
+    r"|[ \t]{1,8}"
+    r"|\n{1,8}"
+    r"|[!-/:-@\[-`{-~]{1,3}"
+    r"|[\s\S]"
+)
+MAX_TOKEN_CHARS = 9
+
+
+def count_tokens(text: str) -> int:
+    """Approximate model token count of text (see TOKEN_RE)."""
+    return len(TOKEN_RE.findall(text))
+
+
+def token_prefix(text: str, n_tokens: int) -> str:
+    """The longest prefix of text made of whole tokens, at most n_tokens of them."""
+    end = 0
+    for end_match, _ in zip(TOKEN_RE.finditer(text), range(n_tokens)):
+        end = end_match.end()
+    return text[:end]
+
+
+TRUNCATION_MARKER_TOKENS = count_tokens(TRUNCATION_MARKER)
+
+
+def marker_cost(ctx: ResolveContext) -> int:
+    """What appending TRUNCATION_MARKER costs in the run's budget unit."""
+    return TRUNCATION_MARKER_TOKENS if ctx.budget_unit == "tokens" else len(TRUNCATION_MARKER)
+
+
+def min_cost_for_size(ctx: ResolveContext, size: int) -> int:
+    """Lowest budget cost a file of `size` bytes can have."""
+    min_chars = min_chars_for_size(size)
+    if ctx.budget_unit == "tokens":
+        return -(-min_chars // MAX_TOKEN_CHARS)
+    return min_chars
+
+
+def read_cap(ctx: ResolveContext, info: Optional[TargetInfo]) -> Optional[int]:
+    """Characters read_target needs of a target to apply the remaining budget; None for all.
+
+    A text of more than budget_remaining tokens has its first
+    budget_remaining + 1 tokens within (budget_remaining + 1) *
+    MAX_TOKEN_CHARS characters, and tokenizing that prefix yields them
+    unchanged, so the capped text overflows exactly when the whole would
+    and truncates to the same token boundary.
+    """
+    if info is None:
+        return None
+    if info.size in ctx.included_sizes:
+        return None  # may repeat an included block; dedupe compares full texts
+    cap = ctx.budget_remaining
+    if ctx.budget_unit == "tokens":
+        cap = (ctx.budget_remaining + 1) * MAX_TOKEN_CHARS
+    # Every character takes at least one byte, so size <= cap always fits
+    return cap if info.size > cap else None
+
+
+def content_cost(ctx: ResolveContext, path: str, content: str) -> int:
+    """Budget cost of a target's content: characters, or approximate tokens.
+
+    Token counts of fully read content are kept per blob OID (per path
+    and file identity in working-tree mode, once the file is past the
+    racy window), in memory and, with --cache-dir, on disk, so unchanged
+    files are never tokenized twice.
+    """
+    if ctx.budget_unit != "tokens":
+        return len(content)
+    if path in ctx.partial_reads:
+        return count_tokens(content)
+    info = ctx.target_infos.get(path)
+    key = None
+    if info is not None and info.oid is not None and info.obj_type == "blob":
+        key = info.oid
+    elif info is not None and info.file_id is not None:
+        if time.time_ns() - info.file_id[0] >= WORKTREE_RACY_NS:
+            key = (path, info.file_id)
+    if key is None:
+        return count_tokens(content)
+    count = ctx.token_counts.get(key)
+    if count is None:
+        cache_key = None
+        if ctx.content_cache is not None:
+            cache_key = token_count_cache_key(ctx.git_dir, key)
+            count = load_cached_count(ctx.content_cache, cache_key)
+        if count is None:
+            count = count_tokens(content)
+            if cache_key is not None:
+                ctx.content_cache.put(cache_key, str(count).encode("ascii"))
+        ctx.token_counts[key] = count
+    return count
+
+
+def truncate_to_budget(ctx: ResolveContext, content: str, available: int) -> str:
+    """Cut content to `available` budget units, on a token boundary in token mode, and mark it."""
+    if ctx.budget_unit == "tokens":
+        return token_prefix(content, available) + TRUNCATION_MARKER
+    return content[:available] + TRUNCATION_MARKER
+
+
+def block_key(ctx: ResolveContext, path: str, content: Optional[str] = None) -> Optional[str]:
+    """Content identity of a fully read blob target for --dedupe-includes.
+
+    In merge-base mode this is the blob OID, known without reading; on
+    disk it is the text itself, read in full only when its size matches
+    an already included block. None when the target cannot be a repeat.
+    """
+    info = ctx.target_infos.get(path)
+    if info is None or info.obj_type != "blob":
+        return None
+    if info.oid is not None:
+        return info.oid
+    if content is None:
+        if info.size not in ctx.included_sizes:
+            return None
+        content = read_target(ctx, path)
+    if content is None or path in ctx.partial_reads:
+        return None
+    return content
+
+
+def record_included_block(ctx: ResolveContext, path: str, content: str) -> None:
+    """Remember that a target's full content is now in the output."""
+    key = block_key(ctx, path, content)
+    if key is not None:
+        ctx.included_blocks.setdefault(key, path)
+        ctx.included_sizes.add(ctx.target_infos[path].size)
+
+
+def plan_targets(ctx: ResolveContext, paths: list[str]) -> None:
+    """Record existence, OID and size for targets not planned yet, without reading them.
+
+    In merge-base mode all unplanned paths go to git in one pipelined
+    `cat-file --batch-check` round trip; in working-tree mode each is a
+    lookup in its directory's cached listing. Budget decisions can then be
+    made before any content is fetched.
+    """
+    pending = [p for p in dict.fromkeys(paths) if p not in ctx.target_infos]
+    if not pending:
+        return
+    if ctx.working_tree:
+        for path in pending:
+            st = ctx.listings.file_stat(path)
+            if st is None:
+                ctx.target_infos[path] = None  # same answer as os.path.isfile
+                continue
+            ctx.target_infos[path] = TargetInfo(
+                oid=None, obj_type="blob", size=st.st_size,
+                file_id=(st.st_mtime_ns, st.st_size, st.st_ino),
+            )
+        return
+    infos = ctx.git.object_infos([f"{ctx.merge_base}:{p}" for p in pending])
+    for path, info in zip(pending, infos):
+        ctx.target_infos[path] = TargetInfo(*info) if info is not None else None
+
+
+def target_exists(ctx: ResolveContext, path: str) -> bool:
+    """Check (once per run) whether a guideline or directive target exists."""
+    plan_targets(ctx, [path])
+    return ctx.target_infos[path] is not None
+
+
+def read_target(ctx: ResolveContext, path: str) -> Optional[str]:
+    """Read (once per run) a guideline or directive target's content.
+
+    A file whose size exceeds the remaining budget may not fit, so only
+    its first budget_remaining + 1 characters (see read_cap for tokens)
+    are read: enough for the callers' overflow check and truncation to
+    give the same result as the whole file. The budget only shrinks
+    during a run, so the capped text stays sufficient for later reads of
+    the same path. Capped text is never put in the cross-run blob cache
+    and is recorded in partial_reads.
+    """
+    if path in ctx.read_cache:
+        return ctx.read_cache[path]
+    plan_targets(ctx, [path])
+    info = ctx.target_infos[path]
+    max_chars = read_cap(ctx, info)
+    if ctx.working_tree:
+        content = None
+        cache_key = None
+        if ctx.content_cache is not None and info is not None and max_chars is None:
+            cache_key = worktree_text_cache_key(ctx.git_dir, path, info.file_id)
+            content = load_cached_text(ctx.content_cache, cache_key)
+        if content is None:
+            hit, content = take_prefetched(ctx, path, max_chars)
+            if not hit:
+                content = read_file_from_disk(ctx.git_dir, path, max_chars)
+            if cache_key is not None and content is not None:
+                store_worktree_text(ctx.content_cache, cache_key, ctx.git_dir, path, info, content)
+    elif info is not None and info.obj_type == "blob":
+        content = cached_blob_text(ctx, info.oid)
+        if content is None:
+            hit, content = take_prefetched(ctx, path, max_chars)
+            if not hit:
+                content = read_blob(ctx.git, info.oid, max_chars)
+            if content is not None and (max_chars is None or len(content) <= max_chars):
+                ctx.blob_texts[info.oid] = content
+                if ctx.blob_cache is not None:
+                    ctx.blob_cache.put(
+                        blob_text_cache_key(info.oid), content.encode("utf-8", "surrogatepass"),
+                    )
+    else:
+        content = read_file_at_ref(ctx.git, ctx.merge_base, path, max_chars)
+    if content is not None and max_chars is not None and len(content) > max_chars:
+        ctx.partial_reads.add(path)
+    ctx.read_cache[path] = content
+    return content
+
+
+def cached_blob_text(ctx: ResolveContext, oid: str) -> Optional[str]:
+    """A blob's full text from the in-process blob cache or, failing that, --blob-cache."""
+    content = ctx.blob_texts.get(oid)
+    if content is None and ctx.blob_cache is not None:
+        content = load_cached_text(ctx.blob_cache, blob_text_cache_key(oid))
+        if content is not None:
+            ctx.blob_texts[oid] = content
+    return content
+
+
+PREFETCH_WORKERS = 8
+
+
+def take_prefetched(ctx: ResolveContext, path: str, max_chars: Optional[int]) -> tuple[bool, Optional[str]]:
+    """Use a prefetched read of path in place of reading it now with max_chars.
+
+    Reads are prefix-stable (reading with a cap returns the first cap + 1
+    characters of the full text), so a read made with a cap at least as
+    large can be cut down to exactly what the read now would return.
+    Returns (False, None) when there is no prefetched read or it was
+    capped too tightly.
+    """
+    entry = ctx.prefetched.pop(path, None)
+    if entry is None:
+        return False, None
+    cap, content = entry
+    if cap is not None and (max_chars is None or max_chars > cap):
+        return False, None
+    if content is not None and max_chars is not None:
+        content = content[:max_chars + 1]
+    return True, content
+
+
+def prefetch_targets(ctx: ResolveContext, paths: list[str], allowance: Optional[int] = None) -> int:
+    """Read planned blob targets concurrently into ctx.prefetched.
+
+    On disk the reads go to a bounded thread pool; from git they are
+    pipelined through the session's single `cat-file --batch` process,
+    which is not safe to share between threads. Each read is capped for
+    the budget remaining now, which only shrinks before the text is used.
+
+    Targets are taken in order while the smallest cost of those taken
+    (see min_cost_for_size) stays within allowance, by default the
+    remaining budget: past that, every further target will be
+    budget-dropped and never read. Texts already in the blob cache or
+    --cache-dir count against the allowance but are not read. Returns
+    the allowance left, negative once it ran out.
+    """
+    if allowance is None:
+        allowance = ctx.budget_remaining
+    requests = []
+    for path in paths:
+        if allowance < 0:
+            break
+        info = ctx.target_infos.get(path)
+        if info is None or info.obj_type != "blob":
+            continue
+        allowance -= min_cost_for_size(ctx, info.size)
+        if path in ctx.read_cache or path in ctx.prefetched:
+            continue
+        if not ctx.working_tree and cached_blob_text(ctx, info.oid) is not None:
+            continue
+        if ctx.working_tree and ctx.content_cache is not None:
+            content = load_cached_text(
+                ctx.content_cache, worktree_text_cache_key(ctx.git_dir, path, info.file_id),
+            )
+            if content is not None:
+                ctx.read_cache[path] = content  # what read_target would load: the full text
+                continue
+        requests.append((path, info, read_cap(ctx, info)))
+    if not requests:
+        return allowance
+    if not ctx.working_tree:
+        objs = ctx.git.read_texts([(info.oid, cap) for _, info, cap in requests])
+        texts = [obj[1] if obj is not None and obj[0] == "blob" else None for obj in objs]
+    elif len(requests) == 1 or ctx.prefetch_workers <= 1:
+        texts = [read_file_from_disk(ctx.git_dir, path, cap) for path, _, cap in requests]
+    else:
+        with ThreadPoolExecutor(max_workers=min(ctx.prefetch_workers, len(requests))) as pool:
+            texts = list(pool.map(
+                lambda request: read_file_from_disk(ctx.git_dir, request[0], request[2]),
+                requests,
+            ))
+    for (path, _, cap), text in zip(requests, texts):
+        ctx.prefetched[path] = (cap, text)
+    return allowance
+
+
+def prefetch_directive_graph(ctx: ResolveContext, guidelines: list[Guideline]) -> None:
+    """Prefetch guideline and directive target contents one depth level at a time.
+
+    Each level's targets are planned in one batch and read concurrently;
+    their directives name the next level. This only warms
+    ctx.prefetched: resolution still reads, charges the budget and
+    assigns statuses in document order, so its output is unchanged.
+    Levels are cut short, and descent stops, once the targets planned so
+    far would cost more than the remaining budget even at their smallest
+    (by text for earlier levels, by size within the current one), so
+    nothing is fetched that resolution would budget-drop.
+    """
+    level = [g.path for g in guidelines]
+    parent_dirs = {path: get_parent_dir(path) for path in level}
+    seen = set(level)
+    fetched_cost = 0
+    for depth in range(ctx.depth_limit + 1):
+        allowance = prefetch_targets(ctx, level, ctx.budget_remaining - fetched_cost)
+        if depth == ctx.depth_limit:
+            break
+        next_level = []
+        for path in level:
+            info = ctx.target_infos.get(path)
+            text = ctx.prefetched.get(path, (None, None))[1]
+            if text is None:
+                text = ctx.read_cache.get(path)
+            if text is None and info is not None and info.oid is not None:
+                text = ctx.blob_texts.get(info.oid)
+            if text is None:
+                continue
+            fetched_cost += len(text) if ctx.budget_unit == "chars" else -(-len(text) // MAX_TOKEN_CHARS)
+            for _, directive_path in scan_directives(text, ctx)[1]:
+                resolved = resolve_path(directive_path, parent_dirs[path])
+                if resolved not in seen and not path_escapes_root(resolved):
+                    seen.add(resolved)
+                    parent_dirs[resolved] = posixpath.dirname(resolved)
+                    next_level.append(resolved)
+        if not next_level or allowance < 0 or fetched_cost > ctx.budget_remaining:
+            break
+        plan_targets(ctx, next_level)
+        level = next_level
+
+
+def scan_directives(content: str, ctx: ResolveContext) -> tuple[list[str], list[tuple[int, str]]]:
+    """Split content into lines and find its @ directive lines, once per distinct content.
+
+    One regex search finds the candidate lines (first non-whitespace
+    character is @). Content without candidates is not split at all; for
+    the rest only candidates get the fence and inline-code checks, and
+    fence state is tracked only up to the last candidate.
+    """
+    first = DIRECTIVE_CANDIDATE_RE.search(content)
+    if first is None:
+        return [], []
+    scan = ctx.directive_scans.get(content)
+    if scan is None:
+        lines = content.split("\n")
+        line_idxs = []
+        line_idx = 0
+        pos = 0
+        for m in DIRECTIVE_CANDIDATE_RE.finditer(content, first.start()):
+            line_idx += content.count("\n", pos, m.start())
+            pos = m.start()
+            line_idxs.append(line_idx)
+        fence_flags = fenced_line_flags(lines[:line_idxs[-1] + 1])
+        found = []
+        for i in line_idxs:
+            directive_path = is_directive_line(lines[i], lines, i, fence_flags)
+            if directive_path is not None:
+                found.append((i, directive_path))
+        scan = (lines, found)
+        ctx.directive_scans[content] = scan
+    return scan
+
+
+def resolve_subtree(
+    content: str,
+    resolved_path: str,
+    ctx: ResolveContext,
+    depth: int,
+    chain_paths: set,
+) -> tuple[list[Segment], list[Directive]]:
+    """Resolve the directives inside a fully-read target, reusing a memoized subtree.
+
+    Budget is still charged for every replay, so the output is identical to
+    resolving the subtree again; only the reads, parsing and recursion are
+    skipped.
+    """
+    key = (resolved_path, depth)
+    memo = ctx.subtree_memo.get(key)
+    if (
+        memo is not None
+        and ctx.budget_remaining >= memo.min_budget
+        and chain_paths & memo.touched == memo.chain_hits
+    ):
+        ctx.budget_remaining -= memo.cost
+        return memo.segments, list(memo.directives)
+
+    budget_before = ctx.budget_remaining
+    resolved_dir = posixpath.dirname(resolved_path) if "/" in resolved_path else ""
+    segments, directives = resolve_directive_segments(
+        content, resolved_dir, resolved_path, ctx, depth, chain_paths,
+    )
+    if all(d.status not in ("truncated", "budget-dropped") for d in directives):
+        cost = budget_before - ctx.budget_remaining
+        touched = frozenset(d.resolved_path for d in directives)
+        ctx.subtree_memo[key] = SubtreeMemo(
+            segments=segments,
+            directives=directives,
+            cost=cost,
+            # Any budget above cost + the marker cost passes every check inside
+            # the subtree; so does any budget at least the one it was built with.
+            min_budget=min(budget_before, cost + marker_cost(ctx) + 1),
+            touched=touched,
+            chain_hits=frozenset(chain_paths & touched),
+        )
+    return segments, directives
+
+
 def resolve_directives_in_content(
     content: str,
     parent_dir: str,
@@ -307,20 +2511,45 @@ def resolve_directives_in_content(
 
     Implements bounded recursion with cycle detection and budget management.
     """
-    if current_depth > ctx.depth_limit:
-        return content, []
+    segments, directives = resolve_directive_segments(
+        content, parent_dir, parent_path, ctx, current_depth, chain_paths,
+    )
+    return "".join(text for text, _, _ in segments), directives
 
-    lines = content.split("\n")
-    result_lines = []
-    directives_found = []
 
-    for i, line in enumerate(lines):
-        directive_path = is_directive_line(line, lines, i)
-        if directive_path is None:
-            result_lines.append(line)
-            continue
+def resolve_directive_segments(
+    content: str,
+    parent_dir: str,
+    parent_path: str,
+    ctx: ResolveContext,
+    current_depth: int,
+    chain_paths: set,
+) -> tuple[list[Segment], list[Directive]]:
+    """resolve_directives_in_content, as segments attributed to their sources.
+
+    The output is the same "\n".join of lines and included subtrees, but
+    each run of the parent's own lines is one segment and each included
+    subtree contributes its segments unchanged.
+    """
+    own_depth = current_depth - 1
+    if current_depth > ctx.depth_limit:
+        return [(content, parent_path, own_depth)], []
+
+    lines, directive_lines = scan_directives(content, ctx)
+    if not directive_lines:
+        return [(content, parent_path, own_depth)], []
+    resolved_paths = [resolve_path(p, parent_dir) for _, p in directive_lines]
+    # Size-first planning: existence and sizes for every target in this document
+    plan_targets(ctx, [r for r in resolved_paths if not path_escapes_root(r)])
+    # Each slot is one "line" of the output: a run of own lines or a subtree
+    slots = []
+    directives_found = []
+    next_line = 0
 
-        resolved = resolve_path(directive_path, parent_dir)
+    for (i, directive_path), resolved in zip(directive_lines, resolved_paths):
+        if i > next_line:
+            slots.append([("\n".join(lines[next_line:i]), parent_path, own_depth)])
+        next_line = i + 1
 
         # Path safety check
         if path_escapes_root(resolved):
@@ -340,12 +2569,7 @@ def resolve_directives_in_content(
             continue
 
         # Check existence
-        if ctx.working_tree:
-            exists = file_exists_on_disk(ctx.git_dir, resolved)
-        else:
-            exists = file_exists_at_ref(ctx.git_dir, ctx.merge_base, resolved)
-
-        if not exists:
+        if not target_exists(ctx, resolved):
             directives_found.append(Directive(
                 parent_path=parent_path,
                 directive=directive_path,
@@ -357,8 +2581,24 @@ def resolve_directives_in_content(
             # Drop the directive line (don't add to result_lines)
             continue
 
+        # Repeated content: point back at the first copy instead, free of charge
+        if ctx.dedupe_includes:
+            key = block_key(ctx, resolved)
+            first_path = ctx.included_blocks.get(key) if key is not None else None
+            if first_path is not None:
+                directives_found.append(Directive(
+                    parent_path=parent_path,
+                    directive=directive_path,
+                    resolved_path=resolved,
+                    exists_at_merge_base=True,
+                    status="deduplicated",
+                    depth=current_depth,
+                ))
+                slots.append([(f"(see {first_path} above)", resolved, current_depth)])
+                continue
+
         # Budget check
-        if ctx.budget_remaining < 12:
+        if ctx.budget_remaining <= marker_cost(ctx):
             directives_found.append(Directive(
                 parent_path=parent_path,
                 directive=directive_path,
@@ -370,10 +2610,7 @@ def resolve_directives_in_content(
             continue
 
         # Read content
-        if ctx.working_tree:
-            ref_content = read_file_from_disk(ctx.git_dir, resolved)
-        else:
-            ref_content = read_file_at_ref(ctx.git_dir, ctx.merge_base, resolved)
+        ref_content = read_target(ctx, resolved)
 
         if ref_content is None:
             directives_found.append(Directive(
@@ -388,9 +2625,10 @@ def resolve_directives_in_content(
 
         # Apply budget
         status = "resolved"
-        if len(ref_content) > ctx.budget_remaining:
-            # Truncate: content + "[truncated]" (11 chars) must fit
-            available = ctx.budget_remaining - 11
+        cost = content_cost(ctx, resolved, ref_content)
+        if cost > ctx.budget_remaining:
+            # Truncate: content + "[truncated]" must fit
+            available = ctx.budget_remaining - marker_cost(ctx)
             if available <= 0:
                 directives_found.append(Directive(
                     parent_path=parent_path,
@@ -401,11 +2639,13 @@ def resolve_directives_in_content(
                     depth=current_depth,
                 ))
                 continue
-            ref_content = ref_content[:available] + "[truncated]"
+            ref_content = truncate_to_budget(ctx, ref_content, available)
             status = "truncated"
             ctx.budget_remaining = 0
         else:
-            ctx.budget_remaining -= len(ref_content)
+            ctx.budget_remaining -= cost
+            if ctx.dedupe_includes:
+                record_included_block(ctx, resolved, ref_content)
 
         # Record directive
         directives_found.append(Directive(
@@ -417,63 +2657,823 @@ def resolve_directives_in_content(
             depth=current_depth,
         ))
 
-        # Recurse into fetched content
+        # Recurse into fetched content (memoized per target for full content)
         new_chain = chain_paths | {resolved}
-        resolved_dir = posixpath.dirname(resolved) if "/" in resolved else ""
-        sub_content, sub_directives = resolve_directives_in_content(
-            ref_content, resolved_dir, resolved, ctx,
-            current_depth + 1, new_chain,
-        )
+        if status == "resolved":
+            sub_segments, sub_directives = resolve_subtree(
+                ref_content, resolved, ctx, current_depth + 1, new_chain,
+            )
+        else:
+            resolved_dir = posixpath.dirname(resolved) if "/" in resolved else ""
+            sub_segments, sub_directives = resolve_directive_segments(
+                ref_content, resolved_dir, resolved, ctx,
+                current_depth + 1, new_chain,
+            )
         directives_found.extend(sub_directives)
-        result_lines.append(sub_content)
+        slots.append(sub_segments)
+
+    if next_line < len(lines):
+        slots.append([("\n".join(lines[next_line:]), parent_path, own_depth)])
+    segments = []
+    for n, slot in enumerate(slots):
+        if n:
+            segments.append(("\n", parent_path, own_depth))
+        segments.extend(slot)
+    return segments, directives_found
 
-    return "\n".join(result_lines), directives_found
+
+def guideline_candidates(ancestor_dir: str) -> list[str]:
+    """CLAUDE.md and .claude/CLAUDE.md paths for a directory, in probe order."""
+    if ancestor_dir == "":
+        return ["CLAUDE.md", ".claude/CLAUDE.md"]
+    return [
+        f"{ancestor_dir}/CLAUDE.md",
+        f"{ancestor_dir}/.claude/CLAUDE.md",
+    ]
+
+
+def diff_guidelines(
+    git: GitSession, base: str, head: str, sorted_dirs: list[str]
+) -> Optional[list[tuple[str, str]]]:
+    """Guideline candidates of the ancestor dirs that differ between two commits.
+
+    Runs one `git diff-tree` restricted to CLAUDE.md paths, so the cost
+    scales with the number of changed guideline files rather than with the
+    number of ancestor directories. Returns (status letter, path) pairs in
+    probe order (deepest directory first, CLAUDE.md before
+    .claude/CLAUDE.md), or None if git failed.
+    """
+    result = git.run(
+        "diff-tree", "-r", "-z", "--no-renames", "--name-status",
+        base, head, "--", GUIDELINE_PATHSPEC,
+    )
+    if result.returncode != 0:
+        return None
+    probe_order = {}
+    for d in sorted_dirs:
+        for path in guideline_candidates(d):
+            probe_order.setdefault(path, len(probe_order))
+    fields = result.stdout.split("\0")
+    changed = []
+    for status, path in zip(fields[0::2], fields[1::2]):
+        if path in probe_order:
+            changed.append((status[:1], path))
+    changed.sort(key=lambda change: probe_order[change[1]])
+    return changed
 
 
 def probe_claude_md_paths(
-    git_dir: str, ref: Optional[str], ancestor_dir: str, working_tree: bool
+    git: GitSession,
+    ref: Optional[str],
+    ancestor_dir: str,
+    working_tree: bool,
+    tree_index: Optional[TreeIndex] = None,
+    listings: Optional[DirectoryListings] = None,
 ) -> list[str]:
     """Probe for CLAUDE.md and .claude/CLAUDE.md in a directory at a ref.
 
-    Returns list of existing paths.
+    With a tree_index for the ref, candidates are set lookups and no git
+    work is done; in working-tree mode, listings does the same for the
+    disk. Returns list of existing paths.
     """
     found = []
-    if ancestor_dir == "":
-        candidates = ["CLAUDE.md", ".claude/CLAUDE.md"]
-    else:
-        candidates = [
-            f"{ancestor_dir}/CLAUDE.md",
-            f"{ancestor_dir}/.claude/CLAUDE.md",
-        ]
-
-    for path in candidates:
-        if working_tree:
-            if file_exists_on_disk(git_dir, path):
+    for path in guideline_candidates(ancestor_dir):
+        if working_tree and listings is not None:
+            if listings.file_stat(path) is not None:
+                found.append(path)
+        elif working_tree:
+            if file_exists_on_disk(git.git_dir, path):
+                found.append(path)
+        elif tree_index is not None:
+            if tree_index.exists(path):
                 found.append(path)
         else:
-            if file_exists_at_ref(git_dir, ref, path):
+            if file_exists_at_ref(git, ref, path):
                 found.append(path)
 
     return found
 
 
-def main():
+def resolve_guidelines(guidelines: list[Guideline], ctx: ResolveContext) -> Resolution:
+    """Read each guideline, apply the budget, and resolve its @ directives."""
+    segments = []
+    parts = 0
+    all_directives = []
+    guidelines_loaded_lines = []
+    source_label = "working-tree" if ctx.working_tree else "merge-base"
+    plan_targets(ctx, [g.path for g in guidelines])
+    if ctx.prefetch_workers > 0:
+        prefetch_directive_graph(ctx, guidelines)
+
+    for guideline in guidelines:
+        budget_before = ctx.budget_remaining
+        if ctx.metrics is not None:
+            ctx.metrics.budget_by_guideline[guideline.path] = 0
+        # Size-first: skip reading a file that certainly overflows an exhausted budget
+        info = ctx.target_infos[guideline.path]
+        if (
+            info is not None
+            and info.obj_type == "blob"
+            and ctx.budget_remaining <= marker_cost(ctx)
+            and min_cost_for_size(ctx, info.size) > ctx.budget_remaining
+        ):
+            guidelines_loaded_lines.append(f"- {guideline.path} ({source_label}, budget-exhausted)")
+            continue
+
+        # Read content
+        content = read_target(ctx, guideline.path)
+
+        if content is None:
+            continue
+
+        # Apply budget to the CLAUDE.md content itself
+        cost = content_cost(ctx, guideline.path, content)
+        if cost > ctx.budget_remaining:
+            available = ctx.budget_remaining - marker_cost(ctx)
+            if available <= 0:
+                guidelines_loaded_lines.append(f"- {guideline.path} ({source_label}, budget-exhausted)")
+                continue
+            content = truncate_to_budget(ctx, content, available)
+            ctx.budget_remaining = 0
+        else:
+            ctx.budget_remaining -= cost
+            if ctx.dedupe_includes:
+                record_included_block(ctx, guideline.path, content)
+
+        # Resolve @ directives in this content
+        parent_dir = get_parent_dir(guideline.path)
+        guideline_segments, directives = resolve_directive_segments(
+            content, parent_dir, guideline.path, ctx, 1, set(),
+        )
+
+        if parts:
+            segments.append(("\n\n", None, 0))
+        segments.extend(guideline_segments)
+        parts += 1
+        all_directives.extend(directives)
+        if ctx.metrics is not None:
+            ctx.metrics.budget_by_guideline[guideline.path] = budget_before - ctx.budget_remaining
+
+        # Build guidelines_loaded_section entry
+        gl_line = f"- {guideline.path} ({source_label})"
+        guidelines_loaded_lines.append(gl_line)
+
+        # Add all directive sub-items with depth-based indentation
+        for d in directives:
+            indent = "  " * min(d.depth, 5)
+            guidelines_loaded_lines.append(
+                f"{indent}- @{d.directive} -> {d.resolved_path} ({d.status})"
+            )
+
+    if not guidelines_loaded_lines:
+        guidelines_loaded_lines.append("None found.")
+    ctx.prefetched.clear()  # reads resolution never reached
+
+    resolved_content, source_map = join_segments(segments, ctx)
+    return Resolution(
+        resolved_content=resolved_content,
+        directives=all_directives,
+        guidelines_loaded_section="\n".join(guidelines_loaded_lines),
+        source_map=source_map,
+    )
+
+
+def join_segments(segments: list[Segment], ctx: ResolveContext) -> tuple[str, list[SourceSpan]]:
+    """Concatenate segments once and map each run of same-source text to a span."""
+    texts = []
+    spans = []
+    offset = 0
+    for text, path, depth in segments:
+        if not text:
+            continue
+        if path is not None:
+            last = spans[-1] if spans else None
+            if (
+                last is not None and last.path == path and last.depth == depth
+                and last.offset + last.length == offset
+            ):
+                last.length += len(text)
+            else:
+                info = ctx.target_infos.get(path)
+                oid = info.oid if info is not None and info.obj_type == "blob" else None
+                spans.append(SourceSpan(
+                    offset=offset, length=len(text), path=path, oid=oid, depth=depth,
+                ))
+        texts.append(text)
+        offset += len(text)
+    return "".join(texts), spans
+
+
+def default_socket_path() -> str:
+    """Per-user daemon socket: $RESOLVE_CLAUDE_MD_SOCKET, else $XDG_RUNTIME_DIR, else a private temp dir."""
+    override = os.environ.get("RESOLVE_CLAUDE_MD_SOCKET")
+    if override:
+        return override
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "resolve-claude-md.sock")
+    return os.path.join(fallback_socket_dir(), "daemon.sock")
+
+
+def fallback_socket_dir() -> str:
+    """Private per-user directory for the socket in the shared temp dir (see make_private_dir)."""
+    return os.path.join(tempfile.gettempdir(), f"resolve-claude-md-{os.getuid()}")
+
+
+def make_private_dir(path: str) -> bool:
+    """Create path as a 0700 directory, or check that an existing one is ours and private.
+
+    The temp dir is world-writable, so another user could have created
+    the path first (as a directory, or a symlink to one) to control what
+    listens there. lstat() does not follow symlinks.
+    """
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    except OSError:
+        return False
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+def execute(argv: list[str], pool: SessionPool) -> tuple[int, str, str]:
+    """Run one resolver invocation in-process against warm state.
+
+    Returns (exit code, stdout, stderr) exactly as a standalone run would
+    have produced them. With a watching pool, a repeated working-tree
+    request is answered from memory while nothing it read has changed.
+    A failed request drops the warm state of every repository it used.
+    """
+    watch = pool.watch
+    if watch is not None:
+        key = (os.getcwd(), tuple(argv))
+        cached = watch.lookup(key)
+        if cached is not None:
+            return cached
+        pool.last_dependencies = None
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    exit_code = 0
+    pool.used.clear()
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            main(argv, pool)
+        except SystemExit as e:
+            if e.code is None:
+                exit_code = 0
+            elif isinstance(e.code, int):
+                exit_code = e.code
+            else:
+                print(e.code, file=sys.stderr)
+                exit_code = 1
+        except Exception:
+            traceback.print_exc()
+            exit_code = 1
+    if exit_code != 0:
+        pool.discard_used()
+    response = exit_code, stdout.getvalue(), stderr.getvalue()
+    if watch is not None and exit_code == 0 and pool.last_dependencies is not None:
+        watch.store(key, response, pool.last_dependencies)
+    return response
+
+
+def query_to_argv(query: dict) -> list[str]:
+    """Translate a JSON query into resolver arguments.
+
+    A query is either {"argv": [...]} or an object keyed by option name,
+    e.g. {"git_dir": ".", "merge_base": "abc", "files": ["a.go"], "check_head": true}.
+    An "id" key is ignored here and echoed back by run_batch().
+    """
+    if "argv" in query:
+        return [str(a) for a in query["argv"]]
+    argv = []
+    for key, value in query.items():
+        if key == "id":
+            continue
+        flag = "--" + key.replace("_", "-")
+        if value is True:
+            argv.append(flag)
+        elif value is False or value is None:
+            continue
+        elif isinstance(value, list):
+            argv.append(flag)
+            argv.extend(str(v) for v in value)
+        else:
+            argv.append(f"{flag}={value}")
+    return argv
+
+
+def run_batch(stream_in, stream_out, pool: SessionPool) -> None:
+    """Answer newline-delimited JSON queries, streaming one JSON result line per query.
+
+    Each result is {"id", "exit_code", "result", "stderr"}: "result" is the
+    document a standalone run would print (null on failure) and "id" is the
+    query's "id" or its 1-based line number. All queries share one
+    SessionPool, so git sessions, tree indexes and blob contents are reused.
+    """
+    for lineno, line in enumerate(stream_in, start=1):
+        if not line.strip():
+            continue
+        query_id = lineno
+        try:
+            query = json.loads(line)
+            if not isinstance(query, dict):
+                raise ValueError("query must be a JSON object")
+            query_id = query.get("id", lineno)
+            argv = query_to_argv(query)
+        except ValueError as e:
+            response = {
+                "id": query_id, "exit_code": 1, "result": None,
+                "stderr": f"Error: invalid batch query on line {lineno}: {e}\n",
+            }
+        else:
+            if "--batch" in argv or "--serve" in argv:
+                exit_code, out, err = 1, "", "Error: --batch and --serve cannot be nested\n"
+            else:
+                exit_code, out, err = execute(argv, pool)
+            response = {
+                "id": query_id,
+                "exit_code": exit_code,
+                "result": json.loads(out) if exit_code == 0 else None,
+                "stderr": err,
+            }
+        stream_out.write(json.dumps(response) + "\n")
+        stream_out.flush()
+
+
+class _DaemonHandler(socketserver.StreamRequestHandler):
+    """One request per connection: a JSON line in, a JSON line out.
+
+    A failing request resets the sessions of the repositories it touched
+    (see execute), so one bad request cannot poison the daemon's later ones.
+    """
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return  # liveness probe or client gave up
+        try:
+            request = json.loads(line)
+            argv = [str(a) for a in request["argv"]]
+            cwd = request.get("cwd") or os.getcwd()
+        except (ValueError, KeyError, TypeError):
+            response = {"exit_code": 1, "stdout": "", "stderr": "Error: malformed daemon request\n"}
+        else:
+            # Requests run one at a time, so a process-wide chdir is safe here
+            # and lets relative --git-dir / --cache-dir arguments work.
+            previous_cwd = os.getcwd()
+            try:
+                os.chdir(cwd)
+                exit_code, out, err = execute(argv, self.server.pool)
+            except OSError as e:
+                exit_code, out, err = 1, "", f"Error: {e}\n"
+            finally:
+                os.chdir(previous_cwd)
+            response = {"exit_code": exit_code, "stdout": out, "stderr": err}
+        try:
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+        except OSError:
+            pass  # client went away; nothing to report to
+
+
+def serve(socket_path: str, idle_timeout: float, watch: bool = False) -> None:
+    """Answer resolver requests on a per-user Unix socket until idle for idle_timeout seconds.
+
+    Git sessions, tree indexes, blob contents and directive scans are kept
+    warm per repository between requests; with watch, so are whole
+    working-tree responses (see WorkingTreeWatch).
+    """
+    socket_dir = os.path.dirname(socket_path)
+    if socket_dir == fallback_socket_dir() and not make_private_dir(socket_dir):
+        print(f"Error: {socket_dir} is not a private directory owned by this user", file=sys.stderr)
+        sys.exit(1)
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            os.unlink(socket_path)  # stale socket from a daemon that died
+        else:
+            print(f"Error: a resolver daemon is already listening on {socket_path}", file=sys.stderr)
+            sys.exit(1)
+        finally:
+            probe.close()
+
+    old_umask = os.umask(0o077)
+    try:
+        server = socketserver.UnixStreamServer(socket_path, _DaemonHandler)
+    finally:
+        os.umask(old_umask)
+    server.pool = SessionPool(watch=watch)
+    server.timeout = idle_timeout
+    idle = []
+    server.handle_timeout = lambda: idle.append(True)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while not idle:
+            server.handle_request()
+    finally:
+        server.server_close()
+        server.pool.close()
+        try:
+            os.unlink(socket_path)
+        except OSError:
+            pass
+
+
+def resolution_settings(args: argparse.Namespace) -> dict:
+    """The options a result's content depends on, written to its "settings" field."""
+    return {
+        "mode": "working-tree" if args.working_tree else "merge-base",
+        "depth": args.depth,
+        "budget": args.budget,
+        "budget_unit": args.budget_unit,
+        "dedupe_includes": args.dedupe_includes,
+    }
+
+
+def reuse_previous_result(
+    git: GitSession,
+    previous_path: str,
+    previous_base: str,
+    ref: str,
+    sorted_dirs: list[str],
+    ancestor_dirs_list: str,
+    settings: dict,
+) -> Optional[tuple[list[Guideline], list[str], Resolution]]:
+    """Carry a result computed at another merge-base over to `ref` if still exact.
+
+    The previous result holds iff it was computed with the same settings
+    (see resolution_settings), covers the same ancestor dirs and no
+    path it depends on differs between the two merge-bases: the guideline
+    candidates of every ancestor dir (so none appeared or vanished) and
+    every directive target, found or not, and no directory or other
+    non-blob target was included. That takes one `git diff-tree` between
+    the two commits. Returns None when the result must be
+    recomputed, including when the file is unreadable or the diff fails.
+    """
+    try:
+        with open(previous_path, "r") as f:
+            previous = json.load(f)
+        if previous["settings"] != settings or previous["ancestor_dirs_list"] != ancestor_dirs_list:
+            return None
+        guidelines = [Guideline(**g) for g in previous["expected_guidelines"]]
+        directives = [Directive(**d) for d in previous["expected_directives"]]
+        resolution = Resolution(
+            resolved_content=previous["resolved_content"],
+            directives=directives,
+            guidelines_loaded_section=previous["guidelines_loaded_section"],
+            source_map=[SourceSpan(**span) for span in previous["source_map"]],
+        )
+        warnings = list(previous["warnings"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    # Non-blob targets (oid None) are rendered by `git show`, whose header
+    # names the ref as spelled on the command line
+    if any(span.oid is None for span in resolution.source_map):
+        return None
+    depends_on = {d.resolved_path for d in directives}
+    depends_on.update(g.path for g in guidelines)
+    for d in sorted_dirs:
+        depends_on.update(guideline_candidates(d))
+
+    try:
+        for changed in git.iter_z(
+            "diff-tree", "-r", "-z", "--no-renames", "--name-only", previous_base, ref,
+        ):
+            # A change under a directory target changes its listing too
+            path = changed
+            while path:
+                if path in depends_on:
+                    return None
+                path = posixpath.dirname(path)
+    except subprocess.CalledProcessError:
+        return None
+    return guidelines, warnings, resolution
+
+
+def discover_and_resolve(
+    args: argparse.Namespace,
+    repo: RepoState,
+    ref: Optional[str],
+    sorted_dirs: list[str],
+    metrics: Optional[Metrics] = None,
+    dependencies: Optional[dict] = None,
+) -> tuple[list[Guideline], list[str], Resolution]:
+    """Find the ancestor dirs' guidelines and resolve them (steps 2-4 of main).
+
+    In working-tree mode a dependencies dict, if given, is filled with
+    every file consulted (absolute path -> file identity, None if absent).
+    """
+    git = repo.git
+    # Step 2: Index the merge-base tree's guidelines (merge-base mode only)
+    tree_index = None
+    tree_oid = None
+    if not args.working_tree and ref:
+        info = git.object_info(f"{ref}^{{tree}}")
+        if info is None:
+            print(f"Error: cannot resolve a tree for merge-base {ref}", file=sys.stderr)
+            sys.exit(1)
+        tree_oid = info[0]
+        # Warm process: reuse the index of an already-scanned tree
+        tree_index = repo.tree_indexes.get(tree_oid)
+        if tree_index is None:
+            try:
+                tree_index = TreeIndex.scan(git, tree_oid)
+            except subprocess.CalledProcessError as e:
+                print(f"Error: git diff-tree failed: {e.stderr}", file=sys.stderr)
+                sys.exit(1)
+            repo.tree_indexes[tree_oid] = tree_index
+    if metrics is not None:
+        metrics.lap("tree_scan")
+
+    # Step 3: Per-directory CLAUDE.md discovery (set lookups against the index)
+    expected_guidelines = []
+    guideline_paths_set = set()
+    warnings = []
+
+    listings = DirectoryListings(git.git_dir) if args.working_tree else None
+    for d in sorted_dirs:
+        if args.working_tree:
+            found = probe_claude_md_paths(git, None, d, True, listings=listings)
+        else:
+            found = probe_claude_md_paths(git, ref, d, False, tree_index)
+        for path in found:
+            if path not in guideline_paths_set:
+                expected_guidelines.append(Guideline(path=path, exists_at_merge_base=True))
+                guideline_paths_set.add(path)
+    if metrics is not None:
+        metrics.lap("discovery")
+
+    # Step 4: Read content and resolve @ directives (or reuse a cached resolution)
+    cache = None
+    cache_key = None
+    resolution = None
+    if args.cache_dir:
+        cache = DiskCache(args.cache_dir, args.cache_max_bytes)
+    blob_cache = None
+    if args.blob_cache is not None and not args.working_tree:
+        if args.blob_cache:
+            blob_cache = DiskCache(args.blob_cache, args.cache_max_bytes)
+        else:
+            if repo.shared_blob_cache_dir is None:
+                repo.shared_blob_cache_dir = shared_blob_cache_dir(git)
+            if repo.shared_blob_cache_dir is not None:
+                blob_cache = DiskCache(repo.shared_blob_cache_dir, args.cache_max_bytes)
+    if cache is not None and tree_index is not None:
+        cache_key = resolution_cache_key(
+            tree_index, expected_guidelines, sorted_dirs, args.depth, args.budget,
+            args.budget_unit, args.dedupe_includes,
+        )
+        if cache_key is not None:
+            resolution = load_cached_resolution(cache, cache_key, git, tree_oid)
+
+    if resolution is None:
+        ctx = ResolveContext(
+            git_dir=git.git_dir,
+            merge_base=ref,
+            working_tree=args.working_tree,
+            depth_limit=args.depth,
+            budget=args.budget,
+            budget_remaining=args.budget,
+            budget_unit=args.budget_unit,
+            dedupe_includes=args.dedupe_includes,
+            prefetch_workers=args.prefetch_workers,
+            git=git,
+            directive_scans=repo.directive_scans,
+            blob_texts=repo.blob_texts,
+            token_counts=repo.token_counts,
+            blob_cache=blob_cache,
+            metrics=metrics,
+            listings=listings,
+            content_cache=cache,
+        )
+        resolution = resolve_guidelines(expected_guidelines, ctx)
+        if cache_key is not None:
+            store_cached_resolution(cache, cache_key, resolution, git, tree_oid)
+        if dependencies is not None and args.working_tree:
+            for d in sorted_dirs:
+                for path in guideline_candidates(d):
+                    st = listings.file_stat(path)
+                    ident = (st.st_mtime_ns, st.st_size, st.st_ino) if st is not None else None
+                    dependencies[os.path.join(git.git_dir, path)] = ident
+            for path, info in ctx.target_infos.items():
+                dependencies[os.path.join(git.git_dir, path)] = info.file_id if info else None
+    if metrics is not None:
+        metrics.lap("resolve")
+    return expected_guidelines, warnings, resolution
+
+
+OUTPUT_FIELDS = (
+    "ancestor_dirs_list", "expected_guidelines", "expected_directives",
+    "pr_added_guidelines", "pr_modified_guidelines", "warnings",
+    "guidelines_loaded_section", "resolved_content", "source_map", "settings", "metrics",
+)
+JSON_STRING_CHUNK = 64 * 1024
+
+
+def output_fields(
+    ancestor_dirs_list: str,
+    expected_guidelines: list[Guideline],
+    resolution: Resolution,
+    pr_added_guidelines: list[str],
+    pr_modified_guidelines: list[str],
+    warnings: list[str],
+    settings: dict,
+) -> Iterator[tuple[str, object]]:
+    """The output document's fields in order, except metrics.
+
+    Per-item lists are generators, so a streaming writer never holds them
+    whole.
+    """
+    yield "ancestor_dirs_list", ancestor_dirs_list
+    yield "expected_guidelines", (
+        {"path": g.path, "exists_at_merge_base": g.exists_at_merge_base}
+        for g in expected_guidelines
+    )
+    yield "expected_directives", (
+        {
+            "parent_path": d.parent_path,
+            "directive": d.directive,
+            "resolved_path": d.resolved_path,
+            "exists_at_merge_base": d.exists_at_merge_base,
+            "status": d.status,
+            "depth": d.depth,
+        }
+        for d in resolution.directives
+    )
+    yield "pr_added_guidelines", pr_added_guidelines
+    yield "pr_modified_guidelines", pr_modified_guidelines
+    yield "warnings", warnings
+    yield "guidelines_loaded_section", resolution.guidelines_loaded_section
+    yield "resolved_content", resolution.resolved_content
+    yield "source_map", (asdict(span) for span in resolution.source_map)
+    yield "settings", settings
+
+
+def metrics_summary(
+    metrics: Metrics, resolution: Resolution, git_processes: int, git_bytes_read: int
+) -> dict:
+    """The --timings "metrics" field."""
+    by_depth = {}
+    for d in resolution.directives:
+        by_depth[str(d.depth)] = by_depth.get(str(d.depth), 0) + 1
+    return {
+        "step_seconds": metrics.step_seconds,
+        "git_processes": git_processes,
+        "git_bytes_read": git_bytes_read,
+        "directives": {"total": len(resolution.directives), "by_depth": by_depth},
+        "budget_by_guideline": metrics.budget_by_guideline,
+    }
+
+
+def write_json_value(out, value) -> None:
+    """Write value as compact JSON: strings in chunks, lists and iterators an item at a time.
+
+    A str never splits a code point, so encoding it in slices gives the
+    same text as encoding it whole.
+    """
+    if isinstance(value, str):
+        out.write('"')
+        for start in range(0, len(value), JSON_STRING_CHUNK):
+            out.write(json.dumps(value[start:start + JSON_STRING_CHUNK])[1:-1])
+        out.write('"')
+    elif isinstance(value, (list, Iterator)):
+        out.write("[")
+        for i, item in enumerate(value):
+            if i:
+                out.write(",")
+            write_json_value(out, item)
+        out.write("]")
+    else:
+        out.write(json.dumps(value, separators=(",", ":")))
+
+
+def write_compact_json(out, fields: Iterable[tuple[str, object]]) -> None:
+    """Stream a JSON object one (name, value) pair at a time, on a single line."""
+    out.write("{")
+    for i, (name, value) in enumerate(fields):
+        if i:
+            out.write(",")
+        out.write(json.dumps(name) + ":")
+        write_json_value(out, value)
+    out.write("}\n")
+
+
+def write_indented_json(out, fields: Iterable[tuple[str, object]]) -> None:
+    """Write a JSON object a (name, value) pair at a time, as json.dump(indent=2) would."""
+    empty = True
+    for name, value in fields:
+        if isinstance(value, Iterator):
+            value = list(value)
+        # Encoded strings never hold a raw newline, so this only re-indents
+        encoded = json.dumps(value, indent=2).replace("\n", "\n  ")
+        out.write(("{\n  " if empty else ",\n  ") + json.dumps(name) + ": " + encoded)
+        empty = False
+    out.write("{}\n" if empty else "\n}\n")
+
+
+def main(argv: Optional[list[str]] = None, pool: Optional[SessionPool] = None):
     parser = argparse.ArgumentParser(
         description="Resolve CLAUDE.md files and @ directives for a git repository."
     )
-    parser.add_argument("--git-dir", required=True, help="Directory for git -C commands")
+    parser.add_argument("--git-dir", help="Directory for git -C commands")
     parser.add_argument("--merge-base", help="Trusted commit for reading content")
     parser.add_argument("--working-tree", action="store_true",
                         help="Read from working tree instead of merge-base")
     parser.add_argument("--ref-range", help="e.g. abc123..HEAD for computing changed files")
     parser.add_argument("--depth", type=int, default=5, help="Max @ recursion depth")
     parser.add_argument("--budget", type=int, default=8000, help="Char budget")
+    parser.add_argument("--budget-unit", choices=BUDGET_UNITS, default="chars",
+                        help="Count --budget in characters or in approximate model tokens "
+                             "(token counts of unchanged files are reused from --cache-dir)")
+    parser.add_argument("--prefetch-workers", type=int, default=PREFETCH_WORKERS,
+                        help="Threads reading each include level's working-tree files ahead "
+                             "of resolution (merge-base reads are pipelined instead); "
+                             "0 disables prefetching")
+    parser.add_argument("--dedupe-includes", action="store_true",
+                        help="Replace repeated inclusions of the same content with a "
+                             "'(see <path> above)' reference that costs no budget")
     parser.add_argument("--check-head", action="store_true",
                         help="Also probe HEAD for pr_added_guidelines")
     parser.add_argument("--files", nargs="*", default=None,
                         help="Explicit file list for ancestor-dir computation (alternative to --ref-range)")
+    parser.add_argument("--fields", nargs="+", choices=OUTPUT_FIELDS, default=None, metavar="FIELD",
+                        help="Only output these top-level fields, in document order "
+                             f"(any of: {', '.join(OUTPUT_FIELDS)})")
+    parser.add_argument("--compact", action="store_true",
+                        help="Write single-line JSON, streamed a field at a time "
+                             "with long strings written in chunks")
+    parser.add_argument("--stats", action="store_true",
+                        help="Report the number of git processes spawned on stderr")
+    parser.add_argument("--cache-dir", nargs="?", const=default_cache_dir(), default=None,
+                        help="Reuse merge-base resolutions, token counts, and working-tree "
+                             "file texts keyed by (path, mtime, size, inode), from an on-disk cache "
+                             "(default location: $XDG_CACHE_HOME/claude/resolve-claude-md)")
+    parser.add_argument("--blob-cache", nargs="?", const="", default=None, metavar="DIR",
+                        help="Share merge-base blob texts, keyed by OID, with concurrent runs "
+                             "through an on-disk cache (default location: "
+                             "resolve-claude-md/blobs in the repository's common git dir, "
+                             "shared by all of its worktrees)")
+    parser.add_argument("--cache-max-bytes", type=int, default=DEFAULT_CACHE_MAX_BYTES,
+                        help="Evict least-recently-used cache entries beyond this size "
+                             "(applies to --cache-dir and --blob-cache separately)")
+    parser.add_argument("--previous-result", default=None,
+                        help="JSON output of an earlier merge-base run; reused as-is if it "
+                             "was computed with the same --depth, --budget, --budget-unit and "
+                             "--dedupe-includes (its \"settings\" field) and nothing it "
+                             "depends on changed since --previous-merge-base")
+    parser.add_argument("--previous-merge-base", default=None,
+                        help="Merge-base the --previous-result was computed at")
+    parser.add_argument("--object-backend", choices=["subprocess", "python"], default="subprocess",
+                        help="Read git objects through cat-file processes, or in-process "
+                             "(python; falls back to git for anything it does not support)")
+    parser.add_argument("--timings", action="store_true",
+                        help="Add a metrics object to the output: wall time per step, git "
+                             "processes and bytes read, directives per depth, budget per guideline")
+    parser.add_argument("--batch", action="store_true",
+                        help="Read newline-delimited JSON queries on stdin and write one "
+                             "JSON result per line, sharing git state across queries")
+    parser.add_argument("--serve", action="store_true",
+                        help="Run as a daemon answering requests on a Unix socket "
+                             "(use resolve-claude-md-client.py to query it)")
+    parser.add_argument("--watch", action="store_true",
+                        help="With --batch or --serve: keep working-tree results in memory and "
+                             "answer repeated queries from it until a guideline or directive "
+                             "target they read changes (inotify on Linux, polling elsewhere)")
+    parser.add_argument("--socket", default=None,
+                        help="Daemon socket path (default: per-user socket, see --serve)")
+    parser.add_argument("--idle-timeout", type=float, default=600,
+                        help="Seconds without requests before the daemon exits")
+
+    args = parser.parse_args(argv)
+
+    if args.watch and not (args.batch or args.serve):
+        print("Error: --watch requires --batch or --serve", file=sys.stderr)
+        sys.exit(1)
 
-    args = parser.parse_args()
+    if args.batch:
+        batch_pool = SessionPool(watch=args.watch)
+        try:
+            run_batch(sys.stdin, sys.stdout, batch_pool)
+        finally:
+            batch_pool.close()
+        return
+
+    if args.serve:
+        if pool is not None:
+            print("Error: --serve cannot be sent to a running daemon", file=sys.stderr)
+            sys.exit(1)
+        serve(args.socket or default_socket_path(), args.idle_timeout, args.watch)
+        return
+
+    if args.git_dir is None:
+        parser.error("the following arguments are required: --git-dir")
 
     # Validate mode
     if args.merge_base and args.working_tree:
@@ -488,159 +3488,112 @@ def main():
     if args.files is not None and args.ref_range:
         print("Error: --files and --ref-range are mutually exclusive", file=sys.stderr)
         sys.exit(1)
+    if bool(args.previous_result) != bool(args.previous_merge_base):
+        print("Error: --previous-result and --previous-merge-base must be given together",
+              file=sys.stderr)
+        sys.exit(1)
+    if args.previous_result and not args.merge_base:
+        print("Error: --previous-result requires --merge-base", file=sys.stderr)
+        sys.exit(1)
 
     git_dir = args.git_dir
     ref = args.merge_base if args.merge_base else None
+    if pool is not None:
+        repo = pool.repo(git_dir, args.object_backend)
+    else:
+        repo = RepoState(git=GitSession(git_dir, args.object_backend))
+    git = repo.git
+    processes_before = git.processes_spawned
+    bytes_before = git.bytes_read
+    metrics = Metrics() if args.timings else None
 
     # Step 1: Compute ancestor directories from changed files
-    changed_files = []
+    # (paths from --ref-range stream straight from git into the trie)
     if args.ref_range:
-        result = run_git(git_dir, "diff", "--name-only", args.ref_range)
-        if result.returncode != 0:
-            print(f"Error: git diff --name-only failed: {result.stderr}", file=sys.stderr)
+        try:
+            sorted_dirs = ancestor_dirs_deepest_first(
+                git.iter_z("diff", "--name-only", "-z", args.ref_range)
+            )
+        except subprocess.CalledProcessError as e:
+            print(f"Error: git diff --name-only failed: {e.stderr}", file=sys.stderr)
             sys.exit(1)
-        changed_files = [f for f in result.stdout.strip().split("\n") if f]
-    elif args.files is not None:
-        changed_files = [f for f in args.files if f]
-
-    ancestor_dirs = compute_ancestor_dirs(changed_files)
-    sorted_dirs = sort_ancestor_dirs(ancestor_dirs)
+    else:
+        sorted_dirs = ancestor_dirs_deepest_first(args.files or ())
     ancestor_dirs_list = format_ancestor_dirs_list(sorted_dirs)
-    ancestor_set = set(ancestor_dirs)
-
-    # Step 2: Per-directory CLAUDE.md probing
-    expected_guidelines = []
-    guideline_paths_set = set()
-
-    for d in sorted_dirs:
-        if args.working_tree:
-            found = probe_claude_md_paths(git_dir, None, d, True)
-        else:
-            found = probe_claude_md_paths(git_dir, ref, d, False)
-        for path in found:
-            if path not in guideline_paths_set:
-                expected_guidelines.append(Guideline(path=path, exists_at_merge_base=True))
-                guideline_paths_set.add(path)
-
-    # Step 3: Tree-wide verification (merge-base mode only, diagnostics)
-    warnings = []
-    if not args.working_tree and ref:
-        ls_result = run_git(git_dir, "ls-tree", "-r", "--name-only", ref)
-        if ls_result.returncode != 0:
-            print(f"Error: git ls-tree failed: {ls_result.stderr}", file=sys.stderr)
+    if metrics is not None:
+        metrics.lap("ancestor_dirs")
+
+    # Steps 2-4: Discover and resolve guidelines, unless a previous result still holds
+    resolved = None
+    if args.previous_result:
+        resolved = reuse_previous_result(
+            git, args.previous_result, args.previous_merge_base, ref,
+            sorted_dirs, ancestor_dirs_list, resolution_settings(args),
+        )
+        if metrics is not None:
+            metrics.lap("previous_result")
+    # Watch mode caches plain working-tree answers; git state, timings and
+    # stats can change without any working-tree file changing
+    dependencies = None
+    if (
+        pool is not None and pool.watch is not None and args.working_tree
+        and not (args.ref_range or args.timings or args.stats)
+    ):
+        dependencies = {}
+    if resolved is None:
+        resolved = discover_and_resolve(args, repo, ref, sorted_dirs, metrics, dependencies)
+    expected_guidelines, warnings, resolution = resolved
+    guideline_paths_set = {g.path for g in expected_guidelines}
+
+    # Step 5: PR-added and PR-modified guidelines from one merge-base..HEAD tree diff
+    pr_added_guidelines = []
+    pr_modified_guidelines = []
+    if args.check_head and ref:
+        changed = diff_guidelines(git, ref, "HEAD", sorted_dirs)
+        if changed is None:
+            print("Error: git diff-tree against HEAD failed", file=sys.stderr)
             sys.exit(1)
-
-        # Filter for CLAUDE.md paths
-        claude_md_matches = []
-        for line in ls_result.stdout.split("\n"):
-            line = line.strip()
-            if line and (line == "CLAUDE.md" or line.endswith("/CLAUDE.md")):
-                claude_md_matches.append(line)
-
-        # Check if any matches were missed by per-directory probe
-        for match in claude_md_matches:
-            ancestor = get_parent_dir(match)
-            if ancestor not in ancestor_set:
-                continue  # Outside ancestor set, ignore
-            if match not in guideline_paths_set:
-                warnings.append(f"tree-scan found {match} missed by per-directory probe")
-                expected_guidelines.append(Guideline(path=match, exists_at_merge_base=True))
-                guideline_paths_set.add(match)
-
-    # Step 4: Read content and resolve @ directives
-    ctx = ResolveContext(
-        git_dir=git_dir,
-        merge_base=ref,
-        working_tree=args.working_tree,
-        depth_limit=args.depth,
-        budget=args.budget,
-        budget_remaining=args.budget,
+        for status, path in changed:
+            if status == "A" and path not in guideline_paths_set:
+                pr_added_guidelines.append(path)
+            elif status in ("M", "T") and path in guideline_paths_set:
+                pr_modified_guidelines.append(path)
+        if metrics is not None:
+            metrics.lap("check_head")
+
+    # Write output
+    fields = output_fields(
+        ancestor_dirs_list, expected_guidelines, resolution,
+        pr_added_guidelines, pr_modified_guidelines, warnings, resolution_settings(args),
     )
-
-    resolved_content_parts = []
-    all_directives = []
-    guidelines_loaded_lines = []
-    source_label = "working-tree" if args.working_tree else "merge-base"
-
-    for guideline in expected_guidelines:
-        # Read content
-        if args.working_tree:
-            content = read_file_from_disk(git_dir, guideline.path)
-        else:
-            content = read_file_at_ref(git_dir, ref, guideline.path)
-
-        if content is None:
-            continue
-
-        # Apply budget to the CLAUDE.md content itself
-        if len(content) > ctx.budget_remaining:
-            available = ctx.budget_remaining - 11
-            if available <= 0:
-                guidelines_loaded_lines.append(f"- {guideline.path} ({source_label}, budget-exhausted)")
-                continue
-            content = content[:available] + "[truncated]"
-            ctx.budget_remaining = 0
-        else:
-            ctx.budget_remaining -= len(content)
-
-        # Resolve @ directives in this content
-        parent_dir = get_parent_dir(guideline.path)
-        resolved_text, directives = resolve_directives_in_content(
-            content, parent_dir, guideline.path, ctx, 1, set(),
-        )
-
-        resolved_content_parts.append(resolved_text)
-        all_directives.extend(directives)
-
-        # Build guidelines_loaded_section entry
-        gl_line = f"- {guideline.path} ({source_label})"
-        guidelines_loaded_lines.append(gl_line)
-
-        # Add all directive sub-items with depth-based indentation
-        for d in directives:
-            indent = "  " * min(d.depth, 5)
-            guidelines_loaded_lines.append(
-                f"{indent}- @{d.directive} -> {d.resolved_path} ({d.status})"
+    if args.fields:
+        fields = ((name, value) for name, value in fields if name in args.fields)
+
+    if pool is None:
+        git.close()
+
+    def with_metrics(fields):
+        yield from fields
+        if metrics is not None and (not args.fields or "metrics" in args.fields):
+            # Charged after every other field is written, so JSON encoding is timed too
+            metrics.lap("output")
+            yield "metrics", metrics_summary(
+                metrics, resolution,
+                git.processes_spawned - processes_before, git.bytes_read - bytes_before,
             )
 
-    if not guidelines_loaded_lines:
-        guidelines_loaded_lines.append("None found.")
+    if args.compact:
+        write_compact_json(sys.stdout, with_metrics(fields))
+    else:
+        write_indented_json(sys.stdout, with_metrics(fields))
 
-    # Step 5: HEAD probing for pr_added_guidelines
-    pr_added_guidelines = []
-    if args.check_head and ref:
-        for d in sorted_dirs:
-            head_paths = probe_claude_md_paths(git_dir, "HEAD", d, False)
-            for path in head_paths:
-                if path not in guideline_paths_set:
-                    pr_added_guidelines.append(path)
-
-    # Build output
-    output = {
-        "ancestor_dirs_list": ancestor_dirs_list,
-        "expected_guidelines": [
-            {"path": g.path, "exists_at_merge_base": g.exists_at_merge_base}
-            for g in expected_guidelines
-        ],
-        "expected_directives": [
-            {
-                "parent_path": d.parent_path,
-                "directive": d.directive,
-                "resolved_path": d.resolved_path,
-                "exists_at_merge_base": d.exists_at_merge_base,
-                "status": d.status,
-                "depth": d.depth,
-            }
-            for d in all_directives
-        ],
-        "pr_added_guidelines": pr_added_guidelines,
-        "warnings": warnings,
-        "guidelines_loaded_section": "\n".join(guidelines_loaded_lines),
-        "resolved_content": "\n\n".join(resolved_content_parts),
-    }
+    if args.stats:
+        print(f"git processes spawned: {git.processes_spawned - processes_before}", file=sys.stderr)
 
-    json.dump(output, sys.stdout, indent=2)
-    print()  # trailing newline
+    if dependencies is not None:
+        pool.last_dependencies = {
+            os.path.abspath(path): ident for path, ident in dependencies.items()
+        }
 
 
 if __name__ == "__main__":
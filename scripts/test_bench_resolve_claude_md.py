@@ -0,0 +1,122 @@
+"""Tests for bench-resolve-claude-md.py."""
+
+import importlib.util
+import json
+import os
+import subprocess
+
+# Import the script as a module
+spec = importlib.util.spec_from_file_location(
+    "bench_resolve_claude_md",
+    os.path.join(os.path.dirname(__file__), "bench-resolve-claude-md.py"),
+)
+mod = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mod)
+
+TINY = dict(
+    dir_depth=2, fanout=2, files_per_dir=1, guidelines=4, chains=2,
+    chain_depth=3, fan_in=2, doc_bytes=200, changed_files=3, budget=100000,
+    large_doc_lines=300,
+)
+
+
+class TestGenerateRepo:
+    def test_shape_and_includes_resolve(self, tmp_path):
+        shape = mod.Shape(**TINY)
+        info = mod.generate_repo(str(tmp_path), shape)
+        assert len(info["changed_files"]) == 3
+        tracked = subprocess.run(
+            ["git", "-C", str(tmp_path), "ls-tree", "-r", "--name-only", info["base"]],
+            capture_output=True, text=True, check=True,
+        ).stdout.split()
+        assert len([p for p in tracked if p.endswith("CLAUDE.md")]) == 4
+        assert len([p for p in tracked if p.startswith("docs/")]) == 6
+
+        # Every generated @ include points at a real file
+        script = os.path.join(os.path.dirname(__file__), "resolve-claude-md.py")
+        result = subprocess.run(
+            ["python3", script] + mod.resolver_argv(
+                "merge-base", str(tmp_path), info["base"], ["d0/d1/f0.go", "d1/d0/f0.go"], 100000,
+            ),
+            capture_output=True, text=True, check=True,
+        )
+        statuses = {d["status"] for d in json.loads(result.stdout)["expected_directives"]}
+        assert statuses <= {"resolved", "cycle-skipped"}
+
+    def test_deterministic_for_seed(self, tmp_path):
+        shape = mod.Shape(**TINY)
+        first = mod.generate_repo(str(tmp_path / "a"), shape)
+        second = mod.generate_repo(str(tmp_path / "b"), shape)
+        assert first["changed_files"] == second["changed_files"]
+        trees = [
+            subprocess.run(
+                ["git", "-C", str(tmp_path / name), "rev-parse", f"{info['base']}^{{tree}}"],
+                capture_output=True, text=True, check=True,
+            ).stdout
+            for name, info in (("a", first), ("b", second))
+        ]
+        assert trees[0] == trees[1]
+
+
+class TestRunOnce:
+    def test_counts_git_processes_without_resolver_flags(self, tmp_path):
+        # Stands in for an older resolver that knows no --stats flag
+        resolver = tmp_path / "old-resolver.py"
+        resolver.write_text(
+            "import subprocess, sys\n"
+            "assert '--stats' not in sys.argv\n"
+            "for _ in range(3):\n"
+            "    subprocess.run(['git', '--version'], check=True, capture_output=True)\n"
+        )
+        wrapper_dir = tmp_path / "wrapper"
+        wrapper_dir.mkdir()
+        counter = mod.GitCounter.install(str(wrapper_dir))
+        argv = mod.resolver_argv("merge-base", str(tmp_path), "HEAD", ["a.go"], 100)
+        for _ in range(2):
+            assert mod.run_once(str(resolver), argv, counter)["git_processes"] == 3
+
+
+class TestCompare:
+    @staticmethod
+    def _results(wall, rss, procs):
+        return {
+            "shape": {"seed": 0},
+            "results": {"merge-base": {
+                "wall_seconds": wall, "peak_rss_kib": rss, "git_processes": procs,
+            }},
+        }
+
+    def test_within_tolerance(self):
+        assert mod.compare(self._results(1.0, 100, 3), self._results(1.2, 120, 3), 1.25, 1.25) == []
+
+    def test_regressions_reported(self):
+        regressions = mod.compare(
+            self._results(1.0, 100, 3), self._results(2.0, 200, 4), 1.25, 1.25,
+        )
+        assert len(regressions) == 3
+        assert regressions[2] == "merge-base: git processes 3 -> 4"
+
+    def test_shape_mismatch(self):
+        baseline = self._results(1.0, 100, 3)
+        baseline["shape"] = {"seed": 1}
+        assert mod.compare(baseline, self._results(1.0, 100, 3), 1.25, 1.25) != []
+
+
+class TestMain:
+    def test_records_every_mode_and_compares(self, tmp_path):
+        output = tmp_path / "bench.json"
+        args = [f"--{k.replace('_', '-')}={v}" for k, v in TINY.items()]
+        mod.main(args + ["--repeat", "1", "--output", str(output)])
+        results = json.loads(output.read_text())
+        assert set(results["results"]) == {
+            "merge-base", "working-tree", "check-head", "large-document",
+        }
+        for mode in results["results"].values():
+            assert mode["wall_seconds"] > 0
+            assert mode["peak_rss_kib"] > 0
+        assert results["results"]["working-tree"]["git_processes"] == 0
+        # Comparing a run with itself (generous tolerances) finds no regressions
+        mod.main(args + [
+            "--repeat", "1", "--output", str(tmp_path / "again.json"),
+            "--baseline", str(output), "--wall-tolerance", "100", "--rss-tolerance", "100",
+        ])
@@ -1,9 +1,12 @@
 """Tests for resolve-claude-md.py."""
 
 import importlib.util
+import io
+import json
 import os
 import subprocess
 import tempfile
+import time
 
 import pytest
 
@@ -64,6 +67,34 @@ class TestSortAncestorDirs:
         assert result[-1] == ""
 
 
+class TestAncestorDirsDeepestFirst:
+    def test_matches_compute_then_sort(self):
+        files = [
+            "README.md", "a/x", "a-b/x", "a/b/c/d.go", "a.b/c/d", "b/a/z", "a/b/y",
+            "services/payments/handler.go", "services/auth/login.go", "x//y/z",
+            "/lead/slash.go", "trail/", "ünï/cödé/f.py", "",
+        ]
+        expected = mod.sort_ancestor_dirs(mod.compute_ancestor_dirs(files))
+        assert mod.ancestor_dirs_deepest_first(files) == expected
+
+    def test_randomized_against_reference(self):
+        import random
+        rng = random.Random(18)
+        names = ["a", "a-b", "a.b", "b", "B", "z", "ab", ""]
+        for _ in range(200):
+            files = [
+                "/".join(rng.choice(names) for _ in range(rng.randint(1, 6)))
+                for _ in range(rng.randint(0, 30))
+            ]
+            expected = mod.sort_ancestor_dirs(mod.compute_ancestor_dirs(files))
+            assert mod.ancestor_dirs_deepest_first(files) == expected, files
+
+    def test_consumes_a_generator(self):
+        files = (f"pkg{i % 7}/sub{i % 3}/f{i}.go" for i in range(1000))
+        dirs = mod.ancestor_dirs_deepest_first(files)
+        assert dirs[-1] == "" and len(dirs) == 7 + 21 + 1
+
+
 # --- format_ancestor_dirs_list ---
 
 class TestFormatAncestorDirsList:
@@ -114,6 +145,114 @@ class TestIsInsideFencedCodeBlock:
         assert mod.is_inside_fenced_code_block(lines, 1) is True
 
 
+# --- fenced_line_flags ---
+
+class TestFencedLineFlags:
+    def test_matches_per_line_scan(self):
+        lines = [
+            "intro", "```python", "@a.md", "````", "@b.md", "```",
+            "@c.md", "~~~", "@d.md", "```", "~~~~", "``` `x`", "@e.md",
+            "   ~~~", "@f.md", "   ~~~  ",
+        ]
+        flags = mod.fenced_line_flags(lines)
+        assert flags == [
+            mod.is_inside_fenced_code_block(lines, i) for i in range(len(lines))
+        ]
+
+    def test_empty_document(self):
+        assert mod.fenced_line_flags([]) == []
+
+    def test_unclosed_fence_runs_to_end(self):
+        assert mod.fenced_line_flags(["```", "a", "b"]) == [False, True, True]
+
+
+# --- Directive scan scaling ---
+# (wall-clock timing of large documents lives in bench-resolve-claude-md.py)
+
+class _CountingPattern:
+    """Stands in for a compiled regex, counting match() calls."""
+
+    def __init__(self, pattern, calls):
+        self.pattern = pattern
+        self.calls = calls
+
+    def match(self, *args):
+        self.calls.append(1)
+        return self.pattern.match(*args)
+
+
+class TestDirectiveScanScaling:
+    @staticmethod
+    def _fenced_doc(n_lines):
+        """Markdown with code samples whose lines look like @ directives."""
+        block = ["## Example", "```go", "@not-a-directive.md", "x := 1", "```", ""]
+        return "\n".join((block * (n_lines // len(block) + 1))[:n_lines])
+
+    @staticmethod
+    def _fence_matches(content, monkeypatch):
+        """Fence regex matches and fence passes spent resolving content."""
+        calls = []
+        for name in ("FENCE_OPEN_RE", "BACKTICK_FENCE_CLOSE_RE", "TILDE_FENCE_CLOSE_RE"):
+            monkeypatch.setattr(mod, name, _CountingPattern(getattr(mod, name), calls))
+        passes = []
+        real_flags = mod.fenced_line_flags
+        monkeypatch.setattr(mod, "fenced_line_flags", lambda lines: passes.append(1) or real_flags(lines))
+        ctx = mod.ResolveContext(
+            git_dir="/tmp", merge_base=None, working_tree=True,
+            depth_limit=5, budget=8000, budget_remaining=8000,
+        )
+        mod.resolve_directives_in_content(content, "", "CLAUDE.md", ctx, 1, set())
+        monkeypatch.undo()
+        return len(calls), len(passes)
+
+    def test_50k_line_document_scales_linearly(self, monkeypatch):
+        small, small_passes = self._fence_matches(self._fenced_doc(25_000), monkeypatch)
+        large, large_passes = self._fence_matches(self._fenced_doc(50_000), monkeypatch)
+        # One forward pass: at most one fence match per line, so doubling
+        # the input doubles the work. A per-directive rescan from the top
+        # would be quadratic.
+        assert small_passes == large_passes == 1
+        assert large <= 50_000
+        assert large <= 2 * small + 1
+
+
+class TestDirectiveFreeFastPath:
+    @staticmethod
+    def _ctx():
+        return mod.ResolveContext(
+            git_dir="/tmp", merge_base=None, working_tree=True,
+            depth_limit=5, budget=8000, budget_remaining=8000,
+        )
+
+    def test_content_without_candidates_returned_untouched(self):
+        content = "# Rules\n\nEmail me@example.com or use `@x.md`.\n" * 1000
+        ctx = self._ctx()
+        text, directives = mod.resolve_directives_in_content(
+            content, "", "CLAUDE.md", ctx, 1, set(),
+        )
+        assert text is content  # no split/join copy
+        assert directives == []
+        assert ctx.directive_scans == {}
+
+    @pytest.mark.parametrize("content", [
+        "@a.md",
+        "intro\n  @a.md\n",
+        "\x0c@a.md\n",  # str.strip() whitespace other than spaces
+        "```\n@a.md\n```\n@b.md",
+        "````\n```\n@a.md\n````\n",
+        "text `@a.md`\n@",
+        "x @a.md\n\t@../b.md\n@c/d.md\r",
+    ])
+    def test_candidate_scan_matches_full_line_scan(self, content):
+        lines = content.split("\n")
+        flags = mod.fenced_line_flags(lines)
+        expected = [
+            (i, path) for i, line in enumerate(lines)
+            if (path := mod.is_directive_line(line, lines, i, flags)) is not None
+        ]
+        assert mod.scan_directives(content, self._ctx())[1] == expected
+
+
 # --- is_inside_inline_code_span ---
 
 class TestIsInsideInlineCodeSpan:
@@ -389,6 +528,1697 @@ class TestResolveDirectivesInContent:
         assert directives[1].resolved_path == "inner.md"
 
 
+# --- GitSession ---
+
+class TestGitSession:
+    def _commit_repo(self, repo_dir):
+        """Create a repo with a CLAUDE.md and a nested directive target."""
+        for args in (
+            ["git", "init"],
+            ["git", "config", "user.email", "test@test.com"],
+            ["git", "config", "user.name", "Test"],
+        ):
+            subprocess.run(args, cwd=str(repo_dir), capture_output=True, check=True)
+        (repo_dir / "CLAUDE.md").write_text("# Root\n")
+        (repo_dir / "docs").mkdir()
+        (repo_dir / "docs" / "rules.md").write_text("line one\r\nline two\n")
+        subprocess.run(["git", "add", "."], cwd=str(repo_dir), capture_output=True, check=True)
+        subprocess.run(
+            ["git", "commit", "-m", "init"], cwd=str(repo_dir),
+            capture_output=True, check=True,
+        )
+
+    def test_lookups_share_two_processes(self, tmp_path):
+        self._commit_repo(tmp_path)
+        git = mod.GitSession(str(tmp_path))
+        try:
+            for _ in range(5):
+                assert mod.file_exists_at_ref(git, "HEAD", "CLAUDE.md") is True
+                assert mod.file_exists_at_ref(git, "HEAD", "missing.md") is False
+                assert mod.read_file_at_ref(git, "HEAD", "CLAUDE.md") == "# Root\n"
+                assert mod.read_file_at_ref(git, "HEAD", "missing.md") is None
+            assert git.processes_spawned == 2
+        finally:
+            git.close()
+
+    def test_failed_decode_keeps_pipe_in_step(self, tmp_path):
+        self._commit_repo(tmp_path)
+        (tmp_path / "bad.md").write_bytes(b"\xff" * 600)
+        subprocess.run(["git", "add", "."], cwd=str(tmp_path), capture_output=True, check=True)
+        subprocess.run(
+            ["git", "commit", "-m", "bad"], cwd=str(tmp_path), capture_output=True, check=True,
+        )
+        git = mod.GitSession(str(tmp_path))
+        try:
+            for max_chars in (10, None):
+                with pytest.raises(UnicodeDecodeError):
+                    git.read_text("HEAD:bad.md", max_chars)
+                assert git.read_text("HEAD:CLAUDE.md", max_chars) == ("blob", "# Root\n")
+        finally:
+            git.close()
+
+    def test_read_matches_git_show(self, tmp_path):
+        self._commit_repo(tmp_path)
+        git = mod.GitSession(str(tmp_path))
+        try:
+            expected = subprocess.run(
+                ["git", "show", "HEAD:docs/rules.md"], cwd=str(tmp_path),
+                capture_output=True, text=True, check=True,
+            ).stdout
+            assert mod.read_file_at_ref(git, "HEAD", "docs/rules.md") == expected
+            # Directories exist for cat-file -e and read as `git show` listings
+            assert mod.file_exists_at_ref(git, "HEAD", "docs") is True
+            assert "rules.md" in mod.read_file_at_ref(git, "HEAD", "docs")
+        finally:
+            git.close()
+
+    def test_not_a_repository(self, tmp_path):
+        git = mod.GitSession(str(tmp_path / "nope"))
+        try:
+            assert mod.file_exists_at_ref(git, "HEAD", "CLAUDE.md") is False
+            assert mod.read_file_at_ref(git, "HEAD", "CLAUDE.md") is None
+        finally:
+            git.close()
+
+
+# --- TreeIndex ---
+
+class TestTreeIndex:
+    Z = "0" * 40
+    RECORDS = [
+        f":000000 100644 {Z} aaa A", "CLAUDE.md",
+        f":000000 040000 {Z} ttt A", "svc",
+        f":000000 100644 {Z} bbb A", "svc/api/.claude/CLAUDE.md",
+        f":000000 120000 {Z} ccc A", "svc/CLAUDE.md",
+        f":000000 040000 {Z} ddd A", "docs/CLAUDE.md",
+        f":000000 160000 {Z} eee A", "vendor/CLAUDE.md",
+        f":000000 100644 {Z} fff A", "svc/NOTCLAUDE.md",
+    ]
+
+    def test_blobs_and_dirs(self):
+        index = mod.TreeIndex.from_raw_records(self.RECORDS)
+        assert index.blobs == {
+            "CLAUDE.md": "aaa",
+            "svc/api/.claude/CLAUDE.md": "bbb",
+            "svc/CLAUDE.md": "ccc",
+        }
+        # Only trees that are themselves guideline candidates are kept
+        assert index.dirs == {"docs/CLAUDE.md"}
+
+    def test_exists_matches_cat_file_semantics(self):
+        index = mod.TreeIndex.from_raw_records(self.RECORDS)
+        assert index.exists("CLAUDE.md") is True
+        assert index.exists("docs/CLAUDE.md") is True  # directories exist
+        assert index.exists("vendor/CLAUDE.md") is False  # submodule commit
+        assert index.exists("svc/api/CLAUDE.md") is False
+
+    def test_scan_filters_in_git(self, tmp_path):
+        subprocess.run(["git", "init", "-q"], cwd=tmp_path, check=True)
+        (tmp_path / "CLAUDE.md").write_text("root")
+        (tmp_path / "a" / ".claude").mkdir(parents=True)
+        (tmp_path / "a" / ".claude" / "CLAUDE.md").write_text("a")
+        (tmp_path / "b" / "CLAUDE.md").mkdir(parents=True)
+        (tmp_path / "b" / "CLAUDE.md" / "notes.md").write_text("dir")
+        (tmp_path / "c").mkdir()
+        (tmp_path / "c" / "xCLAUDE.md").write_text("not a guideline")
+        for i in range(50):
+            (tmp_path / "c" / f"f{i}.py").write_text("")
+        subprocess.run(["git", "add", "-A"], cwd=tmp_path, check=True)
+        subprocess.run(
+            ["git", "-c", "user.name=T", "-c", "user.email=t@t", "commit", "-qm", "i"],
+            cwd=tmp_path, check=True,
+        )
+        git = mod.GitSession(str(tmp_path))
+        try:
+            tree_oid = git.object_info("HEAD^{tree}")[0]
+            index = mod.TreeIndex.scan(git, tree_oid)
+        finally:
+            git.close()
+        assert set(index.blobs) == {"CLAUDE.md", "a/.claude/CLAUDE.md"}
+        assert index.dirs == {"b/CLAUDE.md"}
+
+    def test_iter_z_streams_records_and_reports_failure(self, tmp_path):
+        git = mod.GitSession(str(tmp_path))
+        with pytest.raises(subprocess.CalledProcessError):
+            list(git.iter_z("ls-tree", "-z", "HEAD"))
+        assert git.processes_spawned == 1
+
+    def test_probe_uses_index_without_git(self):
+        index = mod.TreeIndex.from_raw_records(self.RECORDS)
+        git = mod.GitSession("/nonexistent")
+        assert mod.probe_claude_md_paths(git, "HEAD", "svc/api", False, index) == [
+            "svc/api/.claude/CLAUDE.md",
+        ]
+        assert mod.probe_claude_md_paths(git, "HEAD", "", False, index) == ["CLAUDE.md"]
+        assert git.processes_spawned == 0
+
+
+# --- DiskCache ---
+
+class TestDiskCache:
+    def test_round_trip_and_miss(self, tmp_path):
+        cache = mod.DiskCache(str(tmp_path))
+        assert cache.get("ab" * 32) is None
+        cache.put("ab" * 32, b"payload")
+        assert cache.get("ab" * 32) == b"payload"
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        cache = mod.DiskCache(str(tmp_path))
+        keys = [f"{i:02d}" * 32 for i in range(3)]
+        for i, key in enumerate(keys):
+            cache.put(key, b"x" * 100)
+            # Distinct mtimes regardless of filesystem timestamp granularity
+            os.utime(cache._entry_path(key), ns=(i * 10**9, i * 10**9))
+        cache.get(keys[0])  # most recently used now
+        cache.max_bytes = 250
+        cache.evict()
+        assert cache.get(keys[0]) is not None
+        assert cache.get(keys[1]) is None
+        assert cache.get(keys[2]) is not None
+
+    def test_put_rescans_only_after_enough_writes(self, tmp_path, monkeypatch):
+        cache = mod.DiskCache(str(tmp_path), max_bytes=16 * 100)
+        evictions = []
+        real_evict = cache.evict
+        monkeypatch.setattr(cache, "evict", lambda: evictions.append(1) or real_evict())
+        for i in range(4):
+            cache.put(f"{i:02d}" * 32, b"x" * 40)
+        # First write, then once more than max_bytes / 16 has been written since
+        assert len(evictions) == 2
+
+    def test_unwritable_root_is_ignored(self, tmp_path):
+        blocker = tmp_path / "file"
+        blocker.write_text("not a directory")
+        cache = mod.DiskCache(str(blocker / "cache"))
+        cache.put("cd" * 32, b"payload")
+        assert cache.get("cd" * 32) is None
+
+
+# --- Directive graph memoization ---
+
+class _NoMemo(dict):
+    """A subtree memo that never stores, forcing full re-resolution."""
+
+    def __setitem__(self, key, value):
+        pass
+
+
+class TestDirectiveGraphMemo:
+    @staticmethod
+    def _write(root, files):
+        for name, text in files.items():
+            path = root / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(text)
+
+    @staticmethod
+    def _resolve(root, content, budget, memo=True):
+        ctx = mod.ResolveContext(
+            git_dir=str(root), merge_base=None, working_tree=True,
+            depth_limit=5, budget=budget, budget_remaining=budget,
+        )
+        if not memo:
+            ctx.subtree_memo = _NoMemo()
+        text, directives = mod.resolve_directives_in_content(
+            content, "", "CLAUDE.md", ctx, 1, set(),
+        )
+        return text, directives, ctx.budget_remaining
+
+    def test_shared_include_read_and_resolved_once(self, tmp_path, monkeypatch):
+        self._write(tmp_path, {
+            "a.md": "A\n@shared.md", "b.md": "B\n@shared.md", "c.md": "C\n@shared.md",
+            "shared.md": "shared\n@leaf.md", "leaf.md": "leaf",
+        })
+        reads = []
+        real_read = mod.read_file_from_disk
+        monkeypatch.setattr(
+            mod, "read_file_from_disk",
+            lambda git_dir, path, *rest: reads.append(path) or real_read(git_dir, path, *rest),
+        )
+        visits = []
+        real_resolve = mod.resolve_directive_segments
+        monkeypatch.setattr(
+            mod, "resolve_directive_segments",
+            lambda content, parent_dir, parent_path, *rest: (
+                visits.append(parent_path)
+                or real_resolve(content, parent_dir, parent_path, *rest)
+            ),
+        )
+        text, directives, _ = self._resolve(tmp_path, "@a.md\n@b.md\n@c.md", 8000)
+        assert visits.count("shared.md") == 1
+        assert sorted(reads) == ["a.md", "b.md", "c.md", "leaf.md", "shared.md"]
+        assert text.count("leaf") == 3
+        assert [d.resolved_path for d in directives] == [
+            "a.md", "shared.md", "leaf.md",
+            "b.md", "shared.md", "leaf.md",
+            "c.md", "shared.md", "leaf.md",
+        ]
+
+    @pytest.mark.parametrize("budget", [8000, 60, 45, 40, 30, 20, 12, 5])
+    def test_memoized_output_matches_full_resolution(self, tmp_path, budget):
+        self._write(tmp_path, {
+            "a.md": "A\n@shared.md\n@b.md", "b.md": "B\n@shared.md\n@a.md",
+            "shared.md": "shared\n@leaf.md\n@a.md", "leaf.md": "leaf text",
+        })
+        content = "@a.md\n@b.md\n@shared.md\n@leaf.md"
+        assert self._resolve(tmp_path, content, budget) == self._resolve(
+            tmp_path, content, budget, memo=False,
+        )
+
+
+# --- Daemon and client ---
+
+class TestDaemon:
+    SCRIPT = os.path.join(os.path.dirname(__file__), "resolve-claude-md.py")
+    CLIENT = os.path.join(os.path.dirname(__file__), "resolve-claude-md-client.py")
+
+    @staticmethod
+    def _make_repo(repo_dir):
+        for args in (
+            ["git", "init"],
+            ["git", "config", "user.email", "test@test.com"],
+            ["git", "config", "user.name", "Test"],
+        ):
+            subprocess.run(args, cwd=str(repo_dir), capture_output=True, check=True)
+        (repo_dir / "CLAUDE.md").write_text("# Project\n@AGENTS.md\n")
+        (repo_dir / "AGENTS.md").write_text("Agent rules")
+        (repo_dir / "src").mkdir()
+        (repo_dir / "src" / "main.py").write_text("print('hello')")
+        subprocess.run(["git", "add", "."], cwd=str(repo_dir), capture_output=True, check=True)
+        subprocess.run(
+            ["git", "commit", "-m", "init"], cwd=str(repo_dir),
+            capture_output=True, check=True,
+        )
+
+    def _argv(self, repo_dir):
+        return ["--git-dir", str(repo_dir), "--merge-base", "HEAD", "--files", "src/main.py"]
+
+    def test_execute_reuses_warm_repo_state(self, tmp_path):
+        self._make_repo(tmp_path)
+        expected = subprocess.run(
+            ["python3", self.SCRIPT] + self._argv(tmp_path),
+            capture_output=True, text=True, check=True,
+        ).stdout
+        pool = mod.SessionPool()
+        try:
+            first = mod.execute(self._argv(tmp_path) + ["--stats"], pool)
+            second = mod.execute(self._argv(tmp_path) + ["--stats"], pool)
+        finally:
+            pool.close()
+        assert first[0] == 0 and first[1] == expected
+        assert second[0] == 0 and second[1] == expected
+        # Tree index and blobs are warm: no git work at all for the repeat
+        assert "git processes spawned: 0" in second[2]
+
+    def test_execute_reports_errors_without_raising(self, tmp_path):
+        pool = mod.SessionPool()
+        exit_code, stdout, stderr = mod.execute(["--git-dir", str(tmp_path)], pool)
+        assert exit_code == 1
+        assert stdout == ""
+        assert "one of --merge-base or --working-tree is required" in stderr
+
+    def test_client_falls_back_without_daemon(self, tmp_path):
+        self._make_repo(tmp_path)
+        env = dict(os.environ, RESOLVE_CLAUDE_MD_SOCKET=str(tmp_path / "absent.sock"))
+        direct = subprocess.run(
+            ["python3", self.SCRIPT] + self._argv(tmp_path),
+            capture_output=True, text=True,
+        )
+        via_client = subprocess.run(
+            ["python3", self.CLIENT] + self._argv(tmp_path),
+            capture_output=True, text=True, env=env,
+        )
+        assert via_client.returncode == 0, via_client.stderr
+        assert via_client.stdout == direct.stdout
+
+    def test_client_queries_running_daemon(self, tmp_path):
+        self._make_repo(tmp_path)
+        sock_dir = tempfile.mkdtemp(prefix="rcm")  # short path for AF_UNIX limits
+        sock_path = os.path.join(sock_dir, "d.sock")
+        env = dict(os.environ, RESOLVE_CLAUDE_MD_SOCKET=sock_path)
+        daemon = subprocess.Popen(
+            ["python3", self.SCRIPT, "--serve", "--idle-timeout", "30"], env=env,
+        )
+        try:
+            deadline = time.time() + 10
+            while not os.path.exists(sock_path) and time.time() < deadline:
+                time.sleep(0.05)
+            assert os.path.exists(sock_path)
+            direct = subprocess.run(
+                ["python3", self.SCRIPT] + self._argv(tmp_path),
+                capture_output=True, text=True,
+            )
+            for _ in range(2):
+                via_daemon = subprocess.run(
+                    ["python3", self.CLIENT] + self._argv(tmp_path) + ["--stats"],
+                    capture_output=True, text=True, env=env,
+                )
+                assert via_daemon.returncode == 0, via_daemon.stderr
+                assert via_daemon.stdout == direct.stdout
+            # Answered from the daemon's warm state, not an in-process fallback
+            assert "git processes spawned: 0" in via_daemon.stderr
+        finally:
+            daemon.terminate()
+            daemon.wait(timeout=10)
+        assert not os.path.exists(sock_path)
+        os.rmdir(sock_dir)
+
+    def test_daemon_recovers_from_failed_request(self, tmp_path):
+        self._make_repo(tmp_path)
+        (tmp_path / "CLAUDE.md").write_text("# Project\n@bad.md\n@AGENTS.md\n")
+        (tmp_path / "bad.md").write_bytes(b"\xff" * 600)  # not valid UTF-8
+        subprocess.run(["git", "add", "."], cwd=str(tmp_path), capture_output=True, check=True)
+        subprocess.run(["git", "commit", "-m", "bad"], cwd=str(tmp_path), capture_output=True, check=True)
+        base = ["--git-dir", str(tmp_path), "--merge-base", "HEAD"]
+        sock_dir = tempfile.mkdtemp(prefix="rcm")
+        sock_path = os.path.join(sock_dir, "d.sock")
+        env = dict(os.environ, RESOLVE_CLAUDE_MD_SOCKET=sock_path)
+        daemon = subprocess.Popen(
+            ["python3", self.SCRIPT, "--serve", "--idle-timeout", "30"], env=env,
+        )
+        try:
+            deadline = time.time() + 10
+            while not os.path.exists(sock_path) and time.time() < deadline:
+                time.sleep(0.05)
+            assert os.path.exists(sock_path)
+            direct = subprocess.run(
+                ["python3", self.SCRIPT] + base + ["--depth", "0"],
+                capture_output=True, text=True, check=True,
+            )
+            failures = [
+                subprocess.run(
+                    ["python3", self.CLIENT] + base + ["--budget", "500"],
+                    capture_output=True, text=True, env=env,
+                )
+                for _ in range(2)
+            ]
+            after = subprocess.run(
+                ["python3", self.CLIENT] + base + ["--depth", "0"],
+                capture_output=True, text=True, env=env,
+            )
+        finally:
+            daemon.terminate()
+            daemon.wait(timeout=10)
+        os.rmdir(sock_dir)
+        assert [f.returncode for f in failures] == [1, 1]
+        assert "UnicodeDecodeError" in failures[0].stderr
+        assert failures[1].stderr == failures[0].stderr
+        assert after.returncode == 0, after.stderr
+        assert after.stdout == direct.stdout
+
+
+    def test_fallback_socket_lives_in_private_dir(self, tmp_path, monkeypatch):
+        monkeypatch.delenv("RESOLVE_CLAUDE_MD_SOCKET", raising=False)
+        monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+        monkeypatch.setattr(mod.tempfile, "gettempdir", lambda: str(tmp_path))
+        path = mod.default_socket_path()
+        assert os.path.dirname(path) == mod.fallback_socket_dir()
+        assert mod.make_private_dir(os.path.dirname(path))
+        assert os.stat(os.path.dirname(path)).st_mode & 0o777 == 0o700
+        assert mod.make_private_dir(os.path.dirname(path))  # existing and private
+
+    def test_shared_or_symlinked_socket_dir_is_refused(self, tmp_path):
+        shared = tmp_path / "shared"
+        shared.mkdir()
+        os.chmod(shared, 0o777)
+        assert not mod.make_private_dir(str(shared))
+        private = tmp_path / "private"
+        private.mkdir(mode=0o700)
+        (tmp_path / "link").symlink_to(private)
+        assert not mod.make_private_dir(str(tmp_path / "link"))
+
+    def test_client_ignores_listener_of_another_user(self, tmp_path, monkeypatch):
+        import socketserver
+        import threading
+        spec = importlib.util.spec_from_file_location("resolve_claude_md_client", self.CLIENT)
+        client = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(client)
+        sock_dir = tempfile.mkdtemp(prefix="rcm")  # short path for AF_UNIX limits
+        sock_path = os.path.join(sock_dir, "d.sock")
+        monkeypatch.setenv("RESOLVE_CLAUDE_MD_SOCKET", sock_path)
+
+        class Forged(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.rfile.readline()
+                self.wfile.write(b'{"exit_code": 0, "stdout": "forged", "stderr": ""}\n')
+
+        server = socketserver.UnixStreamServer(sock_path, Forged)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            assert client.query_daemon(["--help"])["stdout"] == "forged"
+            real_uid = os.getuid()
+            monkeypatch.setattr(client.os, "getuid", lambda: real_uid + 1)
+            assert client.query_daemon(["--help"]) is None
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            os.unlink(sock_path)
+            os.rmdir(sock_dir)
+
+
+# --- Batch mode ---
+
+class TestQueryToArgv:
+    def test_keyword_query(self):
+        argv = mod.query_to_argv({
+            "id": 7, "git_dir": "/repo", "merge_base": "abc",
+            "files": ["a.go", "-odd.go"], "check_head": True, "working_tree": False,
+            "depth": 3,
+        })
+        assert argv == [
+            "--git-dir=/repo", "--merge-base=abc", "--files", "a.go", "-odd.go",
+            "--check-head", "--depth=3",
+        ]
+
+    def test_argv_query(self):
+        assert mod.query_to_argv({"argv": ["--git-dir", ".", "--depth", 2]}) == [
+            "--git-dir", ".", "--depth", "2",
+        ]
+
+    def test_empty_files_list_keeps_flag(self):
+        assert mod.query_to_argv({"files": []}) == ["--files"]
+
+
+class TestBatchMode:
+    SCRIPT = os.path.join(os.path.dirname(__file__), "resolve-claude-md.py")
+
+    def test_results_match_standalone_runs(self, tmp_path):
+        TestDaemon._make_repo(tmp_path)
+        (tmp_path / "src" / "CLAUDE.md").write_text("src rules\n")
+        queries = [
+            {"id": "merge-base", "git_dir": str(tmp_path), "merge_base": "HEAD",
+             "files": ["src/main.py"]},
+            {"git_dir": str(tmp_path), "working_tree": True, "files": ["src/main.py"]},
+            {"git_dir": str(tmp_path), "merge_base": "HEAD", "files": [], "stats": True},
+            {"git_dir": str(tmp_path)},
+        ]
+        stdin = "\n".join(json.dumps(q) for q in queries) + "\n\nnot json\n"
+        result = subprocess.run(
+            ["python3", self.SCRIPT, "--batch"],
+            input=stdin, capture_output=True, text=True,
+        )
+        assert result.returncode == 0, result.stderr
+        lines = [json.loads(line) for line in result.stdout.splitlines()]
+        assert [line["id"] for line in lines] == ["merge-base", 2, 3, 4, 6]
+        for query, line in zip(queries[:3], lines):
+            standalone = subprocess.run(
+                ["python3", self.SCRIPT] + mod.query_to_argv(query),
+                capture_output=True, text=True, check=True,
+            )
+            assert line["exit_code"] == 0
+            assert line["result"] == json.loads(standalone.stdout)
+        # The root-only query reuses the tree index and blobs of the first
+        assert "git processes spawned: 0" in lines[2]["stderr"]
+        assert lines[3]["exit_code"] == 1
+        assert lines[3]["result"] is None
+        assert "one of --merge-base or --working-tree" in lines[3]["stderr"]
+        assert lines[4]["exit_code"] == 1
+        assert "invalid batch query on line 6" in lines[4]["stderr"]
+
+
+    def test_failed_query_does_not_affect_later_ones(self, tmp_path):
+        TestDaemon._make_repo(tmp_path)
+        (tmp_path / "CLAUDE.md").write_text("# Project\n@bad.md\n@AGENTS.md\n")
+        (tmp_path / "bad.md").write_bytes(b"\xff" * 600)  # not valid UTF-8
+        subprocess.run(["git", "add", "."], cwd=str(tmp_path), capture_output=True, check=True)
+        subprocess.run(["git", "commit", "-m", "bad"], cwd=str(tmp_path), capture_output=True, check=True)
+        bad = {"git_dir": str(tmp_path), "merge_base": "HEAD", "budget": 500}
+        good = {"git_dir": str(tmp_path), "merge_base": "HEAD", "depth": 0}
+        stdin = "".join(json.dumps(q) + "\n" for q in (bad, bad, good))
+        result = subprocess.run(
+            ["python3", self.SCRIPT, "--batch"],
+            input=stdin, capture_output=True, text=True,
+        )
+        assert result.returncode == 0, result.stderr
+        lines = [json.loads(line) for line in result.stdout.splitlines()]
+        # The repeat fails the same way instead of reading a stale pipe
+        assert [line["exit_code"] for line in lines] == [1, 1, 0]
+        assert "UnicodeDecodeError" in lines[0]["stderr"]
+        assert lines[1]["stderr"] == lines[0]["stderr"]
+        standalone = subprocess.run(
+            ["python3", self.SCRIPT] + mod.query_to_argv(good),
+            capture_output=True, text=True, check=True,
+        )
+        assert lines[2]["result"] == json.loads(standalone.stdout)
+
+    def test_failed_request_drops_its_repository(self, tmp_path):
+        TestDaemon._make_repo(tmp_path)
+        pool = mod.SessionPool()
+        try:
+            argv = ["--git-dir", str(tmp_path), "--merge-base", "HEAD"]
+            assert mod.execute(argv, pool)[0] == 0
+            state = next(iter(pool.repos.values()))
+            assert mod.execute(argv, pool)[0] == 0
+            assert next(iter(pool.repos.values())) is state  # kept warm
+            assert mod.execute(argv[:2] + ["--merge-base", "no-such-ref"], pool)[0] == 1
+            assert pool.repos == {}
+            assert mod.execute(argv, pool)[0] == 0
+        finally:
+            pool.close()
+
+
+# --- Size-first budget planning ---
+
+class TestSizeFirstPlanning:
+    def test_object_infos_pipelines_many_specs(self, tmp_path):
+        TestDaemon._make_repo(tmp_path)
+        git = mod.GitSession(str(tmp_path))
+        try:
+            specs = []
+            for i in range(300):
+                specs += ["HEAD:CLAUDE.md", f"HEAD:missing-{i}.md"]
+            specs.append("HEAD:bad\nspec")
+            infos = git.object_infos(specs)
+            expected = git.object_info("HEAD:CLAUDE.md")
+            assert expected[1] == "blob"
+            assert expected[2] == len("# Project\n@AGENTS.md\n")
+            assert infos[0::2][:300] == [expected] * 300
+            assert infos[1::2] == [None] * 300
+            assert infos[-1] is None
+            assert git.processes_spawned == 1
+        finally:
+            git.close()
+
+    def test_exhausted_budget_skips_reading_guidelines(self, tmp_path, monkeypatch):
+        (tmp_path / "sub").mkdir()
+        (tmp_path / "sub" / "CLAUDE.md").write_text("s" * 40)
+        (tmp_path / "CLAUDE.md").write_text("r" * 400)
+        reads = []
+        real_read = mod.read_file_from_disk
+        monkeypatch.setattr(
+            mod, "read_file_from_disk",
+            lambda git_dir, path, *rest: reads.append(path) or real_read(git_dir, path, *rest),
+        )
+        ctx = mod.ResolveContext(
+            git_dir=str(tmp_path), merge_base=None, working_tree=True,
+            depth_limit=5, budget=45, budget_remaining=45,
+        )
+        resolution = mod.resolve_guidelines([
+            mod.Guideline(path="sub/CLAUDE.md", exists_at_merge_base=True),
+            mod.Guideline(path="CLAUDE.md", exists_at_merge_base=True),
+        ], ctx)
+        assert reads == ["sub/CLAUDE.md"]
+        assert resolution.guidelines_loaded_section == (
+            "- sub/CLAUDE.md (working-tree)\n"
+            "- CLAUDE.md (working-tree, budget-exhausted)"
+        )
+
+    def test_multibyte_guideline_that_fits_is_still_read(self, tmp_path):
+        # 6 bytes on disk but 3 characters: the size alone is not proof it overflows
+        (tmp_path / "CLAUDE.md").write_text("\u00e9\u00e9\u00e9", encoding="utf-8")
+        ctx = mod.ResolveContext(
+            git_dir=str(tmp_path), merge_base=None, working_tree=True,
+            depth_limit=5, budget=3, budget_remaining=3,
+        )
+        resolution = mod.resolve_guidelines(
+            [mod.Guideline(path="CLAUDE.md", exists_at_merge_base=True)], ctx,
+        )
+        assert resolution.resolved_content == "\u00e9\u00e9\u00e9"
+        assert ctx.budget_remaining == 0
+
+
+class TestBudgetCappedReads:
+    CONTENT = "héllo\r\nwörld\rend\n" * 50
+
+    @staticmethod
+    def _commit(repo, files):
+        subprocess.run(["git", "init", "-q"], cwd=repo, check=True)
+        for name, data in files.items():
+            (repo / name).write_bytes(data)
+        subprocess.run(["git", "add", "-A"], cwd=repo, check=True)
+        subprocess.run(
+            ["git", "-c", "user.name=T", "-c", "user.email=t@t", "commit", "-qm", "i"],
+            cwd=repo, check=True,
+        )
+
+    def test_git_prefix_matches_full_decode(self, tmp_path):
+        self._commit(tmp_path, {"doc.md": self.CONTENT.encode("utf-8"), "next.md": b"next"})
+        full = mod.decode_git_text(self.CONTENT.encode("utf-8"))
+        git = mod.GitSession(str(tmp_path))
+        try:
+            for max_chars in (0, 1, 5, 6, 7, 100, len(full) - 1, len(full), len(full) + 5):
+                assert git.read_text("HEAD:doc.md", max_chars) == ("blob", full[:max_chars + 1])
+                # The rest of the object was drained: the pipe is still in sync
+                assert mod.read_file_at_ref(git, "HEAD", "next.md") == "next"
+            assert git.read_text("HEAD:", 3) == ("tree", None)
+            assert mod.read_file_at_ref(git, "HEAD", "next.md", 2) == "nex"
+        finally:
+            git.close()
+
+    def test_disk_prefix(self, tmp_path):
+        (tmp_path / "doc.md").write_bytes(self.CONTENT.encode("utf-8"))
+        full = mod.read_file_from_disk(str(tmp_path), "doc.md")
+        assert mod.read_file_from_disk(str(tmp_path), "doc.md", 7) == full[:8]
+
+    @pytest.mark.parametrize("working_tree", [False, True])
+    def test_oversized_target_read_up_to_budget(self, tmp_path, working_tree):
+        big = "x" * (2 * 1024 * 1024)
+        self._commit(tmp_path, {"CLAUDE.md": b"# Root\n@big.md\n", "big.md": big.encode()})
+        ctx = mod.ResolveContext(
+            git_dir=str(tmp_path), merge_base=None if working_tree else "HEAD",
+            working_tree=working_tree, depth_limit=5, budget=100, budget_remaining=100,
+        )
+        try:
+            resolution = mod.resolve_guidelines(
+                [mod.Guideline(path="CLAUDE.md", exists_at_merge_base=True)], ctx,
+            )
+        finally:
+            ctx.git.close()
+        assert len(ctx.read_cache["big.md"]) <= 100
+        assert resolution.directives[0].status == "truncated"
+        available = 100 - len("# Root\n@big.md\n") - 11
+        assert resolution.resolved_content == "# Root\n" + "x" * available + "[truncated]\n"
+        # A capped read is not a full blob text, so it is not shared across runs
+        expected_cached = [] if working_tree else ["# Root\n@big.md\n"]
+        assert list(ctx.blob_texts.values()) == expected_cached
+
+
+class TestTokenBudget:
+    def test_tokenizer_shapes(self):
+        assert mod.count_tokens("") == 0
+        assert mod.count_tokens("Use the helper") == 3
+        assert mod.count_tokens("internationalization") == 3  # split into 8-letter chunks
+        assert mod.count_tokens("1234567") == 3
+        assert mod.count_tokens("日本語") == 3
+        assert mod.count_tokens("|---|---|") == 3
+        assert mod.count_tokens(mod.TRUNCATION_MARKER) == mod.TRUNCATION_MARKER_TOKENS
+
+    def test_tokens_cover_text_and_prefixes_are_stable(self):
+        import random
+        rng = random.Random(19)
+        alphabet = "ab Z09 \t\n\n|-`#[]é中😀\r.,:"
+        for _ in range(2000):
+            text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 60)))
+            tokens = mod.TOKEN_RE.findall(text)
+            assert "".join(tokens) == text
+            assert all(len(t) <= mod.MAX_TOKEN_CHARS for t in tokens)
+            n = rng.randint(0, 10)
+            assert mod.token_prefix(text, n) == "".join(tokens[:n])
+            if len(tokens) > n:
+                # What read_cap relies on: a capped prefix still overflows and cuts the same
+                prefix = text[:(n + 1) * mod.MAX_TOKEN_CHARS + 1]
+                assert mod.count_tokens(prefix) > n
+                assert mod.token_prefix(prefix, n) == mod.token_prefix(text, n)
+
+    @staticmethod
+    def _resolve(tmp_path, budget, working_tree=True, token_counts=None):
+        ctx = mod.ResolveContext(
+            git_dir=str(tmp_path), merge_base=None if working_tree else "HEAD",
+            working_tree=working_tree, depth_limit=5, budget=budget,
+            budget_remaining=budget, budget_unit="tokens",
+            token_counts=token_counts if token_counts is not None else {},
+        )
+        try:
+            return mod.resolve_guidelines(
+                [mod.Guideline(path="CLAUDE.md", exists_at_merge_base=True)], ctx,
+            ), ctx
+        finally:
+            ctx.git.close()
+
+    def test_statuses_and_token_boundary_truncation(self, tmp_path):
+        (tmp_path / "CLAUDE.md").write_text("Rules\n@a.md\n@b.md\n@c.md\n")
+        (tmp_path / "a.md").write_text("small doc")
+        (tmp_path / "b.md").write_text("長い文書です。" * 10)
+        (tmp_path / "c.md").write_text("never reached")
+        root_cost = mod.count_tokens("Rules\n@a.md\n@b.md\n@c.md\n")
+        budget = root_cost + 2 + 10
+        resolution, ctx = self._resolve(tmp_path, budget)
+        assert [d.status for d in resolution.directives] == [
+            "resolved", "truncated", "budget-dropped",
+        ]
+        available = 10 - mod.TRUNCATION_MARKER_TOKENS
+        assert resolution.resolved_content == (
+            "Rules\nsmall doc\n" + "長い文書です。長"[:available] + "[truncated]\n"
+        )
+        assert ctx.budget_remaining == 0
+
+    def test_capped_reads_match_full_reads(self, tmp_path, monkeypatch):
+        (tmp_path / "CLAUDE.md").write_text("# Root\n@big.md\n")
+        (tmp_path / "big.md").write_text("word " * 5000 + "| x |\n" * 500)
+        capped, ctx = self._resolve(tmp_path, 300)
+        assert "big.md" in ctx.partial_reads
+        assert len(ctx.read_cache["big.md"]) <= 301 * mod.MAX_TOKEN_CHARS + 1
+        monkeypatch.setattr(mod, "read_cap", lambda ctx, info: None)
+        full, ctx = self._resolve(tmp_path, 300)
+        assert not ctx.partial_reads
+        assert capped == full
+
+    def test_token_counts_cached_per_blob_oid(self, tmp_path, monkeypatch):
+        subprocess.run(["git", "init", "-q"], cwd=tmp_path, check=True)
+        (tmp_path / "CLAUDE.md").write_text("# Root\n@a.md\n@copy.md\n")
+        (tmp_path / "a.md").write_text("shared text")
+        (tmp_path / "copy.md").write_text("shared text")
+        subprocess.run(["git", "add", "-A"], cwd=tmp_path, check=True)
+        subprocess.run(
+            ["git", "-c", "user.name=T", "-c", "user.email=t@t", "commit", "-qm", "i"],
+            cwd=tmp_path, check=True,
+        )
+        counted = []
+        real_count = mod.count_tokens
+        monkeypatch.setattr(mod, "count_tokens", lambda text: counted.append(text) or real_count(text))
+        token_counts = {}
+        first, _ = self._resolve(tmp_path, 1000, working_tree=False, token_counts=token_counts)
+        # Two paths with the same blob are tokenized once
+        assert sorted(counted) == ["# Root\n@a.md\n@copy.md\n", "shared text"]
+        counted.clear()
+        second, _ = self._resolve(tmp_path, 1000, working_tree=False, token_counts=token_counts)
+        assert counted == []
+        assert first == second
+        assert first.resolved_content == "# Root\nshared text\nshared text\n"
+
+    @pytest.mark.parametrize("working_tree", [True, False])
+    def test_token_counts_persist_in_cache_dir(self, tmp_path, monkeypatch, working_tree):
+        repo = tmp_path / "repo"
+        repo.mkdir()
+        subprocess.run(["git", "init", "-q"], cwd=repo, check=True)
+        (repo / "CLAUDE.md").write_text("# Root\n@a.md\n")
+        (repo / "a.md").write_text("some rules")
+        old = time.time() - 60
+        for name in ("CLAUDE.md", "a.md"):
+            os.utime(repo / name, (old, old))
+        subprocess.run(["git", "add", "-A"], cwd=repo, check=True)
+        subprocess.run(
+            ["git", "-c", "user.name=T", "-c", "user.email=t@t", "commit", "-qm", "i"],
+            cwd=repo, check=True,
+        )
+        counted = []
+        real_count = mod.count_tokens
+        monkeypatch.setattr(mod, "count_tokens", lambda text: counted.append(text) or real_count(text))
+        results = []
+        for _ in range(2):
+            # A fresh process: nothing carried over in memory
+            ctx = mod.ResolveContext(
+                git_dir=str(repo), merge_base=None if working_tree else "HEAD",
+                working_tree=working_tree, depth_limit=5, budget=1000, budget_remaining=1000,
+                budget_unit="tokens", content_cache=mod.DiskCache(str(tmp_path / "cache")),
+            )
+            results.append(mod.resolve_guidelines(
+                [mod.Guideline(path="CLAUDE.md", exists_at_merge_base=True)], ctx,
+            ))
+            ctx.git.close()
+        assert sorted(counted) == ["# Root\n@a.md\n", "some rules"]
+        assert results[0] == results[1]
+
+    def test_cli_budget_unit(self, tmp_path):
+        (tmp_path / "CLAUDE.md").write_text("word " * 100)
+        script = os.path.join(os.path.dirname(__file__), "resolve-claude-md.py")
+        contents = {}
+        for unit in ("chars", "tokens"):
+            result = subprocess.run(
+                ["python3", script, "--git-dir", str(tmp_path), "--working-tree",
+                 "--files", "x.go", "--budget", "60", "--budget-unit", unit],
+                capture_output=True, text=True, check=True,
+            )
+            contents[unit] = json.loads(result.stdout)["resolved_content"]
+        assert contents["chars"] == ("word " * 100)[:49] + "[truncated]"
+        assert contents["tokens"] == "word" + " word" * 55 + "[truncated]"
+
+
+class TestDedupeIncludes:
+    SHARED = "Always run the linter before pushing.\n" * 5
+    OTHER = "Other guidance.\n" * 4
+    SVC = "Svc\n@copy.md\n"
+    ROOT = "Root\n@docs/shared.md\n@svc/copy.md\n@docs/other.md\n"
+
+    def _repo(self, tmp_path):
+        (tmp_path / "svc").mkdir()
+        (tmp_path / "CLAUDE.md").write_text(self.ROOT)
+        (tmp_path / "svc" / "CLAUDE.md").write_text(self.SVC)
+        (tmp_path / "svc" / "copy.md").write_text(self.SHARED)
+        (tmp_path / "docs").mkdir()
+        (tmp_path / "docs" / "shared.md").write_text(self.SHARED)
+        (tmp_path / "docs" / "other.md").write_text(self.OTHER)
+
+    @staticmethod
+    def _resolve(tmp_path, budget, dedupe, working_tree=True):
+        ctx = mod.ResolveContext(
+            git_dir=str(tmp_path), merge_base=None if working_tree else "HEAD",
+            working_tree=working_tree, depth_limit=5, budget=budget,
+            budget_remaining=budget, dedupe_includes=dedupe,
+        )
+        guidelines = [
+            mod.Guideline(path="svc/CLAUDE.md", exists_at_merge_base=True),
+            mod.Guideline(path="CLAUDE.md", exists_at_merge_base=True),
+        ]
+        try:
+            return mod.resolve_guidelines(guidelines, ctx), ctx
+        finally:
+            ctx.git.close()
+
+    def test_repeats_become_free_back_references(self, tmp_path):
+        self._repo(tmp_path)
+        plain, plain_ctx = self._resolve(tmp_path, 8000, dedupe=False)
+        deduped, ctx = self._resolve(tmp_path, 8000, dedupe=True)
+        assert plain.resolved_content.count(self.SHARED) == 3
+        assert deduped.resolved_content == (
+            "Svc\n" + self.SHARED + "\n\n\n"
+            "Root\n(see svc/copy.md above)\n(see svc/copy.md above)\n" + self.OTHER + "\n"
+        )
+        assert [d.status for d in deduped.directives] == [
+            "resolved", "deduplicated", "deduplicated", "resolved",
+        ]
+        assert "  - @docs/shared.md -> docs/shared.md (deduplicated)" in (
+            deduped.guidelines_loaded_section
+        )
+        # Back-references are not charged
+        assert plain_ctx.budget_remaining + 2 * len(self.SHARED) == ctx.budget_remaining
+
+    def test_saved_budget_reaches_later_guidelines(self, tmp_path):
+        self._repo(tmp_path)
+        budget = len(self.SVC) + len(self.SHARED) + len(self.ROOT) + len(self.OTHER)
+        plain, _ = self._resolve(tmp_path, budget, dedupe=False)
+        deduped, ctx = self._resolve(tmp_path, budget, dedupe=True)
+        assert [d.status for d in plain.directives][1:] == [
+            "truncated", "budget-dropped", "budget-dropped",
+        ]
+        assert deduped.directives[-1].status == "resolved"
+        assert ctx.budget_remaining == 0
+
+    def test_repeat_detected_when_budget_would_cap_the_read(self, tmp_path):
+        self._repo(tmp_path)
+        budget = len(self.SVC) + len(self.SHARED) + len(self.ROOT) + 5
+        deduped, ctx = self._resolve(tmp_path, budget, dedupe=True)
+        assert deduped.directives[1].status == "deduplicated"
+        assert "docs/shared.md" not in ctx.partial_reads
+
+    def test_merge_base_keys_by_blob_oid_without_reading(self, tmp_path):
+        self._repo(tmp_path)
+        subprocess.run(["git", "init", "-q"], cwd=tmp_path, check=True)
+        subprocess.run(["git", "add", "-A"], cwd=tmp_path, check=True)
+        subprocess.run(
+            ["git", "-c", "user.name=T", "-c", "user.email=t@t", "commit", "-qm", "i"],
+            cwd=tmp_path, check=True,
+        )
+        worktree, _ = self._resolve(tmp_path, 8000, dedupe=True)
+        merge_base, ctx = self._resolve(tmp_path, 8000, dedupe=True, working_tree=False)
+        assert merge_base.resolved_content == worktree.resolved_content
+        assert merge_base.directives == worktree.directives
+        assert "docs/shared.md" not in ctx.read_cache
+
+    def test_including_an_emitted_guideline(self, tmp_path):
+        (tmp_path / "svc").mkdir()
+        (tmp_path / "svc" / "CLAUDE.md").write_text("Svc rules\n")
+        (tmp_path / "CLAUDE.md").write_text("Root\n@svc/CLAUDE.md\n")
+        ctx = mod.ResolveContext(
+            git_dir=str(tmp_path), merge_base=None, working_tree=True, depth_limit=5,
+            budget=8000, budget_remaining=8000, dedupe_includes=True,
+        )
+        resolution = mod.resolve_guidelines([
+            mod.Guideline(path="svc/CLAUDE.md", exists_at_merge_base=True),
+            mod.Guideline(path="CLAUDE.md", exists_at_merge_base=True),
+        ], ctx)
+        assert resolution.resolved_content == "Svc rules\n\n\nRoot\n(see svc/CLAUDE.md above)\n"
+
+
+class TestSourceMap:
+    FILES = {
+        "CLAUDE.md": "Root rules\n@docs/a.md\nmiddle\n@docs/a.md\n@missing.md\nend",
+        "svc/CLAUDE.md": "Svc\n@../docs/b.md\n@b.md\n",
+        "svc/b.md": "svc b",
+        "docs/a.md": "alpha\n@leaf.md",
+        "docs/leaf.md": "leaf",
+    }
+
+    @staticmethod
+    def _resolve(root, working_tree=True, budget=8000):
+        TestDirectiveGraphMemo._write(root, TestSourceMap.FILES) if working_tree else None
+        ctx = mod.ResolveContext(
+            git_dir=str(root), merge_base=None if working_tree else "HEAD",
+            working_tree=working_tree, depth_limit=5, budget=budget, budget_remaining=budget,
+        )
+        try:
+            return mod.resolve_guidelines([
+                mod.Guideline(path="svc/CLAUDE.md", exists_at_merge_base=True),
+                mod.Guideline(path="CLAUDE.md", exists_at_merge_base=True),
+            ], ctx)
+        finally:
+            ctx.git.close()
+
+    @staticmethod
+    def _pieces(resolution):
+        content = resolution.resolved_content
+        return [
+            (content[s.offset:s.offset + s.length], s.path, s.depth)
+            for s in resolution.source_map
+        ]
+
+    def test_spans_attribute_every_source_character(self, tmp_path):
+        resolution = self._resolve(tmp_path)
+        assert self._pieces(resolution) == [
+            ("Svc\n@../docs/b.md\n", "svc/CLAUDE.md", 0),
+            ("svc b", "svc/b.md", 1),
+            ("\n", "svc/CLAUDE.md", 0),
+            ("Root rules\n", "CLAUDE.md", 0),
+            ("alpha\n", "docs/a.md", 1),
+            ("leaf", "docs/leaf.md", 2),
+            ("\nmiddle\n", "CLAUDE.md", 0),
+            # The second include is a memo replay: same text, its own spans
+            ("alpha\n", "docs/a.md", 1),
+            ("leaf", "docs/leaf.md", 2),
+            ("\nend", "CLAUDE.md", 0),
+        ]
+        # Only the blank line joining the guidelines is unattributed
+        covered = sum(s.length for s in resolution.source_map)
+        assert covered == len(resolution.resolved_content) - len("\n\n")
+        assert all(s.oid is None for s in resolution.source_map)
+
+    def test_truncated_target_and_marker_belong_to_the_target(self, tmp_path):
+        budget = len(self.FILES["svc/CLAUDE.md"]) + 5 + len(self.FILES["CLAUDE.md"]) + 13
+        resolution = self._resolve(tmp_path, budget=budget)
+        assert ("al[truncated]", "docs/a.md", 1) in self._pieces(resolution)
+
+    def test_merge_base_spans_carry_blob_oids(self, tmp_path):
+        TestDirectiveGraphMemo._write(tmp_path, self.FILES)
+        subprocess.run(["git", "init", "-q"], cwd=tmp_path, check=True)
+        subprocess.run(["git", "add", "-A"], cwd=tmp_path, check=True)
+        subprocess.run(
+            ["git", "-c", "user.name=T", "-c", "user.email=t@t", "commit", "-qm", "i"],
+            cwd=tmp_path, check=True,
+        )
+        resolution = self._resolve(tmp_path, working_tree=False)
+        assert self._pieces(resolution) == self._pieces(self._resolve(tmp_path))
+        for span in resolution.source_map:
+            oid = subprocess.run(
+                ["git", "rev-parse", f"HEAD:{span.path}"], cwd=tmp_path,
+                capture_output=True, text=True, check=True,
+            ).stdout.strip()
+            assert span.oid == oid
+
+    def test_segments_join_to_resolve_directives_in_content(self, tmp_path):
+        TestDirectiveGraphMemo._write(tmp_path, self.FILES)
+        ctx = mod.ResolveContext(
+            git_dir=str(tmp_path), merge_base=None, working_tree=True,
+            depth_limit=5, budget=8000, budget_remaining=8000,
+        )
+        segments, _ = mod.resolve_directive_segments(
+            self.FILES["CLAUDE.md"], "", "CLAUDE.md", ctx, 1, set(),
+        )
+        text, spans = mod.join_segments(segments, ctx)
+        assert text == TestDirectiveGraphMemo._resolve(tmp_path, self.FILES["CLAUDE.md"], 8000)[0]
+        assert [s.offset for s in spans] == sorted(s.offset for s in spans)
+
+
+class TestLevelPrefetch:
+    FILES = {
+        "CLAUDE.md": "Root\n@a.md\n@b.md\n@a.md\n@missing.md\n@dir\n",
+        "svc/CLAUDE.md": "Svc\n@c.md\n",
+        "svc/c.md": "c\n@../a.md\n@d.md",
+        "svc/d.md": "dddd " * 40,
+        "a.md": "a\n@svc/d.md\n@b.md",
+        "b.md": "b " * 30 + "\n@a.md",
+        "dir/x.md": "x",
+    }
+
+    def _setup(self, tmp_path, git=False):
+        TestDirectiveGraphMemo._write(tmp_path, self.FILES)
+        if git:
+            subprocess.run(["git", "init", "-q"], cwd=tmp_path, check=True)
+            subprocess.run(["git", "add", "-A"], cwd=tmp_path, check=True)
+            subprocess.run(
+                ["git", "-c", "user.name=T", "-c", "user.email=t@t", "commit", "-qm", "i"],
+                cwd=tmp_path, check=True,
+            )
+
+    @staticmethod
+    def _resolve(tmp_path, workers, budget=8000, working_tree=True, **kwargs):
+        ctx = mod.ResolveContext(
+            git_dir=str(tmp_path), merge_base=None if working_tree else "HEAD",
+            working_tree=working_tree, depth_limit=5, budget=budget,
+            budget_remaining=budget, prefetch_workers=workers, **kwargs,
+        )
+        try:
+            return mod.resolve_guidelines([
+                mod.Guideline(path="svc/CLAUDE.md", exists_at_merge_base=True),
+                mod.Guideline(path="CLAUDE.md", exists_at_merge_base=True),
+            ], ctx), ctx
+        finally:
+            ctx.git.close()
+
+    @pytest.mark.parametrize("working_tree", [True, False])
+    @pytest.mark.parametrize("budget", [0, 12, 40, 90, 150, 400, 8000])
+    def test_output_identical_to_sequential(self, tmp_path, working_tree, budget):
+        self._setup(tmp_path, git=not working_tree)
+        for kwargs in ({}, {"dedupe_includes": True}, {"budget_unit": "tokens"}):
+            sequential, _ = self._resolve(tmp_path, 0, budget, working_tree, **kwargs)
+            prefetched, _ = self._resolve(tmp_path, 4, budget, working_tree, **kwargs)
+            assert prefetched == sequential, kwargs
+
+    def test_disk_reads_run_on_the_pool_once_each(self, tmp_path, monkeypatch):
+        import threading
+        self._setup(tmp_path)
+        reads = []
+        real_read = mod.read_file_from_disk
+        monkeypatch.setattr(
+            mod, "read_file_from_disk",
+            lambda git_dir, path, *rest: (
+                reads.append((path, threading.current_thread() is threading.main_thread()))
+                or real_read(git_dir, path, *rest)
+            ),
+        )
+        _, ctx = self._resolve(tmp_path, 4)
+        assert sorted(path for path, _ in reads) == [
+            "CLAUDE.md", "a.md", "b.md", "svc/CLAUDE.md", "svc/c.md", "svc/d.md",
+        ]
+        # Level 1 (a.md, b.md, svc/c.md) and level 0 were read off the main thread
+        assert not any(on_main for path, on_main in reads if path != "svc/d.md")
+        assert ctx.prefetched == {}
+
+    def test_git_reads_are_pipelined(self, tmp_path, monkeypatch):
+        self._setup(tmp_path, git=True)
+        single_reads = []
+        real_read_text = mod.GitSession.read_text
+        monkeypatch.setattr(
+            mod.GitSession, "read_text",
+            lambda self, spec, *rest: single_reads.append(spec) or real_read_text(self, spec, *rest),
+        )
+        resolution, ctx = self._resolve(tmp_path, 4, working_tree=False)
+        # Only the directory target, which is not a blob, is read on its own
+        assert single_reads == ["HEAD:dir"]
+        assert resolution.directives[-1].resolved_path == "dir"
+
+    def test_read_texts_matches_read_text(self, tmp_path):
+        self._setup(tmp_path, git=True)
+        git = mod.GitSession(str(tmp_path))
+        try:
+            requests = [
+                ("HEAD:a.md", None), ("HEAD:svc/d.md", 7), ("HEAD:missing.md", None),
+                ("HEAD:dir", 3), ("HEAD:b.md", 0), ("bad\nspec", None), ("HEAD:b.md", 1000),
+            ]
+            expected = [git.read_text(spec, cap) for spec, cap in requests]
+            assert git.read_texts(requests) == expected
+            assert git.read_texts([]) == []
+        finally:
+            git.close()
+
+    def test_prefetch_stops_once_levels_exceed_budget(self, tmp_path, monkeypatch):
+        self._setup(tmp_path)
+        fetched = []
+        real_prefetch = mod.prefetch_targets
+        monkeypatch.setattr(
+            mod, "prefetch_targets",
+            lambda ctx, paths, *rest: fetched.append(sorted(paths)) or real_prefetch(ctx, paths, *rest),
+        )
+        self._resolve(tmp_path, 4, budget=20)
+        assert fetched == [["CLAUDE.md", "svc/CLAUDE.md"]]
+
+    def test_budget_dropped_targets_are_not_fetched(self, tmp_path):
+        files = {"CLAUDE.md": "x" * 7000 + "\n" + "".join(f"@t{i}.md\n" for i in range(20))}
+        files.update({f"t{i}.md": f"{i} " * 10000 for i in range(20)})
+        TestDirectiveGraphMemo._write(tmp_path, files)
+        self.FILES = files
+        self._setup(tmp_path, git=True)
+        results = {}
+        for workers in (0, 4):
+            ctx = mod.ResolveContext(
+                git_dir=str(tmp_path), merge_base="HEAD", working_tree=False,
+                depth_limit=5, budget=8000, budget_remaining=8000, prefetch_workers=workers,
+            )
+            resolution = mod.resolve_guidelines(
+                [mod.Guideline(path="CLAUDE.md", exists_at_merge_base=True)], ctx,
+            )
+            ctx.git.close()
+            results[workers] = resolution, ctx.git.bytes_read
+        assert results[4][0] == results[0][0]
+        statuses = [d.status for d in results[0][0].directives]
+        assert statuses.count("budget-dropped") == 19
+        # Only the one truncated target is read, as without prefetching
+        assert results[4][1] == results[0][1] < 2 * len(files["t0.md"]) + 7200
+
+    def test_tightly_capped_prefetch_is_not_used(self, tmp_path):
+        (tmp_path / "doc.md").write_text("0123456789" * 10)
+        ctx = mod.ResolveContext(
+            git_dir=str(tmp_path), merge_base=None, working_tree=True,
+            depth_limit=5, budget=30, budget_remaining=30,
+        )
+        mod.plan_targets(ctx, ["doc.md"])
+        mod.prefetch_targets(ctx, ["doc.md"])
+        assert ctx.prefetched["doc.md"] == (30, "0123456789" * 3 + "0")
+        ctx.budget_remaining = 5
+        assert mod.take_prefetched(ctx, "doc.md", 5) == (True, "012345")
+        ctx.prefetched["doc.md"] = (30, "0123456789" * 3 + "0")
+        assert mod.take_prefetched(ctx, "doc.md", None) == (False, None)
+        assert ctx.prefetched == {}
+
+
+class TestWorkingTreeCaches:
+    def test_listings_match_isfile_with_one_scandir_per_dir(self, tmp_path, monkeypatch):
+        (tmp_path / "sub" / ".claude").mkdir(parents=True)
+        (tmp_path / "CLAUDE.md").write_text("root")
+        (tmp_path / "sub" / "CLAUDE.md").mkdir()  # a directory is not a file
+        (tmp_path / "sub" / ".claude" / "CLAUDE.md").symlink_to(tmp_path / "CLAUDE.md")
+        (tmp_path / "broken.md").symlink_to(tmp_path / "nowhere.md")
+        scanned = []
+        real_scandir = os.scandir
+        monkeypatch.setattr(
+            mod.os, "scandir", lambda path: scanned.append(path) or real_scandir(path),
+        )
+        listings = mod.DirectoryListings(str(tmp_path))
+        paths = [
+            "CLAUDE.md", ".claude/CLAUDE.md", "sub/CLAUDE.md", "sub/.claude/CLAUDE.md",
+            "broken.md", "missing/CLAUDE.md", "CLAUDE.md/x",
+        ]
+        for _ in range(2):
+            for path in paths:
+                expected = os.path.isfile(os.path.join(tmp_path, path))
+                assert (listings.file_stat(path) is not None) == expected, path
+        assert len(scanned) == len(set(scanned)) == 6
+        assert listings.file_stat("CLAUDE.md").st_size == len("root")
+
+    def test_listings_fall_back_to_stat_for_unlisted_names(self, tmp_path, monkeypatch):
+        (tmp_path / "AGENTS.md").write_text("Agent rules")
+        (tmp_path / "docs").mkdir()
+        real_stat = os.stat
+        stat_calls = []
+
+        def case_insensitive_stat(path, *args, **kwargs):
+            # What a case-insensitive filesystem does for a differently cased name
+            stat_calls.append(path)
+            parent, name = os.path.split(path)
+            try:
+                names = os.listdir(parent)
+            except OSError:
+                names = []
+            for existing in names:
+                if existing.lower() == name.lower():
+                    return real_stat(os.path.join(parent, existing), *args, **kwargs)
+            return real_stat(path, *args, **kwargs)
+
+        monkeypatch.setattr(mod.os, "stat", case_insensitive_stat)
+        listings = mod.DirectoryListings(str(tmp_path))
+        assert listings.file_stat("agents.md").st_size == len("Agent rules")
+        assert listings.file_stat("Docs") is None  # a directory is not a file
+        assert listings.file_stat("missing.md") is None
+        stat_calls.clear()
+        assert listings.file_stat("nowhere/CLAUDE.md") is None
+        assert stat_calls == []  # a missing directory needs no stat() per name
+
+    @staticmethod
+    def _resolve(tmp_path, cache, workers=0):
+        ctx = mod.ResolveContext(
+            git_dir=str(tmp_path / "repo"), merge_base=None, working_tree=True,
+            depth_limit=5, budget=8000, budget_remaining=8000, content_cache=cache,
+            prefetch_workers=workers,
+        )
+        return mod.resolve_guidelines(
+            [mod.Guideline(path="CLAUDE.md", exists_at_merge_base=True)], ctx,
+        )
+
+    @pytest.mark.parametrize("workers", [0, 4])
+    def test_content_cache_skips_unchanged_files(self, tmp_path, monkeypatch, workers):
+        repo = tmp_path / "repo"
+        repo.mkdir()
+        (repo / "CLAUDE.md").write_text("# Root\n@rules.md\n")
+        (repo / "rules.md").write_text("Rules")
+        (repo / "fresh.md").write_text("x")
+        old = time.time() - 60
+        for name in ("CLAUDE.md", "rules.md"):
+            os.utime(repo / name, (old, old))
+        cache = mod.DiskCache(str(tmp_path / "cache"))
+        reads = []
+        real_read = mod.read_file_from_disk
+        monkeypatch.setattr(
+            mod, "read_file_from_disk",
+            lambda git_dir, path, *rest: reads.append(path) or real_read(git_dir, path, *rest),
+        )
+        cold = self._resolve(tmp_path, cache, workers)
+        assert reads == ["CLAUDE.md", "rules.md"]
+        reads.clear()
+        warm = self._resolve(tmp_path, cache, workers)
+        assert warm == cold
+        assert reads == []
+
+        # A rewrite changes mtime/size, so the file is read again
+        (repo / "rules.md").write_text("New rules")
+        changed = self._resolve(tmp_path, cache, workers)
+        assert reads == ["rules.md"]
+        assert "New rules" in changed.resolved_content
+
+    def test_recently_modified_files_not_cached(self, tmp_path):
+        repo = tmp_path / "repo"
+        repo.mkdir()
+        (repo / "CLAUDE.md").write_text("# Root\n")
+        cache = mod.DiskCache(str(tmp_path / "cache"))
+        self._resolve(tmp_path, cache)
+        assert not (tmp_path / "cache").exists() or not any(
+            name for _dir, _dirs, names in os.walk(tmp_path / "cache")
+            for name in names if not name.startswith(".")
+        )
+
+
+class TestSharedBlobCache:
+    SCRIPT = os.path.join(os.path.dirname(__file__), "resolve-claude-md.py")
+
+    @staticmethod
+    def _make_worktrees(tmp_path):
+        main = tmp_path / "main"
+        main.mkdir()
+        TestDaemon._make_repo(main)
+        (main / "AGENTS.md").write_text("Agent rules\n@docs/style.md\n")
+        (main / "docs").mkdir()
+        (main / "docs" / "style.md").write_text("Style rules")
+        subprocess.run(["git", "add", "."], cwd=str(main), capture_output=True, check=True)
+        subprocess.run(["git", "commit", "-m", "docs"], cwd=str(main), capture_output=True, check=True)
+        for name in ("wt1", "wt2"):
+            subprocess.run(
+                ["git", "worktree", "add", "--detach", str(tmp_path / name)],
+                cwd=str(main), capture_output=True, check=True,
+            )
+        return main
+
+    @staticmethod
+    def _argv(repo_dir, *extra):
+        return ["--git-dir", str(repo_dir), "--merge-base", "HEAD",
+                "--files", "src/main.py", *extra]
+
+    @staticmethod
+    def _count_blob_reads(monkeypatch):
+        reads = []
+        real_read_text = mod.GitSession.read_text
+        real_read_texts = mod.GitSession.read_texts
+        monkeypatch.setattr(
+            mod.GitSession, "read_text",
+            lambda self, spec, *a: reads.append(spec) or real_read_text(self, spec, *a),
+        )
+        monkeypatch.setattr(
+            mod.GitSession, "read_texts",
+            lambda self, specs: reads.extend(s for s, _ in specs) or real_read_texts(self, specs),
+        )
+        return reads
+
+    def test_worktrees_share_blobs_through_common_git_dir(self, tmp_path, monkeypatch):
+        main = self._make_worktrees(tmp_path)
+        expected = subprocess.run(
+            ["python3", self.SCRIPT] + self._argv(tmp_path / "wt1"),
+            capture_output=True, text=True, check=True,
+        ).stdout
+        reads = self._count_blob_reads(monkeypatch)
+        first = mod.execute(self._argv(tmp_path / "wt1", "--blob-cache"), mod.SessionPool())
+        assert first == (0, expected, "")
+        assert len(reads) == 3
+        assert os.path.isdir(main / ".git" / "resolve-claude-md" / "blobs")
+
+        # Another worktree, in a fresh process state, reads no blobs from git
+        reads.clear()
+        second = mod.execute(self._argv(tmp_path / "wt2", "--blob-cache"), mod.SessionPool())
+        assert second == (0, expected, "")
+        assert reads == []
+
+    def test_explicit_directory_and_prefetch(self, tmp_path, monkeypatch):
+        self._make_worktrees(tmp_path)
+        cache_dir = str(tmp_path / "blobs")
+        for workers in ("0", "8"):
+            mod.execute(
+                self._argv(tmp_path / "wt1", "--blob-cache", cache_dir, "--prefetch-workers", workers),
+                mod.SessionPool(),
+            )
+        reads = self._count_blob_reads(monkeypatch)
+        for workers in ("0", "8"):
+            exit_code, out, err = mod.execute(
+                self._argv(tmp_path / "wt2", "--blob-cache", cache_dir, "--prefetch-workers", workers),
+                mod.SessionPool(),
+            )
+            assert exit_code == 0, err
+            assert "Style rules" in json.loads(out)["resolved_content"]
+        assert reads == []
+
+    def test_concurrent_runs_agree(self, tmp_path):
+        self._make_worktrees(tmp_path)
+        expected = subprocess.run(
+            ["python3", self.SCRIPT] + self._argv(tmp_path / "wt1"),
+            capture_output=True, text=True, check=True,
+        ).stdout
+        procs = [
+            subprocess.Popen(
+                ["python3", self.SCRIPT] + self._argv(
+                    tmp_path / name, "--blob-cache", "--cache-max-bytes", "40",
+                ),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+            )
+            for name in ("main", "wt1", "wt2") * 3
+        ]
+        for proc in procs:
+            out, err = proc.communicate(timeout=60)
+            assert proc.returncode == 0, err
+            assert out == expected
+
+
+class TestWatchMode:
+    SCRIPT = os.path.join(os.path.dirname(__file__), "resolve-claude-md.py")
+
+    @staticmethod
+    def _backdate(*paths):
+        old = time.time() - 60
+        for path in paths:
+            os.utime(path, (old, old))
+
+    def _make_repo(self, repo_dir):
+        TestDaemon._make_repo(repo_dir)
+        self._backdate(repo_dir / "CLAUDE.md", repo_dir / "AGENTS.md", repo_dir / "src" / "main.py")
+
+    @staticmethod
+    def _argv(repo_dir):
+        return ["--git-dir", str(repo_dir), "--working-tree", "--files", "src/main.py"]
+
+    @staticmethod
+    def _pool(use_inotify):
+        if use_inotify and mod.Inotify.open() is None:
+            pytest.skip("inotify unavailable")
+        pool = mod.SessionPool(watch=True)
+        pool.watch.close()
+        pool.watch = mod.WorkingTreeWatch(use_inotify=use_inotify)
+        return pool
+
+    @staticmethod
+    def _count_runs(monkeypatch):
+        runs = []
+        real = mod.discover_and_resolve
+        monkeypatch.setattr(
+            mod, "discover_and_resolve", lambda *a, **kw: runs.append(1) or real(*a, **kw),
+        )
+        return runs
+
+    def _content(self, pool, repo_dir):
+        exit_code, out, err = mod.execute(self._argv(repo_dir), pool)
+        assert exit_code == 0, err
+        return json.loads(out)["resolved_content"]
+
+    @pytest.mark.parametrize("use_inotify", [True, False])
+    def test_repeat_is_answered_from_memory(self, tmp_path, monkeypatch, use_inotify):
+        self._make_repo(tmp_path)
+        expected = subprocess.run(
+            ["python3", self.SCRIPT] + self._argv(tmp_path),
+            capture_output=True, text=True, check=True,
+        ).stdout
+        runs = self._count_runs(monkeypatch)
+        pool = self._pool(use_inotify)
+        try:
+            responses = [mod.execute(self._argv(tmp_path), pool) for _ in range(3)]
+        finally:
+            pool.close()
+        assert responses == [(0, expected, "")] * 3
+        assert len(runs) == 1
+
+    @pytest.mark.parametrize("use_inotify", [True, False])
+    def test_changes_to_read_files_invalidate(self, tmp_path, monkeypatch, use_inotify):
+        self._make_repo(tmp_path)
+        runs = self._count_runs(monkeypatch)
+        pool = self._pool(use_inotify)
+        try:
+            assert "Agent rules" in self._content(pool, tmp_path)
+
+            # An unrelated file changing keeps the cached answer
+            (tmp_path / "src" / "main.py").write_text("print('changed')")
+            (tmp_path / "notes.md").write_text("unrelated")
+            self._content(pool, tmp_path)
+            assert len(runs) == 1
+
+            # A directive target changing
+            (tmp_path / "AGENTS.md").write_text("New agent rules")
+            self._backdate(tmp_path / "AGENTS.md")
+            assert "New agent rules" in self._content(pool, tmp_path)
+            assert len(runs) == 2
+
+            # A guideline appearing in an ancestor dir that had none
+            (tmp_path / "src" / ".claude").mkdir()
+            (tmp_path / "src" / ".claude" / "CLAUDE.md").write_text("src rules")
+            self._backdate(tmp_path / "src" / ".claude" / "CLAUDE.md")
+            assert "src rules" in self._content(pool, tmp_path)
+            assert len(runs) == 3
+
+            # A directive target disappearing
+            (tmp_path / "AGENTS.md").unlink()
+            assert "New agent rules" not in self._content(pool, tmp_path)
+            assert len(runs) == 4
+            self._content(pool, tmp_path)
+            assert len(runs) == 4
+        finally:
+            pool.close()
+
+    def test_recent_files_and_stats_are_not_cached(self, tmp_path, monkeypatch):
+        self._make_repo(tmp_path)
+        runs = self._count_runs(monkeypatch)
+        pool = self._pool(use_inotify=False)
+        try:
+            # Modified within the racy window: a same-size rewrite could keep its mtime
+            (tmp_path / "AGENTS.md").write_text("Agent rules")
+            for _ in range(2):
+                self._content(pool, tmp_path)
+            assert len(runs) == 2
+            self._backdate(tmp_path / "AGENTS.md")
+            for _ in range(2):
+                mod.execute(self._argv(tmp_path) + ["--stats"], pool)
+            assert len(runs) == 4
+        finally:
+            pool.close()
+
+    def test_watch_requires_batch_or_serve(self, tmp_path):
+        exit_code, _, err = mod.execute(self._argv(tmp_path) + ["--watch"], mod.SessionPool())
+        assert exit_code == 1
+        assert "--watch requires --batch or --serve" in err
+
+    def test_batch_watch_matches_plain_batch(self, tmp_path):
+        self._make_repo(tmp_path)
+        query = json.dumps({"git_dir": str(tmp_path), "working_tree": True, "files": ["src/main.py"]})
+        stdin = query + "\n" + query + "\n"
+        plain, watched = (
+            subprocess.run(
+                ["python3", self.SCRIPT, "--batch"] + extra,
+                input=stdin, capture_output=True, text=True, check=True,
+            ).stdout
+            for extra in ([], ["--watch"])
+        )
+        assert watched == plain
+
+
+class TestOutputFields:
+    @staticmethod
+    def _run(repo_dir, *extra):
+        exit_code, out, err = mod.execute(
+            ["--git-dir", str(repo_dir), "--merge-base", "HEAD", "--files", "src/main.py", *extra],
+            mod.SessionPool(),
+        )
+        assert exit_code == 0, err
+        return out
+
+    def test_compact_output_matches_indented(self, tmp_path, monkeypatch):
+        TestDaemon._make_repo(tmp_path)
+        (tmp_path / "AGENTS.md").write_text('Quotes " and \\ \t tabs, caf\u00e9, \U0001f600 and \x01\n' * 5)
+        subprocess.run(["git", "commit", "-qam", "tricky"], cwd=str(tmp_path), check=True)
+        monkeypatch.setattr(mod, "JSON_STRING_CHUNK", 7)  # many chunk boundaries
+        indented = self._run(tmp_path)
+        compact = self._run(tmp_path, "--compact")
+        assert compact.count("\n") == 1 and compact.endswith("}\n")
+        assert json.loads(compact) == json.loads(indented)
+        assert list(json.loads(compact)) == list(json.loads(indented))
+        assert compact == json.dumps(json.loads(indented), separators=(",", ":")) + "\n"
+
+    @pytest.mark.parametrize("compact", [[], ["--compact"]])
+    def test_fields_selects_keys_in_document_order(self, tmp_path, compact):
+        TestDaemon._make_repo(tmp_path)
+        full = json.loads(self._run(tmp_path))
+        selected = json.loads(self._run(
+            tmp_path, *compact, "--fields", "resolved_content", "guidelines_loaded_section",
+        ))
+        assert list(selected) == ["guidelines_loaded_section", "resolved_content"]
+        assert selected == {key: full[key] for key in selected}
+
+    @pytest.mark.parametrize("compact", [[], ["--compact"]])
+    def test_metrics_come_last_and_can_be_left_out(self, tmp_path, compact):
+        TestDaemon._make_repo(tmp_path)
+        output = json.loads(self._run(tmp_path, *compact, "--timings"))
+        assert list(output)[-1] == "metrics"
+        assert "output" in output["metrics"]["step_seconds"]
+        output = json.loads(self._run(tmp_path, *compact, "--timings", "--fields", "warnings"))
+        assert output == {"warnings": []}
+
+    @pytest.mark.parametrize("value", [
+        {"a": [1, {"b": []}], "c": {}}, [], {}, "line\nbreak é", None, 1.5,
+    ])
+    def test_indented_writer_matches_json_dump(self, value):
+        out = io.StringIO()
+        mod.write_indented_json(out, [("first", value), ("second", iter(["x", value]))])
+        expected = {"first": value, "second": ["x", value]}
+        assert out.getvalue() == json.dumps(expected, indent=2) + "\n"
+        out = io.StringIO()
+        mod.write_indented_json(out, [])
+        assert out.getvalue() == "{}\n"
+
+    def test_timings_encodes_output_once(self, tmp_path, monkeypatch):
+        TestDaemon._make_repo(tmp_path)
+        content = json.loads(self._run(tmp_path))["resolved_content"]
+        encoded = []
+        real_dumps = json.dumps
+        monkeypatch.setattr(
+            mod.json, "dumps",
+            lambda value, **kwargs: encoded.append(value) or real_dumps(value, **kwargs),
+        )
+        self._run(tmp_path, "--timings")
+        assert encoded.count(content) == 1
+
+    def test_unknown_field_is_rejected(self, tmp_path):
+        exit_code, out, err = mod.execute(
+            ["--git-dir", str(tmp_path), "--working-tree", "--fields", "content"],
+            mod.SessionPool(),
+        )
+        assert exit_code == 2
+        assert out == ""
+        assert "invalid choice: 'content'" in err
+
+    def test_batch_query_fields_list(self, tmp_path):
+        TestDaemon._make_repo(tmp_path)
+        argv = mod.query_to_argv({
+            "git_dir": str(tmp_path), "merge_base": "HEAD", "files": ["src/main.py"],
+            "fields": ["resolved_content"], "compact": True,
+        })
+        exit_code, out, err = mod.execute(argv, mod.SessionPool())
+        assert exit_code == 0, err
+        assert list(json.loads(out)) == ["resolved_content"]
+
+
+class TestPythonObjectBackend:
+    """The in-process ObjectDatabase must answer exactly like git cat-file."""
+
+    @staticmethod
+    def _git(repo, *args, **kwargs):
+        return subprocess.run(
+            ["git", "-C", str(repo)] + list(args),
+            capture_output=True, text=True, check=True, **kwargs,
+        ).stdout
+
+    @classmethod
+    def _make_repo(cls, repo, object_format="sha1"):
+        repo.mkdir()
+        cls._git(repo, "init", "-q", f"--object-format={object_format}")
+        cls._git(repo, "config", "user.email", "t@t")
+        cls._git(repo, "config", "user.name", "T")
+        (repo / "docs").mkdir()
+        (repo / "docs" / "ünïcode.md").write_text("unicode name")
+        (repo / "link.md").symlink_to("CLAUDE.md")
+        for i in range(8):
+            # Similar versions of a large file so repacking produces delta chains
+            lines = [f"line {n} of the rules" for n in range(2000)]
+            lines[i * 200] = f"changed in version {i}"
+            (repo / "CLAUDE.md").write_text("\n".join(lines[:1500 + i * 50]) + "\n")
+            (repo / "docs" / f"v{i}.md").write_text("\n".join(lines[i:]) + "\n")
+            cls._git(repo, "add", "-A")
+            cls._git(repo, "commit", "-qm", f"v{i}")
+        head = cls._git(repo, "rev-parse", "HEAD").strip()
+        cls._git(repo, "update-index", "--add", "--cacheinfo", f"160000,{head},vendor/sub")
+        cls._git(repo, "update-index", "--add", "--cacheinfo", f"160000,{'1' * len(head)},vendor/ext")
+        cls._git(repo, "commit", "-qm", "submodule")
+        cls._git(repo, "tag", "-a", "v1", "-m", "release", "HEAD~2")
+        cls._git(repo, "tag", "light", "HEAD~1")
+
+    @classmethod
+    def _specs(cls, repo):
+        paths = cls._git(repo, "ls-tree", "-r", "-t", "-z", "--name-only", "HEAD").split("\0")
+        specs = [f"HEAD:{p}" for p in paths if p]
+        specs += [
+            "HEAD", "HEAD^{tree}", "HEAD:", "v1", "v1^{tree}", "v1:CLAUDE.md", "light:docs",
+            "master:CLAUDE.md", "refs/heads/master:docs/v3.md", "heads/master:link.md",
+            "HEAD:missing.md", "HEAD:docs/missing/x.md", "HEAD:CLAUDE.md/x", "HEAD:vendor/sub/x",
+            "no-such-ref:CLAUDE.md",
+            # Left to git: revision expressions, abbreviations, relative paths
+            "HEAD~3:CLAUDE.md", "HEAD^:docs", cls._git(repo, "rev-parse", "--short", "HEAD").strip(),
+            "HEAD:./CLAUDE.md",
+        ]
+        objects = cls._git(
+            repo, "cat-file", "--batch-all-objects", "--batch-check=%(objectname)",
+        ).split()
+        return specs + objects
+
+    def _compare_backends(self, repo):
+        native = mod.GitSession(str(repo))
+        python = mod.GitSession(str(repo), "python")
+        try:
+            assert python._object_db() is not None
+            specs = self._specs(repo)
+            assert python.object_infos(specs) == native.object_infos(specs)
+            for spec in specs:
+                assert python.read_object(spec) == native.read_object(spec), spec
+                assert python.read_text(spec, 100) == native.read_text(spec, 100), spec
+            # Only the specs left to git started a process
+            assert python.processes_spawned <= 2
+        finally:
+            native.close()
+            python.close()
+
+    def test_loose_objects(self, tmp_path):
+        self._make_repo(tmp_path / "repo")
+        self._compare_backends(tmp_path / "repo")
+
+    def test_packed_ofs_deltas(self, tmp_path):
+        repo = tmp_path / "repo"
+        self._make_repo(repo)
+        self._git(repo, "repack", "-adf", "--depth=50", "--window=50")
+        self._git(repo, "prune-packed")
+        assert "delta" in self._git(repo, "verify-pack", "-v", *[
+            str(p) for p in (repo / ".git" / "objects" / "pack").glob("*.idx")
+        ])
+        self._compare_backends(repo)
+
+    def test_packed_ref_deltas_and_packed_refs(self, tmp_path):
+        repo = tmp_path / "repo"
+        self._make_repo(repo)
+        self._git(repo, "-c", "repack.useDeltaBaseOffset=false", "repack", "-adf")
+        self._git(repo, "pack-refs", "--all")
+        self._compare_backends(repo)
+
+    def test_sha256_repository(self, tmp_path):
+        repo = tmp_path / "repo"
+        self._make_repo(repo, "sha256")
+        self._git(repo, "repack", "-ad")
+        self._compare_backends(repo)
+
+    def test_linked_worktree(self, tmp_path):
+        repo = tmp_path / "repo"
+        self._make_repo(repo)
+        self._git(repo, "worktree", "add", "-q", "--detach", str(tmp_path / "wt"), "HEAD~4")
+        native = mod.GitSession(str(tmp_path / "wt"))
+        python = mod.GitSession(str(tmp_path / "wt"), "python")
+        try:
+            for spec in ("HEAD:CLAUDE.md", "master:CLAUDE.md", "v1^{tree}"):
+                assert python.object_info(spec) == native.object_info(spec)
+            assert python.processes_spawned == 0
+        finally:
+            native.close()
+            python.close()
+
+    def test_unsupported_repository_falls_back(self, tmp_path):
+        repo = tmp_path / "repo"
+        self._make_repo(repo)
+        self._git(repo, "config", "extensions.partialClone", "origin")
+        self._git(repo, "config", "core.repositoryFormatVersion", "1")
+        python = mod.GitSession(str(repo), "python")
+        try:
+            assert python._object_db() is None
+            assert python.object_info("HEAD:CLAUDE.md")[1] == "blob"
+            assert python.processes_spawned == 1
+        finally:
+            python.close()
+
+    def test_main_output_identical(self, tmp_path):
+        repo = tmp_path / "repo"
+        self._make_repo(repo)
+        (repo / "docs" / "CLAUDE.md").write_text("@v1.md\n@../link.md\n@missing.md\n")
+        self._git(repo, "add", "-A")
+        self._git(repo, "commit", "-qm", "guideline")
+        self._git(repo, "gc", "-q")
+        script = os.path.join(os.path.dirname(__file__), "resolve-claude-md.py")
+        outputs = [
+            subprocess.run(
+                ["python3", script, "--git-dir", str(repo), "--merge-base", "HEAD~1",
+                 "--files", "docs/v1.md", "--check-head", "--object-backend", backend],
+                capture_output=True, text=True, check=True,
+            ).stdout
+            for backend in ("subprocess", "python")
+        ]
+        assert outputs[0] == outputs[1]
+        assert "line 1 of the rules" in json.loads(outputs[0])["resolved_content"]
+
+
 # --- Integration test for main() ---
 
 class TestMainIntegration:
@@ -457,8 +2287,8 @@ class TestMainIntegration:
         # Verify all expected keys
         for key in [
             "ancestor_dirs_list", "expected_guidelines", "expected_directives",
-            "pr_added_guidelines", "warnings", "guidelines_loaded_section",
-            "resolved_content",
+            "pr_added_guidelines", "pr_modified_guidelines", "warnings",
+            "guidelines_loaded_section", "resolved_content", "source_map", "settings",
         ]:
             assert key in output, f"Missing key: {key}"
         # Verify guideline was found
@@ -593,6 +2423,333 @@ class TestMainIntegration:
         assert "src" in ancestor_dirs
         assert "(root)" in ancestor_dirs
 
+    def test_stats_reports_constant_git_processes(self, tmp_path):
+        """Test --stats reports a process count independent of directory count."""
+        self._init_git_repo(tmp_path)
+        (tmp_path / "CLAUDE.md").write_text("# Project\n@AGENTS.md\n")
+        (tmp_path / "AGENTS.md").write_text("Agent rules")
+        files = []
+        for i in range(20):
+            d = tmp_path / f"pkg{i}" / "sub"
+            d.mkdir(parents=True)
+            (d / "f.py").write_text("x = 1")
+            files.append(f"pkg{i}/sub/f.py")
+        subprocess.run(
+            ["git", "add", "."], cwd=str(tmp_path),
+            capture_output=True, check=True,
+        )
+        subprocess.run(
+            ["git", "commit", "-m", "init"],
+            cwd=str(tmp_path), capture_output=True, check=True,
+        )
+        script = os.path.join(os.path.dirname(__file__), "resolve-claude-md.py")
+        result = subprocess.run(
+            [
+                "python3", script,
+                "--git-dir", str(tmp_path),
+                "--merge-base", "HEAD",
+                "--files", *files,
+                "--stats",
+            ],
+            capture_output=True, text=True,
+        )
+        assert result.returncode == 0, f"Script failed: {result.stderr}"
+        # ls-tree + batch-check (size planning) + batch, regardless of the
+        # 41 ancestor dirs
+        assert "git processes spawned: 3" in result.stderr
+
+    def _commit_all(self, repo_dir, message):
+        subprocess.run(["git", "add", "."], cwd=str(repo_dir), capture_output=True, check=True)
+        subprocess.run(
+            ["git", "commit", "-m", message], cwd=str(repo_dir),
+            capture_output=True, check=True,
+        )
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=str(repo_dir),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+
+    def test_ref_range_paths_are_not_quoted(self, tmp_path):
+        """Non-ASCII changed paths reach the ancestor trie verbatim."""
+        self._init_git_repo(tmp_path)
+        pkg = tmp_path / "pkg ü"
+        pkg.mkdir()
+        (pkg / "CLAUDE.md").write_text("unicode rules")
+        (pkg / "a.go").write_text("v1")
+        base = self._commit_all(tmp_path, "init")
+        (pkg / "a.go").write_text("v2")
+        self._commit_all(tmp_path, "update")
+        script = os.path.join(os.path.dirname(__file__), "resolve-claude-md.py")
+        result = subprocess.run(
+            ["python3", script, "--git-dir", str(tmp_path), "--merge-base", base,
+             "--ref-range", f"{base}..HEAD"],
+            capture_output=True, text=True,
+        )
+        assert result.returncode == 0, result.stderr
+        output = json.loads(result.stdout)
+        assert output["ancestor_dirs_list"] == "pkg ü, (root)"
+        assert [g["path"] for g in output["expected_guidelines"]] == ["pkg ü/CLAUDE.md"]
+
+    def test_bad_ref_range_exits(self, tmp_path):
+        self._init_git_repo(tmp_path)
+        (tmp_path / "a.go").write_text("v1")
+        self._commit_all(tmp_path, "init")
+        script = os.path.join(os.path.dirname(__file__), "resolve-claude-md.py")
+        result = subprocess.run(
+            ["python3", script, "--git-dir", str(tmp_path), "--working-tree",
+             "--ref-range", "nope..HEAD"],
+            capture_output=True, text=True,
+        )
+        assert result.returncode == 1
+        assert "git diff --name-only failed" in result.stderr
+
+    def _run_cached(self, repo_dir, base, cache_dir):
+        script = os.path.join(os.path.dirname(__file__), "resolve-claude-md.py")
+        result = subprocess.run(
+            [
+                "python3", script,
+                "--git-dir", str(repo_dir),
+                "--merge-base", base,
+                "--files", "src/main.py",
+                "--cache-dir", str(cache_dir),
+                "--stats",
+            ],
+            capture_output=True, text=True,
+        )
+        assert result.returncode == 0, f"Script failed: {result.stderr}"
+        return result
+
+    def test_cache_hit_skips_blob_reads(self, tmp_path):
+        """Test a warm --cache-dir run returns identical output from the tree index alone."""
+        repo = tmp_path / "repo"
+        repo.mkdir()
+        self._init_git_repo(repo)
+        (repo / "CLAUDE.md").write_text("# Project\n@AGENTS.md\n")
+        (repo / "AGENTS.md").write_text("Agent rules")
+        (repo / "src").mkdir()
+        (repo / "src" / "main.py").write_text("print('hello')")
+        base = self._commit_all(repo, "init")
+        cache_dir = tmp_path / "cache"
+        cold = self._run_cached(repo, base, cache_dir)
+        warm = self._run_cached(repo, base, cache_dir)
+        assert warm.stdout == cold.stdout
+        # Tree lookup and target validation (batch-check) plus the guideline
+        # scan; no content was read
+        assert "git processes spawned: 2" in warm.stderr
+
+    def test_cache_invalidated_by_directive_target_change(self, tmp_path):
+        """Test a changed @ target blob misses even though CLAUDE.md is unchanged."""
+        repo = tmp_path / "repo"
+        repo.mkdir()
+        self._init_git_repo(repo)
+        (repo / "CLAUDE.md").write_text("# Project\n@AGENTS.md\n")
+        (repo / "AGENTS.md").write_text("Old rules")
+        (repo / "src").mkdir()
+        (repo / "src" / "main.py").write_text("print('hello')")
+        first = self._commit_all(repo, "init")
+        (repo / "AGENTS.md").write_text("New rules")
+        second = self._commit_all(repo, "update rules")
+        cache_dir = tmp_path / "cache"
+        self._run_cached(repo, first, cache_dir)
+        result = self._run_cached(repo, second, cache_dir)
+        import json
+        assert "New rules" in json.loads(result.stdout)["resolved_content"]
+
+    def test_check_head_reports_added_and_modified_guidelines(self, tmp_path):
+        """Test --check-head classifies guideline changes from one tree diff."""
+        self._init_git_repo(tmp_path)
+        (tmp_path / "CLAUDE.md").write_text("# Root\n")
+        for d in ("svc/api", "svc/web", "other"):
+            (tmp_path / d).mkdir(parents=True)
+            (tmp_path / d / "main.go").write_text("package main")
+        (tmp_path / "svc" / "web" / "CLAUDE.md").write_text("web rules")
+        base = self._commit_all(tmp_path, "init")
+        (tmp_path / "CLAUDE.md").write_text("# Root v2\n")  # modified
+        (tmp_path / "svc" / ".claude").mkdir()
+        (tmp_path / "svc" / ".claude" / "CLAUDE.md").write_text("svc")  # added
+        (tmp_path / "svc" / "api" / "CLAUDE.md").write_text("api")  # added
+        (tmp_path / "svc" / "web" / "CLAUDE.md").unlink()  # deleted
+        (tmp_path / "other" / "CLAUDE.md").write_text("out of scope")
+        (tmp_path / "svc" / "api" / "main.go").write_text("package api")
+        self._commit_all(tmp_path, "pr")
+        script = os.path.join(os.path.dirname(__file__), "resolve-claude-md.py")
+        result = subprocess.run(
+            [
+                "python3", script,
+                "--git-dir", str(tmp_path),
+                "--merge-base", base,
+                "--files", "svc/api/main.go", "svc/web/main.go",
+                "--check-head",
+            ],
+            capture_output=True, text=True,
+        )
+        assert result.returncode == 0, f"Script failed: {result.stderr}"
+        import json
+        output = json.loads(result.stdout)
+        assert output["pr_added_guidelines"] == ["svc/api/CLAUDE.md", "svc/.claude/CLAUDE.md"]
+        assert output["pr_modified_guidelines"] == ["CLAUDE.md"]
+
+    def _run_incremental(self, repo_dir, base, *extra):
+        script = os.path.join(os.path.dirname(__file__), "resolve-claude-md.py")
+        result = subprocess.run(
+            [
+                "python3", script,
+                "--git-dir", str(repo_dir),
+                "--merge-base", base,
+                "--files", "src/main.py",
+                "--stats",
+                *extra,
+            ],
+            capture_output=True, text=True,
+        )
+        assert result.returncode == 0, f"Script failed: {result.stderr}"
+        return result
+
+    def _incremental_repo(self, tmp_path):
+        repo = tmp_path / "repo"
+        repo.mkdir()
+        self._init_git_repo(repo)
+        (repo / "CLAUDE.md").write_text("# Project\n@docs/rules.md\n@docs/missing.md\n")
+        (repo / "docs").mkdir()
+        (repo / "docs" / "rules.md").write_text("Rules")
+        (repo / "src").mkdir()
+        (repo / "src" / "main.py").write_text("print('hello')")
+        (repo / "lib").mkdir()
+        (repo / "lib" / "util.py").write_text("")
+        base = self._commit_all(repo, "init")
+        previous = tmp_path / "previous.json"
+        previous.write_text(self._run_incremental(repo, base).stdout)
+        return repo, base, previous
+
+    def test_previous_result_reused_with_one_git_call(self, tmp_path):
+        """Test an unrelated merge-base move reuses the previous result."""
+        repo, base, previous = self._incremental_repo(tmp_path)
+        (repo / "lib" / "util.py").write_text("x = 1")
+        (repo / "src" / "main.py").write_text("print('bye')")
+        new_base = self._commit_all(repo, "unrelated")
+        full = self._run_incremental(repo, new_base)
+        incremental = self._run_incremental(
+            repo, new_base,
+            "--previous-result", str(previous), "--previous-merge-base", base,
+        )
+        assert incremental.stdout == full.stdout
+        assert "git processes spawned: 1" in incremental.stderr
+
+    @pytest.mark.parametrize("change", [
+        ("docs/rules.md", "New rules"),  # directive target changed
+        ("docs/missing.md", "Now here"),  # not-found target appeared
+        ("src/CLAUDE.md", "New guideline"),  # guideline candidate appeared
+    ])
+    def test_previous_result_recomputed_when_dependency_moves(self, tmp_path, change):
+        """Test a change to anything the result depends on forces re-resolution."""
+        repo, base, previous = self._incremental_repo(tmp_path)
+        path, content = change
+        (repo / path).write_text(content)
+        new_base = self._commit_all(repo, "relevant")
+        full = self._run_incremental(repo, new_base)
+        incremental = self._run_incremental(
+            repo, new_base,
+            "--previous-result", str(previous), "--previous-merge-base", base,
+        )
+        assert incremental.stdout == full.stdout
+        assert json.loads(incremental.stdout) != json.loads(previous.read_text())
+
+    @pytest.mark.parametrize("settings", [
+        ["--budget", "10"],
+        ["--depth", "0"],
+        ["--budget-unit", "tokens"],
+        ["--dedupe-includes"],
+    ])
+    def test_previous_result_recomputed_when_settings_differ(self, tmp_path, settings):
+        """Test a result computed with other settings is never reused."""
+        repo, base, previous = self._incremental_repo(tmp_path)
+        full = self._run_incremental(repo, base, *settings)
+        incremental = self._run_incremental(
+            repo, base, *settings,
+            "--previous-result", str(previous), "--previous-merge-base", base,
+        )
+        assert incremental.stdout == full.stdout
+        assert json.loads(incremental.stdout)["settings"] != json.loads(previous.read_text())["settings"]
+
+    def test_previous_result_with_directory_target_not_reused(self, tmp_path):
+        """Test a listing naming the previous ref is recomputed however that ref is spelled."""
+        repo, base, previous = self._incremental_repo(tmp_path)
+        (repo / "CLAUDE.md").write_text("# Project\n@docs\n")
+        base = self._commit_all(repo, "directory target")
+        short_base = subprocess.run(
+            ["git", "rev-parse", "--short", base], cwd=str(repo),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+        previous.write_text(self._run_incremental(repo, short_base).stdout)
+        assert f"tree {short_base}:docs" in previous.read_text()
+        (repo / "lib" / "util.py").write_text("x = 1")
+        new_base = self._commit_all(repo, "unrelated")
+        incremental = self._run_incremental(
+            repo, new_base,
+            "--previous-result", str(previous), "--previous-merge-base", base,
+        )
+        assert incremental.stdout == self._run_incremental(repo, new_base).stdout
+        assert f"tree {new_base}:docs" in incremental.stdout
+
+    def test_previous_result_from_working_tree_not_reused(self, tmp_path):
+        """Test a working-tree result is not carried over to a merge-base."""
+        repo, base, previous = self._incremental_repo(tmp_path)
+        (repo / "docs" / "rules.md").write_text("Uncommitted rules")
+        script = os.path.join(os.path.dirname(__file__), "resolve-claude-md.py")
+        previous.write_text(subprocess.run(
+            ["python3", script, "--git-dir", str(repo), "--working-tree", "--files", "src/main.py"],
+            capture_output=True, text=True, check=True,
+        ).stdout)
+        incremental = self._run_incremental(
+            repo, base, "--previous-result", str(previous), "--previous-merge-base", base,
+        )
+        assert incremental.stdout == self._run_incremental(repo, base).stdout
+        assert "Uncommitted rules" not in incremental.stdout
+
+    def test_previous_result_requires_previous_merge_base(self, tmp_path):
+        """Test --previous-result without --previous-merge-base is rejected."""
+        script = os.path.join(os.path.dirname(__file__), "resolve-claude-md.py")
+        result = subprocess.run(
+            [
+                "python3", script, "--git-dir", str(tmp_path), "--merge-base", "HEAD",
+                "--previous-result", str(tmp_path / "previous.json"),
+            ],
+            capture_output=True, text=True,
+        )
+        assert result.returncode == 1
+        assert "must be given together" in result.stderr
+
+    def test_timings_adds_metrics(self, tmp_path):
+        """Test --timings reports steps, git I/O, directive depths and budget use."""
+        self._init_git_repo(tmp_path)
+        (tmp_path / "CLAUDE.md").write_text("# Root\n@a.md\n")
+        (tmp_path / "a.md").write_text("A\n@b.md\n")
+        (tmp_path / "b.md").write_text("B")
+        (tmp_path / "src").mkdir()
+        (tmp_path / "src" / "main.py").write_text("")
+        base = self._commit_all(tmp_path, "init")
+        script = os.path.join(os.path.dirname(__file__), "resolve-claude-md.py")
+        cmd = [
+            "python3", script, "--git-dir", str(tmp_path), "--merge-base", base,
+            "--files", "src/main.py", "--check-head",
+        ]
+        plain = subprocess.run(cmd, capture_output=True, text=True)
+        timed = subprocess.run(cmd + ["--timings", "--stats"], capture_output=True, text=True)
+        assert timed.returncode == 0, f"Script failed: {timed.stderr}"
+        assert "metrics" not in json.loads(plain.stdout)
+        output = json.loads(timed.stdout)
+        metrics = output.pop("metrics")
+        assert output == json.loads(plain.stdout)
+        assert set(metrics["step_seconds"]) == {
+            "ancestor_dirs", "tree_scan", "discovery", "resolve", "check_head", "output",
+        }
+        assert f"git processes spawned: {metrics['git_processes']}" in timed.stderr
+        assert metrics["git_bytes_read"] > len("# Root\n@a.md\nA\n@b.md\nB")
+        assert metrics["directives"] == {"total": 2, "by_depth": {"1": 1, "2": 1}}
+        # Budget is charged for each file's full text, directive lines included
+        charged = len("# Root\n@a.md\n") + len("A\n@b.md\n") + len("B")
+        assert metrics["budget_by_guideline"] == {"CLAUDE.md": charged}
+
 
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])